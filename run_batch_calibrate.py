@@ -0,0 +1,183 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Calibrate many cameras from recorded videos or images
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_batch_calibrate.py recordings/ -grid 9x6 -o yaml/fleet --fisheye
+
+Every input is a video file, a directory of images, or a directory searched
+recursively for both. One camera is calibrated per video or image
+directory, the yaml file is written to the output directory under the
+path of the input relative to the searched directory, e.g.
+recordings/truck7/front.mp4 gives yaml/fleet/truck7/front.yaml.
+
+The cameras are processed in parallel on worker processes. The detected
+corners are cached in the -cache directory, so running again with other
+calibration settings does not read the recordings again. Only a well spread
+subset of at most -views views is given to the calibration.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from surround_view.calibration import (IMAGE_EXTENSIONS, make_grid_points, detect_source,
+                                       select_views, calibrate_camera, save_camera_params)
+
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov")
+
+
+def is_image_dir(path):
+    return any(f.lower().endswith(IMAGE_EXTENSIONS) for f in os.listdir(path))
+
+
+def find_sources(paths):
+    """
+    Returns a list of (input path, name) where name is the relative path of
+    the yaml file without extension.
+    """
+    sources = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isfile(path) or is_image_dir(path):
+            sources.append((path, os.path.splitext(os.path.basename(path))[0]))
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for d in list(dirs):
+                if is_image_dir(os.path.join(root, d)):
+                    sources.append((os.path.join(root, d),
+                                    os.path.relpath(os.path.join(root, d), path)))
+                    # an image directory is one camera, do not search inside it
+                    dirs.remove(d)
+            for f in sorted(files):
+                if f.lower().endswith(VIDEO_EXTENSIONS):
+                    sources.append((os.path.join(root, f),
+                                    os.path.splitext(os.path.relpath(os.path.join(root, f),
+                                                                     path))[0]))
+    return sources
+
+
+def calibrate_source(path, output, grid_size, fisheye, framestep, max_size, max_views,
+                     cache_dir):
+    """
+    Runs on a worker process. Returns a dict with the statistics of the
+    camera, a camera that fails for any reason is reported with its error
+    and does not stop the others.
+    """
+    result = {"path": path, "output": output, "ok": False, "error": ""}
+    try:
+        return _calibrate_source(result, path, output, grid_size, fisheye, framestep,
+                                 max_size, max_views, cache_dir)
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = "{}: {}".format(type(e).__name__,
+                                          (str(e).strip().splitlines() or [""])[-1])
+        return result
+
+
+def _calibrate_source(result, path, output, grid_size, fisheye, framestep, max_size,
+                      max_views, cache_dir):
+    cv2.setNumThreads(1)
+    # every image of a directory is meant to be a view
+    step = 1 if os.path.isdir(path) else framestep
+    t0 = time.perf_counter()
+    try:
+        image_size, _, corners, frames_read, cached = detect_source(
+            path, grid_size, step, max_size, cache_dir)
+    except IOError as e:
+        result["error"] = str(e)
+        return result
+    t1 = time.perf_counter()
+    result.update(frames=frames_read, boards=len(corners), cached=cached, detect_time=t1 - t0)
+
+    if len(corners) < 12:
+        result["error"] = "only {} boards found".format(len(corners))
+        return result
+
+    views = [corners[k] for k in select_views(corners, image_size, max_views)]
+    try:
+        rms, K, D, views_used = calibrate_camera(views, make_grid_points(grid_size),
+                                                 image_size, fisheye)
+    except (cv2.error, RuntimeError) as e:
+        result["error"] = str(e).strip().splitlines()[-1]
+        return result
+    result.update(calibrate_time=time.perf_counter() - t1, views=views_used, rms=rms)
+
+    output_dir = os.path.dirname(output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    save_camera_params(output, image_size, K, D)
+    result["ok"] = True
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+",
+                        help="videos, image directories or directories containing them")
+    parser.add_argument("-grid", "--grid", default="9x6",
+                        help="size of the calibrate grid pattern")
+    parser.add_argument("-o", "--output", default=os.path.join(os.getcwd(), "yaml", "batch"),
+                        help="directory of the output yaml files")
+    parser.add_argument("-fisheye", "--fisheye", action="store_true",
+                        help="set true if these are fisheye cameras")
+    parser.add_argument("-framestep", type=int, default=5,
+                        help="use every nth frame of the videos")
+    parser.add_argument("-detect_size", "--detect_size", type=int, default=640,
+                        help="longer side of the downscaled image corners are searched on, 0 for full size")
+    parser.add_argument("-views", "--views", type=int, default=30,
+                        help="maximum number of views used for the calibration of a camera")
+    parser.add_argument("-cache", "--cache", default=os.path.join(os.getcwd(), ".calib_cache"),
+                        help="directory the detected corners are cached in, empty to disable")
+    parser.add_argument("-workers", "--workers", type=int, default=None,
+                        help="number of worker processes, defaults to the number of cores")
+    args = parser.parse_args()
+
+    grid_size = tuple(int(x) for x in args.grid.split("x"))
+    sources = find_sources(args.inputs)
+    if len(sources) == 0:
+        print("no videos or image directories found")
+        return
+
+    print("calibrating {} cameras".format(len(sources)))
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(calibrate_source, path,
+                                   os.path.join(args.output, name + ".yaml"),
+                                   grid_size, args.fisheye, args.framestep, args.detect_size,
+                                   args.views, args.cache or None): path
+                   for path, name in sources}
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except Exception as e:
+                # the worker process itself died, e.g. killed for its memory
+                r = {"path": futures[future], "ok": False,
+                     "error": "{}: {}".format(type(e).__name__, e)}
+            results.append(r)
+            if r["ok"]:
+                print("{}: {} frames, {} boards, {} views, rms {:.3f} px, "
+                      "detect {:.1f} s{}, calibrate {:.1f} s".format(
+                          r["path"], r["frames"], r["boards"], r["views"], r["rms"],
+                          r["detect_time"], " (cached)" if r["cached"] else "",
+                          r["calibrate_time"]))
+            else:
+                print("{}: FAILED, {}".format(r["path"], r["error"]))
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["ok"]]
+    detected = [r for r in results if "frames" in r and not r["cached"]]
+    frames = sum(r["frames"] for r in detected)
+    print("{} of {} cameras calibrated in {:.1f} s, {:.1f} cameras per minute".format(
+        len(ok), len(results), elapsed, 60 * len(results) / elapsed))
+    print("{} frames read ({} cameras from cache), {:.1f} frames per second".format(
+        frames, sum(1 for r in results if r.get("cached")), frames / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,16 +8,19 @@ Usage:
         -i 0 \
         -grid 9x6 \
         -out fisheye.yaml \
-        -framestep 20 \
+        -framestep 1 \
         --resolution 640x480
         --fisheye
+
+Chessboard detection runs on a pool of worker processes, frames that arrive
+while all workers are busy are skipped, and views too close to one already
+collected are discarded.
 """
 import argparse
 import os
-import numpy as np
 import cv2
-from surround_view import CaptureThread, MultiBufferManager
-import surround_view.utils as utils
+from surround_view import CaptureThread, MultiBufferManager, CornerCollector
+from surround_view.calibration import calibrate_camera, save_camera_params
 
 
 # we will save the camera param file to this directory
@@ -41,9 +44,18 @@ def main():
     parser.add_argument("-r", "--resolution", default="640x480",
                         help="resolution of the camera image")
 
-    parser.add_argument("-framestep", type=int, default=20,
+    parser.add_argument("-framestep", type=int, default=1,
                         help="use every nth frame in the video")
 
+    parser.add_argument("-workers", "--workers", type=int, default=None,
+                        help="number of corner detection processes, defaults to the number of cores")
+
+    parser.add_argument("-detect_size", "--detect_size", type=int, default=640,
+                        help="longer side of the downscaled image corners are searched on, 0 for full size")
+
+    parser.add_argument("-min_distance", "--min_distance", type=float, default=0.02,
+                        help="discard views closer than this to a collected one, relative to the image diagonal")
+
     parser.add_argument("-o", "--output", default=DEFAULT_PARAM_FILE,
                         help="path to output yaml file")
 
@@ -71,11 +83,12 @@ def main():
     W = int(resolution_str[0])
     H = int(resolution_str[1])
     grid_size = tuple(int(x) for x in args.grid.split("x"))
-    grid_points = np.zeros((1, np.prod(grid_size), 3), np.float32)
-    grid_points[0, :, :2] = np.indices(grid_size).T.reshape(-1, 2)
 
-    objpoints = []  # 3d point in real world space
-    imgpoints = []  # 2d points in image plane
+    # the detection processes must be forked before the capture thread starts
+    collector = CornerCollector(grid_size,
+                                workers=args.workers,
+                                max_size=args.detect_size,
+                                min_distance=args.min_distance)
 
     device = args.input
     cap_thread = CaptureThread(device_id=device,
@@ -89,42 +102,39 @@ def main():
         cap_thread.start()
     else:
         print("cannot open device")
+        collector.close()
         return
 
     quit = False
     do_calib = False
+    last_corners = None
     i = -1
     while True:
         i += 1
         img = buffer_manager.get_device(device).get().image
-        if i % args.framestep != 0:
-            continue
-
-        print("searching for chessboard corners in frame " + str(i) + "...")
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        found, corners = cv2.findChessboardCorners(
-            gray,
-            grid_size,
-            cv2.CALIB_CB_ADAPTIVE_THRESH +
-            cv2.CALIB_CB_NORMALIZE_IMAGE +
-            cv2.CALIB_CB_FILTER_QUADS
-        )
-        if found:
-            term = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
-            cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1), term)
-            print("OK")
-            imgpoints.append(corners)
-            objpoints.append(grid_points)
-            cv2.drawChessboardCorners(img, grid_size, corners, found)
+        if i % args.framestep == 0:
+            collector.submit(img)
 
+        for corners, kept in collector.poll():
+            last_corners = corners
+            if kept:
+                print("view {} collected in frame {}".format(len(collector.views), i))
+
+        if last_corners is not None:
+            # the corners lag the displayed frame by the detection time
+            cv2.drawChessboardCorners(img, grid_size, last_corners, True)
+
+        text4 = "views: {}".format(len(collector.views))
         cv2.putText(img, text1, (20, 70), font, fontscale, (255, 200, 0), 2)
         cv2.putText(img, text2, (20, 110), font, fontscale, (255, 200, 0), 2)
         cv2.putText(img, text3, (20, 30), font, fontscale, (255, 200, 0), 2)
+        cv2.putText(img, text4, (20, 150), font, fontscale, (255, 200, 0), 2)
         cv2.imshow("corners", img)
         key = cv2.waitKey(1) & 0xFF
         if key == ord("c"):
             print("\nPerforming calibration...\n")
-            N_OK = len(objpoints)
+            collector.poll(wait=True)
+            N_OK = len(collector.views)
             if N_OK < 12:
                 print("Less than 12 corners (%d) detected, calibration failed" %(N_OK))
                 continue
@@ -136,47 +146,29 @@ def main():
             quit = True
             break
 
+    print("{} frames submitted, {} skipped while busy, {} boards found, {} duplicates".format(
+        collector.submitted_count, collector.dropped_count,
+        collector.detected_count, collector.duplicate_count))
+    imgpoints = collector.image_points
+    collector.close()
+
     if quit:
         cap_thread.stop()
         cap_thread.disconnect_camera()
         cv2.destroyAllWindows()
 
     if do_calib:
-        N_OK = len(objpoints)
-        K = np.zeros((3, 3))
-        D = np.zeros((4, 1))
-        rvecs = [np.zeros((1, 1, 3), dtype=np.float64) for _ in range(N_OK)]
-        tvecs = [np.zeros((1, 1, 3), dtype=np.float64) for _ in range(N_OK)]
-        calibration_flags = (cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC +
-                             cv2.fisheye.CALIB_CHECK_COND +
-                             cv2.fisheye.CALIB_FIX_SKEW)
-
-        if args.fisheye:
-            ret, mtx, dist, rvecs, tvecs = cv2.fisheye.calibrate(
-                objpoints,
-                imgpoints,
-                (W, H),
-                K,
-                D,
-                rvecs,
-                tvecs,
-                calibration_flags,
-                (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-6)
-            )
-        else:
-            ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
-                objpoints,
-                imgpoints,
-                (W, H),
-                None,
-                None)
+        try:
+            rms, mtx, dist, N_USED = calibrate_camera(imgpoints, collector.grid_points, (W, H),
+                                                      args.fisheye)
+            ret = True
+            print("rms error {:.3f} px with {} views".format(rms, N_USED))
+        except (cv2.error, RuntimeError) as e:
+            print(e)
+            ret = False
 
         if ret:
-            fs = cv2.FileStorage(args.output, cv2.FILE_STORAGE_WRITE)
-            fs.write("resolution", np.int32([W, H]))
-            fs.write("camera_matrix", K)
-            fs.write("dist_coeffs", D)
-            fs.release()
+            save_camera_params(args.output, (W, H), mtx, dist)
             print("successfully saved camera data")
             cv2.putText(img, "Success!", (220, 240), font, 2, (0, 0, 255), 2)
 
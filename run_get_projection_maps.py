@@ -2,20 +2,36 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 Manually select points to get the projection map
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_get_projection_maps.py -camera front -scale 0.7 0.8 -shift -150 -100
+    python run_get_projection_maps.py -camera front --interactive
+
+With --interactive the scale and shift are set with trackbars and the
+keypoints can be dragged, the undistorted image, the projected image and
+the birdview stitched with the other three cameras are previewed at
+1 / -preview_scale resolution while editing. Press Enter to render the
+projection at full resolution and confirm, d to delete the last keypoint
+and q to quit.
 """
 import argparse
 import os
 import numpy as np
 import cv2
-from surround_view import FisheyeCameraModel, PointSelector, display_image
+from surround_view import FisheyeCameraModel, PointSelector, BirdView, display_image
+from surround_view.projection_preview import PreviewProjector
 import surround_view.param_settings as settings
 
 
+# keypoints closer than this to the mouse, in preview pixels, are dragged
+GRAB_DISTANCE = 10
+
+
 def get_projection_map(camera_model, image):
     und_image = camera_model.undistort(image)
     name = camera_model.camera_name
     gui = PointSelector(und_image, title=name)
-    dst_points = settings.project_keypoints[name]
+    dst_points = camera_model.layout.project_keypoints[name]
     choice = gui.loop()
     if choice > 0:
         src = np.float32(gui.keypoints)
@@ -32,6 +48,155 @@ def get_projection_map(camera_model, image):
     return False
 
 
+class InteractiveProjection(object):
+
+    """
+    Edit the scale, shift and keypoints of a camera with a live preview.
+    """
+
+    def __init__(self, preview, others=(), birdview=None):
+        """
+        preview: the `PreviewProjector` of the camera being edited.
+        others: the `PreviewProjector`s of the other cameras, in the order of
+            `settings.camera_names` without the edited one.
+        birdview: a `BirdView` with weights loaded, to preview the stitched
+            image, or None.
+        """
+        self.preview = preview
+        self.others = list(others)
+        self.birdview = birdview
+        self.title = preview.camera.camera_name
+        self.dragging = None
+        self.dirty = True
+        sx, sy = preview.scale_xy
+        tx, ty = preview.shift_xy
+        self.trackbars = {"scale x %": (int(round(sx * 100)), 300),
+                          "scale y %": (int(round(sy * 100)), 300),
+                          "shift x + 1000": (int(round(tx)) + 1000, 2000),
+                          "shift y + 1000": (int(round(ty)) + 1000, 2000)}
+
+    def get_scale_and_shift(self):
+        values = {name: cv2.getTrackbarPos(name, self.title) for name in self.trackbars}
+        scale = (max(values["scale x %"], 1) / 100.0, max(values["scale y %"], 1) / 100.0)
+        shift = (values["shift x + 1000"] - 1000, values["shift y + 1000"] - 1000)
+        return scale, shift
+
+    def onchange(self, value):
+        scale, shift = self.get_scale_and_shift()
+        if scale != self.preview.scale_xy or shift != self.preview.shift_xy:
+            self.preview.set_scale_and_shift(scale, shift)
+            self.dirty = True
+
+    def onclick(self, event, x, y, flags, param):
+        s = self.preview.s
+        keypoints = list(self.preview.keypoints)
+        if event == cv2.EVENT_LBUTTONDOWN:
+            for i, (px, py) in enumerate(keypoints):
+                if np.hypot(px / s - x, py / s - y) <= GRAB_DISTANCE:
+                    self.dragging = i
+                    return
+            if len(keypoints) < 4:
+                keypoints.append((x * s, y * s))
+                self.preview.set_keypoints(keypoints)
+                self.dirty = True
+
+        elif event == cv2.EVENT_MOUSEMOVE and self.dragging is not None:
+            keypoints[self.dragging] = (x * s, y * s)
+            self.preview.set_keypoints(keypoints)
+            self.dirty = True
+
+        elif event == cv2.EVENT_LBUTTONUP:
+            self.dragging = None
+
+    def draw(self):
+        s = self.preview.s
+        image = self.preview.get_undistorted().copy()
+        points = [(int(round(x / s)), int(round(y / s))) for x, y in self.preview.keypoints]
+        for i, pt in enumerate(points):
+            cv2.circle(image, pt, 4, PointSelector.POINT_COLOR, -1)
+            cv2.putText(image, str(i), (pt[0], pt[1] - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, PointSelector.POINT_COLOR, 1)
+        if len(points) == 4:
+            # the keypoints are clicked in the order top left, top right,
+            # bottom left, bottom right
+            cv2.polylines(image, [np.int32([points[0], points[1], points[3], points[2]])],
+                          True, PointSelector.FILL_COLOR, 1)
+        cv2.imshow(self.title, image)
+        cv2.imshow("projected", self.preview.get_projected())
+        if self.birdview is not None:
+            cv2.imshow("birdview", self.stitch())
+
+    def stitch(self):
+        s = self.preview.s
+        frames = {p.camera.camera_name: p.get_projected() for p in [self.preview] + self.others}
+        canvas, weights, car = self.birdview.get_scaled_tables(s)
+        layout = self.birdview.layout
+        self.birdview.stitch_planes(canvas, [frames[name] for name in layout.camera_names],
+                                    weights, s)
+        np.copyto(canvas[layout.yt // s:layout.yb // s, layout.xl // s:layout.xr // s], car)
+        return canvas
+
+    def loop(self):
+        """
+        Returns True if the keypoints were confirmed with Enter, False if
+        the user quit.
+        """
+        cv2.namedWindow(self.title)
+        for name, (value, maximum) in self.trackbars.items():
+            cv2.createTrackbar(name, self.title, value, maximum, self.onchange)
+        cv2.setMouseCallback(self.title, self.onclick)
+
+        while True:
+            if self.dirty:
+                self.draw()
+                self.dirty = False
+
+            key = cv2.waitKey(10) & 0xFF
+            if key == ord("q") or cv2.getWindowProperty(self.title, cv2.WND_PROP_AUTOSIZE) < 0:
+                return False
+
+            if key == ord("d") and len(self.preview.keypoints) > 0:
+                self.preview.set_keypoints(self.preview.keypoints[:-1])
+                self.dirty = True
+
+            if key == 13:
+                if len(self.preview.keypoints) == 4:
+                    return True
+                print("select four keypoints first")
+
+
+def get_projection_map_interactive(camera_model, image, preview_scale=2):
+    names = [name for name in settings.camera_names if name != camera_model.camera_name]
+    others = []
+    for name in names:
+        model = FisheyeCameraModel(os.path.join(os.getcwd(), "yaml", name + ".yaml"), name)
+        other_image = cv2.imread(os.path.join(os.getcwd(), "images", name + ".png"))
+        others.append(PreviewProjector(model, other_image, preview_scale))
+
+    birdview = None
+    if os.path.isfile("weights.npz"):
+        birdview = BirdView()
+        birdview.load_weights_and_masks("weights.npz")
+    elif os.path.isfile("weights.png") and os.path.isfile("masks.png"):
+        birdview = BirdView()
+        birdview.load_weights_and_masks("weights.png", "masks.png")
+
+    preview = PreviewProjector(camera_model, image, preview_scale)
+    gui = InteractiveProjection(preview, others, birdview)
+    while gui.loop():
+        # full resolution render only on confirm
+        camera_model = preview.apply()
+        proj_image = camera_model.project(camera_model.undistort(image))
+        ret = display_image("Bird's View", proj_image)
+        cv2.destroyWindow("Bird's View")
+        if ret > 0:
+            return True
+        gui.dirty = True
+
+    cv2.destroyAllWindows()
+    return False
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-camera", required=True,
@@ -41,6 +206,10 @@ def main():
                         help="scale the undistorted image")
     parser.add_argument("-shift", nargs="+", default=None,
                         help="shift the undistorted image")
+    parser.add_argument("--interactive", action="store_true",
+                        help="edit the scale, shift and keypoints with a live preview")
+    parser.add_argument("-preview_scale", "--preview_scale", type=int, default=2,
+                        help="the preview is rendered at 1 / preview_scale resolution")
     args = parser.parse_args()
 
     if args.scale is not None:
@@ -58,8 +227,13 @@ def main():
     image_file = os.path.join(os.getcwd(), "images", camera_name + ".png")
     image = cv2.imread(image_file)
     camera = FisheyeCameraModel(camera_file, camera_name)
-    camera.set_scale_and_shift(scale, shift)
-    success = get_projection_map(camera, image)
+    if args.interactive:
+        if args.scale is not None or args.shift is not None:
+            camera.set_scale_and_shift(scale, shift)
+        success = get_projection_map_interactive(camera, image, args.preview_scale)
+    else:
+        camera.set_scale_and_shift(scale, shift)
+        success = get_projection_map(camera, image)
     if success:
         print("saving projection matrix to yaml")
         camera.save_data()
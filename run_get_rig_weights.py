@@ -0,0 +1,56 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Compute the weights and masks of all overlaps of a camera rig
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_get_rig_weights.py -rig yaml/rig.yaml -o weights.npz
+
+The rig file describes the cameras and their overlaps (see `Rig.from_file`),
+each camera needs "yaml/<name>.yaml" and "images/<name>.png". The overlaps
+are computed in parallel and cached in the -cache directory, only the
+overlaps of cameras whose projection changed are computed again.
+"""
+import argparse
+import os
+import cv2
+from surround_view import BirdView, display_image
+from surround_view.rig import Rig, save_weights_and_masks
+from surround_view.weight_cache import WeightCache
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-rig", "--rig", default=None,
+                        help="rig description file, the four camera layout if not given")
+    parser.add_argument("-o", "--output", default="weights.npz",
+                        help="output file of the weights and masks")
+    parser.add_argument("-cache", "--cache", default=os.path.join(os.getcwd(), ".weights_cache"),
+                        help="directory the weights of every overlap are cached in, empty to disable")
+    args = parser.parse_args()
+
+    rig = Rig.from_file(args.rig) if args.rig is not None else Rig.default()
+    camera_models = rig.make_camera_models(os.path.join(os.getcwd(), "yaml"))
+
+    projected = []
+    for camera in camera_models:
+        img = cv2.imread(os.path.join(os.getcwd(), "images", camera.camera_name + ".png"))
+        img = camera.undistort(img)
+        img = camera.project(img)
+        img = camera.flip(img)
+        projected.append(img)
+
+    birdview = BirdView(rig=rig)
+    cache = WeightCache(args.cache) if args.cache else None
+    weights, masks = birdview.stitcher.compute_weights_and_masks(projected, camera_models, cache)
+    if cache is not None:
+        print("{} overlaps computed, {} from cache".format(cache.misses, cache.hits))
+    birdview.update_frames(projected)
+    ret = display_image("BirdView Result", birdview.render_rig())
+    if ret > 0:
+        save_weights_and_masks(args.output, weights, masks)
+        print("saved weights and masks of {} overlaps to {}".format(len(weights), args.output))
+
+
+if __name__ == "__main__":
+    main()
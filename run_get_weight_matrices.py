@@ -1,12 +1,42 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Compute the weights and masks of the four corners
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_get_weight_matrices.py -o weights.npz
+
+The corners are computed in parallel and cached in the -cache directory
+under the projection parameters of their two cameras, so after
+recalibrating one camera only its two corners are computed again. The
+result is written as float32 weights and uint8 masks to a .npz file, which
+`BirdView.load_weights_and_masks` reads; --png also writes the older
+weights.png and masks.png.
+"""
+import argparse
 import os
+import time
 import numpy as np
 import cv2
 from PIL import Image
 from surround_view import FisheyeCameraModel, display_image, BirdView
+from surround_view.rig import save_weights_and_masks
+from surround_view.weight_cache import WeightCache
 import surround_view.param_settings as settings
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="weights.npz",
+                        help="output file of the weights and masks")
+    parser.add_argument("--png", action="store_true",
+                        help="also write weights.png and masks.png")
+    parser.add_argument("-cache", "--cache", default=os.path.join(os.getcwd(), ".weights_cache"),
+                        help="directory the weights of every corner are cached in, empty to disable")
+    parser.add_argument("-workers", "--workers", type=int, default=None,
+                        help="number of worker processes, defaults to one per corner to compute")
+    args = parser.parse_args()
+
     names = settings.camera_names
     images = [os.path.join(os.getcwd(), "images", name + ".png") for name in names]
     yamls = [os.path.join(os.getcwd(), "yaml", name + ".yaml") for name in names]
@@ -21,15 +51,28 @@ def main():
         projected.append(img)
 
     birdview = BirdView()
-    Gmat, Mmat = birdview.get_weights_and_masks(projected)
+    cache = WeightCache(args.cache) if args.cache else None
+    start = time.perf_counter()
+    Gmat, Mmat = birdview.get_weights_and_masks(projected, camera_models, cache, args.workers)
+    elapsed = time.perf_counter() - start
+    if cache is not None:
+        print("{} corners computed, {} from cache, {:.1f} s".format(cache.misses, cache.hits,
+                                                                  elapsed))
+    else:
+        print("4 corners computed, {:.1f} s".format(elapsed))
+
     birdview.update_frames(projected)
     birdview.make_luminance_balance().stitch_all_parts()
     birdview.make_white_balance()
     birdview.copy_car_image()
     ret = display_image("BirdView Result", birdview.image)
     if ret > 0:
-        Image.fromarray((Gmat * 255).astype(np.uint8)).save("weights.png")
-        Image.fromarray(Mmat.astype(np.uint8)).save("masks.png")
+        save_weights_and_masks(args.output, [G[:, :, 0] for G in birdview.weights],
+                               birdview.masks)
+        print("saved weights and masks to {}".format(args.output))
+        if args.png:
+            Image.fromarray((Gmat * 255).astype(np.uint8)).save("weights.png")
+            Image.fromarray(Mmat.astype(np.uint8)).save("masks.png")
 
 
 if __name__ == "__main__":
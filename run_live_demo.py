@@ -3,53 +3,236 @@ import cv2
 from surround_view import CaptureThread, CameraProcessingThread
 from surround_view import FisheyeCameraModel, BirdView
 from surround_view import MultiBufferManager, ProjectedImageBuffer
+from surround_view import BirdViewPublisher
+from surround_view import EncoderThread, VideoFileSink, MJPEGStreamSink
+from surround_view import CalibrationReloader, Rig, QualityGovernor, SchedulingConfig
+from surround_view import MotionGate, SeamMonitor, Profiler
+from surround_view import MemoryBudget, memory_report, CameraCache, probe_cameras
+from surround_view.memory import format_report
 import surround_view.param_settings as settings
 
 
 yamls_dir = os.path.join(os.getcwd(), "yaml")
 camera_ids = [4, 3, 5, 6]
 flip_methods = [0, 2, 0, 2]
-names = settings.camera_names
-cameras_files = [os.path.join(yamls_dir, name + ".yaml") for name in names]
-camera_models = [FisheyeCameraModel(camera_file, name) for camera_file, name in zip(cameras_files, names)]
+# open `camera_ids` as USB cameras (/dev/videoN) in the mode found by probing
+# them, all at once and cached by USB port in this file (see `test_cameras.py`),
+# instead of csi cameras through gstreamer. BGR only
+usb_cameras = False
+camera_cache_file = os.path.join(os.getcwd(), ".camera_cache.json")
+# "BGR", or "NV12" to process the camera frames in yuv space and convert
+# only the stitched image to BGR
+pixel_format = "BGR"
+# name of the shared memory ring the birdview is published to, other
+# processes can read the frames with `BirdViewReader(shm_name)`
+shm_name = None
+# record the birdview to this file and/or serve it as a MJPEG stream on this
+# (host, port) address, encoding runs in its own thread and drops frames
+# instead of slowing down the stitcher
+record_file = None
+stream_address = None
+# reload the yaml files, weights and masks when they are modified, without
+# restarting the threads
+hot_reload = True
+# undistort, project and flip each camera frame with one remap that only
+# computes the pixels used by the stitcher
+crop_remap = True
+# how long (ms) the threads wait for a camera before continuing without it,
+# and what the birdview shows for it meanwhile: "hold" its last frame or "mask" it
+sync_timeout = 500
+stale_policy = "hold"
+# frame rate the stitcher should hold, when it falls behind it lowers its
+# quality step by step (see `QualityGovernor`), None to always run at full quality
+target_fps = None
+# skip the processing of camera frames that did not change and keep their
+# regions of the birdview, everything is refreshed at least every
+# `refresh_interval` frames. Saves most of the cpu of a parked vehicle
+motion_gating = False
+refresh_interval = 30
+# extra views rendered from the raw frames with the gains of the birdview,
+# e.g. `surround_view.Viewport("bumper", (600, 550), rect=(300, 0, 900, 550))`
+# for a zoom on the front of the canvas or
+# `surround_view.Viewport("rear", (640, 360), camera="back")` for the
+# undistorted rear camera, or a perspective view of the bowl around the car,
+# `surround_view.BowlViewpoint("rear3d", (800, 600), (600, 250, 400), (600, 1200, 0))`,
+# switch between them with `birdview.select_viewports(names)`. Four camera
+# BGR layout only
+viewports = []
+# measure the misalignment of one corner of the birdview every this many
+# frames and warn when a camera has moved since the calibration, 0 to disable
+seam_check_interval = 15
+# press "p" to start profiling the threads and again to stop and write the
+# stages to `<profile_prefix>.json` (a Chrome trace) and the stacks sampled
+# every `profile_sample_interval` seconds (0 for the stages only) to
+# `<profile_prefix>.folded` (collapsed stacks for flamegraph.pl), None to disable
+profile_prefix = None
+profile_sample_interval = 0.01
+# resident memory the pipeline should fit in, in MB: the buffers are made
+# shallower, the weights compact and the allocator returns freed arrays to
+# the system until the estimate fits (see `MemoryBudget`), None for the
+# defaults. Press "m" to print the memory held by each component
+memory_budget_mb = None
+# cores and priorities of the threads, e.g. `SchedulingConfig.spread(camera_ids)`,
+# run `run_schedule_benchmark.py` to find the best layout for a board
+scheduling = None
+# a rig description like yaml/rig.yaml to stitch any number of cameras,
+# `camera_ids` and `flip_methods` must list the cameras of the rig in order
+rig_file = None
+if rig_file is not None:
+    rig = Rig.from_file(rig_file)
+    camera_models = rig.make_camera_models(yamls_dir)
+    weights_files = ("./weights.npz", None)
+else:
+    rig = None
+    names = settings.camera_names
+    cameras_files = [os.path.join(yamls_dir, name + ".yaml") for name in names]
+    camera_models = [FisheyeCameraModel(camera_file, name) for camera_file, name in zip(cameras_files, names)]
+    # written by run_get_weight_matrices.py, the pngs are the older format
+    if os.path.isfile("./weights.npz"):
+        weights_files = ("./weights.npz", None)
+    else:
+        weights_files = ("./weights.png", "./masks.png")
+
+
+def toggle_profiling(threads, profiler):
+    """
+    Attach a new profiler to the threads, or detach `profiler` and write its
+    files. Returns the active profiler.
+    """
+    if profiler is None:
+        profiler = Profiler()
+        for td in threads:
+            name = "{} {}".format(type(td).__name__, getattr(td, "device_id", "")).strip()
+            td.set_profiler(profiler, name)
+        if profile_sample_interval > 0:
+            profiler.start_sampling(profile_sample_interval)
+        print("profiling started")
+        return profiler
+
+    for td in threads:
+        td.set_profiler(None)
+    profiler.stop_sampling()
+    profiler.write_chrome_trace(profile_prefix + ".json")
+    profiler.write_collapsed(profile_prefix + ".folded")
+    print("profile written to {}.json and {}.folded".format(profile_prefix, profile_prefix))
+    return None
 
 
 def main():
-    capture_tds = [CaptureThread(camera_id, flip_method)
-                   for camera_id, flip_method in zip(camera_ids, flip_methods)]
-    capture_buffer_manager = MultiBufferManager()
+    schedules = scheduling if scheduling is not None else SchedulingConfig()
+    schedules.apply_opencv_threads()
+    plan = MemoryBudget(memory_budget_mb).plan(camera_models, pixel_format=pixel_format)
+    plan.apply_allocator_settings()
+    if memory_budget_mb is not None:
+        print(plan)
+
+    sources = [None] * len(camera_ids)
+    if usb_cameras:
+        infos = probe_cameras(camera_ids, cache=CameraCache(camera_cache_file))
+        for info in infos:
+            print(info if info.ok else "camera {}: {}".format(info.index, info.error))
+        sources = [info.make_source() if info.ok else None for info in infos]
+    capture_tds = [CaptureThread(camera_id, flip_method, pixel_format=pixel_format,
+                                 use_gst=not usb_cameras, source=source)
+                   for camera_id, flip_method, source in zip(camera_ids, flip_methods, sources)]
+    schedules.assign(capture_tds, "capture")
+    capture_buffer_manager = MultiBufferManager(sync_timeout=sync_timeout)
     for td in capture_tds:
-        capture_buffer_manager.bind_thread(td, buffer_size=8)
+        capture_buffer_manager.bind_thread(td, buffer_size=plan.capture_buffer_size)
         if (td.connect_camera()):
             td.start()
 
-    proc_buffer_manager = ProjectedImageBuffer()
+    proc_buffer_manager = ProjectedImageBuffer(buffer_size=plan.proc_buffer_size,
+                                               pixel_format=pixel_format, sync_timeout=sync_timeout)
     process_tds = [CameraProcessingThread(capture_buffer_manager,
                                           camera_id,
-                                          camera_model)
+                                          camera_model,
+                                          motion_gate=MotionGate(refresh_interval=refresh_interval)
+                                          if motion_gating else None)
                    for camera_id, camera_model in zip(camera_ids, camera_models)]
+    schedules.assign(process_tds, "process")
     for td in process_tds:
         proc_buffer_manager.bind_thread(td)
         td.start()
 
-    birdview = BirdView(proc_buffer_manager)
-    birdview.load_weights_and_masks("./weights.png", "./masks.png")
+    governor = QualityGovernor(target_fps) if target_fps is not None else None
+    birdview = BirdView(proc_buffer_manager, buffer_size=plan.birdview_buffer_size,
+                        compact_weights=plan.compact_weights, pixel_format=pixel_format, rig=rig,
+                        governor=governor, stale_policy=stale_policy,
+                        reuse_unchanged=motion_gating, refresh_interval=refresh_interval,
+                        seam_monitor=SeamMonitor(seam_check_interval)
+                        if seam_check_interval > 0 and rig is None else None)
+    schedules.assign([birdview], "stitch")
+    birdview.load_weights_and_masks(*weights_files)
+    publisher = None
+    if shm_name is not None:
+        publisher = BirdViewPublisher(shm_name, birdview.output_shape())
+        birdview.publisher = publisher
+    if crop_remap and rig is None:
+        report = birdview.crop_camera_models(camera_models)
+        for name, (before, after) in report.items():
+            print("{}: {} pixels per frame instead of {} ({:.0%} saved)".format(
+                name, after, before, 1 - after / before))
+    if len(viewports) > 0:
+        birdview.set_viewports(viewports, camera_models)
+    sinks = []
+    if record_file is not None:
+        sinks.append(VideoFileSink(record_file))
+    if stream_address is not None:
+        sinks.append(MJPEGStreamSink(stream_address))
+    encoder = None
+    if len(sinks) > 0:
+        encoder = EncoderThread(sinks, pixel_format="NV12" if birdview.yuv_output else "BGR")
+        birdview.add_output(encoder)
+        schedules.assign([encoder], "encode")
+        encoder.start()
     birdview.start()
+
+    profiled_tds = capture_tds + process_tds + [birdview] + ([encoder] if encoder is not None else [])
+    profiler = None
+
+    reloader = None
+    if hot_reload:
+        reloader = CalibrationReloader(process_tds, birdview, *weights_files)
+        reloader.start()
     while True:
         img = cv2.resize(birdview.get(), (300, 400))
         cv2.imshow("birdview", img)
+        for name, image in birdview.get_viewports().items():
+            cv2.imshow(name, image)
         key = cv2.waitKey(1) & 0xFF
         if key == ord("q"):
             break
+        if key == ord("p") and profile_prefix is not None:
+            profiler = toggle_profiling(profiled_tds, profiler)
+        if key == ord("m"):
+            print(format_report(memory_report(birdview, camera_models, capture_buffer_manager,
+                                              proc_buffer_manager, capture_tds)))
 
         for td in capture_tds:
-            print("camera {} fps: {}\n".format(td.device_id, td.stat_data.average_fps), end="\r")
+            print("camera {} fps: {}, {}\n".format(td.device_id, td.stat_data.average_fps,
+                                                  td.camera_health().state), end="\r")
 
         for td in process_tds:
-            print("process {} fps: {}\n".format(td.device_id, td.stat_data.average_fps), end="\r")
+            print("process {} fps: {}, reused: {}\n".format(td.device_id, td.stat_data.average_fps,
+                                                         td.stat_data.frames_reused_count), end="\r")
 
         print("birdview fps: {}".format(birdview.stat_data.average_fps))
+        if birdview.stat_data.seam_drift:
+            print("seams drifted, check the calibration: {}".format(birdview.stat_data.seam_scores))
+        if governor is not None:
+            print("quality: {}, {} switches".format(governor.level.name, len(governor.history)))
+        if encoder is not None:
+            print("encoder fps: {}, dropped: {}".format(encoder.stat_data.average_fps,
+                                                        encoder.stat_data.frames_dropped_count))
+
+
+    if profiler is not None:
+        toggle_profiling(profiled_tds, profiler)
 
+    if reloader is not None:
+        reloader.stop()
+        reloader.wait()
 
     for td in process_tds:
         td.stop()
@@ -58,6 +241,15 @@ def main():
         td.stop()
         td.disconnect_camera()
 
+    if encoder is not None:
+        encoder.stop()
+        encoder.wait(1000)
+
+    if publisher is not None:
+        birdview.stop()
+        birdview.wait(1000)
+        publisher.close()
+
 
 if __name__ == "__main__":
     main()
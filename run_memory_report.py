@@ -0,0 +1,122 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Memory held by the pipeline, with and without a budget
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_memory_report.py -budget 300 -fps 30 -duration 20
+
+Runs the full pipeline on virtual cameras replaying the sample images, once
+with the default settings and once with the settings `MemoryBudget` picks
+for the budget (in MB), each in its own process. For each run it prints the
+plan, the bytes held by every component at the end of the run, the peak
+resident memory, and the frame rate and 99th percentile of the time
+between two stitched frames, so the cost of the budget can be judged.
+"""
+import argparse
+import os
+import time
+import multiprocessing
+import numpy as np
+import cv2
+from surround_view import CaptureThread, CameraProcessingThread, SyntheticSource
+from surround_view import FisheyeCameraModel, MultiBufferManager, ProjectedImageBuffer, BirdView
+from surround_view.memory import MemoryBudget, memory_report, format_report, resident_memory
+import surround_view.param_settings as settings
+
+
+def run_pipeline(limit_mb, fps, duration, warmup):
+    camera_models = [FisheyeCameraModel(os.path.join(os.getcwd(), "yaml", name + ".yaml"), name)
+                     for name in settings.camera_names]
+    plan = MemoryBudget(limit_mb).plan(camera_models)
+    plan.apply_allocator_settings()
+
+    capture_buffer_manager = MultiBufferManager()
+    capture_tds = []
+    for device_id, model in enumerate(camera_models):
+        background = cv2.imread(os.path.join(os.getcwd(), "images", model.camera_name + ".png"))
+        source = SyntheticSource(resolution=tuple(int(x) for x in model.resolution),
+                                 framerate=fps, background=background, seed=device_id)
+        td = CaptureThread(device_id, source=source, reuse_frames=True)
+        capture_buffer_manager.bind_thread(td, buffer_size=plan.capture_buffer_size)
+        td.connect_camera()
+        capture_tds.append(td)
+
+    proc_buffer_manager = ProjectedImageBuffer(buffer_size=plan.proc_buffer_size)
+    process_tds = []
+    for device_id, model in enumerate(camera_models):
+        td = CameraProcessingThread(capture_buffer_manager, device_id, model)
+        proc_buffer_manager.bind_thread(td)
+        process_tds.append(td)
+
+    birdview = BirdView(proc_buffer_manager, buffer_size=plan.birdview_buffer_size,
+                        compact_weights=plan.compact_weights)
+    birdview.load_weights_and_masks("./weights.png", "./masks.png")
+    birdview.crop_camera_models(camera_models)
+    for td in capture_tds + process_tds + [birdview]:
+        td.start()
+
+    start = time.perf_counter()
+    stamps = []
+    peak = 0
+    while time.perf_counter() - start < warmup + duration:
+        birdview.get()
+        now = time.perf_counter()
+        if now - start >= warmup:
+            stamps.append(now)
+        peak = max(peak, resident_memory())
+    report = memory_report(birdview, camera_models, capture_buffer_manager,
+                           proc_buffer_manager, capture_tds)
+
+    birdview.stop()
+    birdview.wait(2000)
+    for td in process_tds:
+        td.stop()
+    for td in capture_tds:
+        td.stop()
+    proc_buffer_manager.wake_all()
+    capture_buffer_manager.wake_all()
+    for td in process_tds + capture_tds:
+        td.wait(2000)
+    for td in capture_tds:
+        td.disconnect_camera()
+
+    frame_times = np.diff(stamps) * 1000
+    return {"plan": str(plan),
+            "report": report,
+            "peak": peak,
+            "fps": len(frame_times) / duration,
+            "p99": np.percentile(frame_times, 99) if len(frame_times) > 0 else float("nan")}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-budget", "--budget", type=float, required=True,
+                        help="memory budget of the pipeline in MB")
+    parser.add_argument("-fps", "--fps", type=float, default=30,
+                        help="frame rate of the virtual cameras, 0 for unlimited")
+    parser.add_argument("-duration", "--duration", type=float, default=20,
+                        help="seconds measured per run")
+    parser.add_argument("-warmup", "--warmup", type=float, default=3,
+                        help="seconds to run before measuring")
+    args = parser.parse_args()
+
+    # a fresh process per run, so the resident memory of one run does not
+    # include what the previous one left behind
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name, limit in (("default", None), ("budget {:.0f} MB".format(args.budget), args.budget)):
+        print("running: {}".format(name))
+        with context.Pool(1) as pool:
+            result = pool.apply(run_pipeline, (limit, args.fps, args.duration, args.warmup))
+        print(result["plan"])
+        print(format_report(result["report"]))
+        results.append((name, result))
+
+    print("{:<20}{:>12}{:>8}{:>10}".format("run", "peak MB", "fps", "p99 ms"))
+    for name, r in results:
+        print("{:<20}{:>12.1f}{:>8.1f}{:>10.1f}".format(name, r["peak"] / 2**20, r["fps"], r["p99"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Process several surround view rigs on a shared worker pool
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_multi_rig.py rigs/yard1 rigs/yard2 -workers 4
+    python run_multi_rig.py -synthetic 8 -duration 10
+
+A rig directory contains one video per camera (`<name>.mp4` or `<name>.avi`),
+and optionally `rig.yaml`, `weights.npz` and `yaml/<name>.yaml`. Missing
+files are taken from the four camera layout and the `yaml` folder of the
+current directory. With `-synthetic` the sample images are replayed as
+virtual cameras instead.
+"""
+import argparse
+import os
+import time
+import cv2
+from surround_view import Rig, RigInstance, RigPool, SyntheticSource, VideoFileSource
+from surround_view import EncoderThread, VideoFileSink
+
+
+def find_file(*candidates):
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def load_rig_dir(rig_dir, framerate, record):
+    rig_file = find_file(os.path.join(rig_dir, "rig.yaml"))
+    rig = Rig.from_file(rig_file) if rig_file is not None else Rig.default()
+
+    weights_file = find_file(os.path.join(rig_dir, "weights.npz"))
+    masks_file = None
+    if weights_file is None:
+        weights_file, masks_file = "weights.png", "masks.png"
+
+    yamls_dir = os.path.join(rig_dir, "yaml")
+    if not os.path.isdir(yamls_dir):
+        yamls_dir = os.path.join(os.getcwd(), "yaml")
+    camera_models = rig.make_camera_models(yamls_dir)
+
+    sources = []
+    for name in rig.camera_names:
+        video = find_file(os.path.join(rig_dir, name + ".mp4"),
+                          os.path.join(rig_dir, name + ".avi"))
+        if video is None:
+            raise IOError("No video for camera {} in {}".format(name, rig_dir))
+        sources.append(VideoFileSource(video, loop=False, realtime=False))
+
+    instance = RigInstance(os.path.basename(os.path.normpath(rig_dir)), rig, camera_models,
+                           sources, weights_file, masks_file, framerate=framerate)
+    encoder = None
+    if record:
+        encoder = EncoderThread([VideoFileSink(os.path.join(rig_dir, "birdview.avi"))],
+                                name=instance.name)
+        instance.add_output(encoder)
+    return instance, encoder
+
+
+def make_synthetic_rig(index, framerate):
+    rig = Rig.default()
+    camera_models = rig.make_camera_models(os.path.join(os.getcwd(), "yaml"))
+    sources = []
+    for k, (name, model) in enumerate(zip(rig.camera_names, camera_models)):
+        background = cv2.imread(os.path.join(os.getcwd(), "images", name + ".png"))
+        sources.append(SyntheticSource(resolution=tuple(int(x) for x in model.resolution),
+                                       framerate=0,
+                                       background=background,
+                                       seed=index * len(camera_models) + k))
+    return RigInstance("synthetic{}".format(index), rig, camera_models, sources,
+                       "weights.png", "masks.png", framerate=framerate)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rigs", nargs="*", help="rig directories")
+    parser.add_argument("-synthetic", "--synthetic", type=int, default=0,
+                        help="number of virtual rigs replaying the sample images")
+    parser.add_argument("-workers", "--workers", type=int, default=None,
+                        help="number of worker threads, defaults to the number of cores")
+    parser.add_argument("-fps", "--fps", type=float, default=0,
+                        help="frame rate of each rig, 0 for as fast as possible")
+    parser.add_argument("-duration", "--duration", type=float, default=0,
+                        help="stop after this many seconds, 0 to run until all rigs end")
+    parser.add_argument("--record", action="store_true",
+                        help="write the birdview of each rig directory to birdview.avi")
+    args = parser.parse_args()
+
+    if len(args.rigs) == 0 and args.synthetic == 0:
+        args.synthetic = 4
+
+    pool = RigPool(max_workers=args.workers)
+    encoders = []
+    for rig_dir in args.rigs:
+        instance, encoder = load_rig_dir(rig_dir, args.fps, args.record)
+        if encoder is not None:
+            encoder.start()
+            encoders.append(encoder)
+        pool.add_rig(instance)
+    for k in range(args.synthetic):
+        pool.add_rig(make_synthetic_rig(k, args.fps))
+
+    print("{} rigs on {} workers".format(len(pool.instances), pool.max_workers))
+    start = time.perf_counter()
+    pool.start()
+    while not pool.is_finished():
+        time.sleep(1)
+        if args.duration > 0 and time.perf_counter() - start >= args.duration:
+            break
+    elapsed = time.perf_counter() - start
+
+    pool.stop()
+    pool.wait()
+    for encoder in encoders:
+        encoder.stop()
+        encoder.wait()
+
+    total = 0
+    for instance in pool.instances:
+        total += instance.stat_data.frames_processed_count
+        print("{}: {}, {} frames, {} fps, last frame {:.1f} ms{}".format(
+            instance.name, instance.stat_data.state, instance.stat_data.frames_processed_count,
+            instance.stat_data.average_fps, instance.processing_time,
+            ", {}".format(instance.error) if instance.error is not None else ""))
+        instance.release()
+    print("total: {:.2f} frame sets per second".format(total / elapsed))
+
+
+if __name__ == "__main__":
+    main()
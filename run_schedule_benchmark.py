@@ -0,0 +1,127 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Compare thread placements of the pipeline on this machine
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_schedule_benchmark.py -fps 30 -duration 20
+
+Runs the full pipeline (capture, processing and stitching threads) on
+virtual cameras replaying the sample images, once per scheduling layout,
+and reports the time between two stitched frames: the median, the 99th
+percentile and the worst case. The layout with the lowest p99 is the one
+with the least jitter on this SoC.
+"""
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+from surround_view import CaptureThread, CameraProcessingThread, SyntheticSource
+from surround_view import FisheyeCameraModel, MultiBufferManager, ProjectedImageBuffer, BirdView
+from surround_view import SchedulingConfig
+import surround_view.param_settings as settings
+
+
+def make_layouts(device_ids, cores):
+    default_threads = cv2.getNumThreads()
+    return [
+        SchedulingConfig({}, default_threads, name="unpinned"),
+        SchedulingConfig({}, 1, name="unpinned, 1 opencv thread"),
+        SchedulingConfig.spread(device_ids, cores, default_threads, name="spread"),
+        SchedulingConfig.spread(device_ids, cores, 1, name="spread, 1 opencv thread"),
+    ]
+
+
+def run_pipeline(config, device_ids, fps, duration, warmup):
+    config.apply_opencv_threads()
+    capture_buffer_manager = MultiBufferManager()
+    capture_tds = []
+    camera_models = []
+    for device_id, name in zip(device_ids, settings.camera_names):
+        model = FisheyeCameraModel(os.path.join(os.getcwd(), "yaml", name + ".yaml"), name)
+        camera_models.append(model)
+        background = cv2.imread(os.path.join(os.getcwd(), "images", name + ".png"))
+        source = SyntheticSource(resolution=tuple(int(x) for x in model.resolution),
+                                 framerate=fps,
+                                 background=background,
+                                 seed=device_id)
+        td = CaptureThread(device_id, source=source, reuse_frames=True)
+        capture_buffer_manager.bind_thread(td, buffer_size=8)
+        td.connect_camera()
+        capture_tds.append(td)
+
+    proc_buffer_manager = ProjectedImageBuffer()
+    process_tds = []
+    for device_id, model in zip(device_ids, camera_models):
+        td = CameraProcessingThread(capture_buffer_manager, device_id, model)
+        proc_buffer_manager.bind_thread(td)
+        process_tds.append(td)
+
+    birdview = BirdView(proc_buffer_manager)
+    birdview.load_weights_and_masks("./weights.png", "./masks.png")
+    birdview.crop_camera_models(camera_models)
+
+    config.assign(capture_tds, "capture")
+    config.assign(process_tds, "process")
+    config.assign([birdview], "stitch")
+    for td in capture_tds + process_tds + [birdview]:
+        td.start()
+
+    start = time.perf_counter()
+    stamps = []
+    while time.perf_counter() - start < warmup + duration:
+        birdview.get()
+        now = time.perf_counter()
+        if now - start >= warmup:
+            stamps.append(now)
+
+    # the birdview thread exits after the next frame set, stop it while
+    # the other threads still produce frames
+    birdview.stop()
+    birdview.wait(2000)
+    for td in process_tds:
+        td.stop()
+    for td in capture_tds:
+        td.stop()
+    proc_buffer_manager.wake_all()
+    capture_buffer_manager.wake_all()
+    for td in process_tds + capture_tds:
+        td.wait(2000)
+    for td in capture_tds:
+        td.disconnect_camera()
+    return np.diff(stamps) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-fps", "--fps", type=float, default=30,
+                        help="frame rate of the virtual cameras, 0 for unlimited")
+    parser.add_argument("-duration", "--duration", type=float, default=20,
+                        help="seconds measured per layout")
+    parser.add_argument("-warmup", "--warmup", type=float, default=3,
+                        help="seconds to run before measuring")
+    parser.add_argument("-cores", "--cores", type=int, nargs="+", default=None,
+                        help="cores available to the pipeline, all by default")
+    args = parser.parse_args()
+
+    device_ids = list(range(len(settings.camera_names)))
+    results = []
+    for config in make_layouts(device_ids, args.cores):
+        print("running layout: {}".format(config.name))
+        frame_times = run_pipeline(config, device_ids, args.fps, args.duration, args.warmup)
+        if len(frame_times) == 0:
+            print("  no frames")
+            continue
+        results.append((config.name, len(frame_times) / args.duration,
+                        np.percentile(frame_times, 50),
+                        np.percentile(frame_times, 99),
+                        frame_times.max()))
+
+    print("{:<28}{:>8}{:>10}{:>10}{:>10}".format("layout", "fps", "p50 ms", "p99 ms", "max ms"))
+    for name, fps, p50, p99, worst in sorted(results, key=lambda r: r[3]):
+        print("{:<28}{:>8.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(name, fps, p50, p99, worst))
+
+
+if __name__ == "__main__":
+    main()
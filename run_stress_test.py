@@ -0,0 +1,111 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Stress test the capture/processing pipeline with virtual cameras
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_stress_test.py -n 8 -fps 60 -duration 10
+
+Each virtual camera replays one of the images in the `images` folder
+through a `SyntheticSource`, so no camera hardware is required.
+"""
+import argparse
+import os
+import time
+import cv2
+from surround_view import CaptureThread, CameraProcessingThread, SyntheticSource
+from surround_view import FisheyeCameraModel, MultiBufferManager, ProjectedImageBuffer
+import surround_view.param_settings as settings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_cameras", type=int, default=8,
+                        help="number of virtual cameras")
+    parser.add_argument("-fps", "--fps", type=float, default=60,
+                        help="frame rate of each virtual camera, 0 for unlimited")
+    parser.add_argument("-duration", "--duration", type=float, default=10,
+                        help="how many seconds to run the test")
+    parser.add_argument("-pixel_format", "--pixel_format", default="BGR",
+                        choices=["BGR", "NV12", "I420"],
+                        help="pixel format of the virtual cameras")
+    parser.add_argument("--capture_only", action="store_true",
+                        help="only run the capture threads")
+    args = parser.parse_args()
+
+    names = settings.camera_names
+    yamls_dir = os.path.join(os.getcwd(), "yaml")
+    images_dir = os.path.join(os.getcwd(), "images")
+    camera_ids = list(range(args.num_cameras))
+    camera_names = [names[i % len(names)] for i in camera_ids]
+
+    capture_buffer_manager = MultiBufferManager()
+    capture_tds = []
+    camera_models = []
+    for camera_id, name in zip(camera_ids, camera_names):
+        model = FisheyeCameraModel(os.path.join(yamls_dir, name + ".yaml"), name)
+        camera_models.append(model)
+        background = cv2.imread(os.path.join(images_dir, name + ".png"))
+        source = SyntheticSource(resolution=tuple(int(x) for x in model.resolution),
+                                 framerate=args.fps,
+                                 background=background,
+                                 seed=camera_id,
+                                 pixel_format=args.pixel_format)
+        td = CaptureThread(camera_id, source=source, reuse_frames=True,
+                           pixel_format=args.pixel_format)
+        capture_buffer_manager.bind_thread(td, buffer_size=8)
+        if not td.connect_camera():
+            print("cannot open virtual camera {}".format(camera_id))
+            return
+        capture_tds.append(td)
+
+    process_tds = []
+    proc_buffer_manager = ProjectedImageBuffer(pixel_format=args.pixel_format)
+    if not args.capture_only:
+        for camera_id, model in zip(camera_ids, camera_models):
+            proc_td = CameraProcessingThread(capture_buffer_manager, camera_id, model)
+            proc_buffer_manager.bind_thread(proc_td)
+            process_tds.append(proc_td)
+
+    for td in capture_tds + process_tds:
+        td.start()
+
+    start = time.perf_counter()
+    synced = 0
+    while time.perf_counter() - start < args.duration:
+        if args.capture_only:
+            for td in capture_tds:
+                capture_buffer_manager.get_device(td.device_id).get()
+        else:
+            proc_buffer_manager.get()
+        synced += 1
+    elapsed = time.perf_counter() - start
+
+    for td in capture_tds:
+        print("camera {} fps: {}".format(td.device_id, td.stat_data.average_fps))
+
+    for td in process_tds:
+        print("process {} fps: {}, frames: {}".format(td.device_id,
+                                                      td.stat_data.average_fps,
+                                                      td.stat_data.frames_processed_count))
+
+    print("{} cameras, synchronized frame sets per second: {:.2f}".format(
+        args.num_cameras, synced / elapsed))
+
+    for td in process_tds:
+        td.stop()
+    proc_buffer_manager.wake_all()
+
+    for td in capture_tds:
+        td.stop()
+    capture_buffer_manager.wake_all()
+
+    for td in process_tds + capture_tds:
+        td.wait(1000)
+
+    for td in capture_tds:
+        td.disconnect_camera()
+
+
+if __name__ == "__main__":
+    main()
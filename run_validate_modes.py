@@ -0,0 +1,135 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Check the fast rendering modes against the reference output
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Usage:
+    python run_validate_modes.py
+    python run_validate_modes.py -synthetic 60
+    python run_validate_modes.py -sequence recordings/yard1 -frames 100
+
+Renders the sample images, virtual cameras replaying them with a moving bar
+(camera k only delivers a new frame every k + 1 frames, so the modes that
+keep state across frames are exercised), or the frames of a recorded
+sequence (one `<name>.mp4`/`<name>.avi` video or `<name>/` image directory
+per camera) with the reference pipeline and with every fast mode. For each mode it
+prints the time per frame and the worst PSNR, SSIM and largest absolute
+error of every region of the canvas over all frames, and exits with status
+1 if a mode does not meet the tolerances it declares.
+"""
+import argparse
+import os
+import sys
+import cv2
+from surround_view import SyntheticSource
+from surround_view.validation import default_modes, validate, canvas_regions
+from surround_view.calibration import IMAGE_EXTENSIONS
+import surround_view.param_settings as settings
+
+
+def sample_frames(images_dir):
+    yield [cv2.imread(os.path.join(images_dir, name + ".png")) for name in settings.camera_names]
+
+
+def synthetic_frames(images_dir, count):
+    sources = []
+    for k, name in enumerate(settings.camera_names):
+        background = cv2.imread(os.path.join(images_dir, name + ".png"))
+        source = SyntheticSource(background.shape[1::-1], framerate=0, background=background,
+                                 seed=k)
+        source.open()
+        sources.append(source)
+    frames = [None] * len(sources)
+    for i in range(count):
+        for k, source in enumerate(sources):
+            if frames[k] is None or i % (k + 1) == 0:
+                frames[k] = source.read()[1]
+        # a repeated frame is a new array with the same content, as from a camera
+        yield [frame.copy() for frame in frames]
+
+
+def open_camera(sequence_dir, name):
+    """
+    A function returning the next frame of a camera, None at the end.
+    """
+    for ext in (".mp4", ".avi"):
+        path = os.path.join(sequence_dir, name + ext)
+        if os.path.isfile(path):
+            cap = cv2.VideoCapture(path)
+            return lambda: cap.read()[1]
+
+    path = os.path.join(sequence_dir, name)
+    if os.path.isdir(path):
+        files = iter(sorted(os.path.join(path, f) for f in os.listdir(path)
+                            if f.lower().endswith(IMAGE_EXTENSIONS)))
+        return lambda: cv2.imread(next(files, ""))
+    raise IOError("No video or image directory for camera {} in {}".format(name, sequence_dir))
+
+
+def sequence_frames(sequence_dir, max_frames):
+    cameras = [open_camera(sequence_dir, name) for name in settings.camera_names]
+    for _ in range(max_frames):
+        frames = [read() for read in cameras]
+        if any(frame is None for frame in frames):
+            return
+        yield frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sequence", "--sequence", default=None,
+                        help="directory of a recorded sequence, the sample images if not given")
+    parser.add_argument("-synthetic", "--synthetic", type=int, default=0,
+                        help="number of frames of virtual cameras to render instead")
+    parser.add_argument("-frames", "--frames", type=int, default=30,
+                        help="maximum number of frames of the sequence")
+    parser.add_argument("-yaml", "--yaml", default=os.path.join(os.getcwd(), "yaml"),
+                        help="directory of the camera yaml files")
+    parser.add_argument("-modes", "--modes", nargs="+", default=None,
+                        help="names of the modes to check, all by default")
+    args = parser.parse_args()
+
+    if os.path.isfile("weights.npz"):
+        weights_files = ("weights.npz", None)
+    else:
+        weights_files = ("weights.png", "masks.png")
+
+    modes = default_modes()
+    if args.modes is not None:
+        modes = [mode for mode in modes if mode.name in args.modes]
+    images_dir = os.path.join(os.getcwd(), "images")
+    if args.synthetic > 0:
+        frame_sets = synthetic_frames(images_dir, args.synthetic)
+    elif args.sequence is None:
+        frame_sets = sample_frames(images_dir)
+    else:
+        frame_sets = sequence_frames(args.sequence, args.frames)
+
+    report = validate(frame_sets, modes, args.yaml, weights_files)
+    regions = list(canvas_regions())
+    print("{:<24}{:>10}  {}".format("mode", "ms/frame", "  ".join(
+        "{:>16}".format(region) for region in regions)))
+    print("{:<24}{:>10}  {}".format("", "", "  ".join(
+        "{:>16}".format("psnr/ssim/max") for _ in regions)))
+    failed = False
+    for r in report:
+        cells = []
+        for region in regions:
+            if region in r["metrics"]:
+                p, s, m = r["metrics"][region]
+                cells.append("{:>16}".format("{:.1f}/{:.3f}/{}".format(p, s, m)))
+            else:
+                cells.append("{:>16}".format("-"))
+        print("{:<24}{:>10.1f}  {}".format(r["mode"].name, r["time"], "  ".join(cells)))
+        for failure in r["failures"]:
+            print("    FAILED: {}".format(failure))
+        failed = failed or len(r["failures"]) > 0
+
+    if failed:
+        print("some modes exceed their tolerances")
+        sys.exit(1)
+    print("all modes within their tolerances")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,23 @@
 from .fisheye_camera import FisheyeCameraModel
 from .imagebuffer import MultiBufferManager
 from .capture_thread import CaptureThread
+from .capture_source import (CaptureSource, GStreamerSource, V4L2Source,
+                             VideoFileSource, ImageSequenceSource, SyntheticSource)
 from .process_thread import CameraProcessingThread
 from .simple_gui import display_image, PointSelector
 from .birdview import BirdView, ProjectedImageBuffer
+from .shm_ring import BirdViewPublisher, BirdViewReader
+from .recorder import EncoderThread, VideoFileSink, MJPEGStreamSink
+from .hot_reload import CalibrationReloader
+from .rig import Rig, RigCamera, RigOverlap, RigStitcher
+from .rig_pool import RigInstance, RigPool
+from .quality import QualityLevel, QualityGovernor, QUALITY_LEVELS
+from .scheduling import StageSchedule, SchedulingConfig
+from .calibration import CornerCollector, detect_corners
+from .motion import MotionGate
+from .viewports import Viewport, ViewportRenderer
+from .bowl import BowlSurface, BowlViewpoint, BowlRenderer
+from .seam_monitor import SeamMonitor
+from .profiler import Profiler
+from .memory import MemoryBudget, MemoryPlan, memory_report
+from .camera_probe import CameraInfo, CameraCache, probe_cameras
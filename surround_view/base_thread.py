@@ -1,6 +1,7 @@
+import time
 from queue import Queue
 import cv2
-from PyQt5.QtCore import (QThread, QTime, QMutex, pyqtSignal, QMutexLocker)
+from PyQt5.QtCore import (QThread, QTime, QMutex, pyqtSignal, QMutexLocker, Qt)
 
 from .structures import ThreadStatisticsData
 
@@ -19,6 +20,9 @@ class BaseThread(QThread):
     def __init__(self, parent=None):
         super(BaseThread, self).__init__(parent)
         self.init_commons()
+        # `started` is emitted in the new thread, the direct connection
+        # makes `apply_schedule` run there before `run`
+        self.started.connect(self.apply_schedule, Qt.DirectConnection)
 
     def init_commons(self):
         self.stopped = False
@@ -29,6 +33,61 @@ class BaseThread(QThread):
         self.processing_mutex = QMutex()
         self.fps_sum = 0
         self.stat_data = ThreadStatisticsData()
+        # consumers of the frames produced by this thread, e.g. `EncoderThread`,
+        # anything with a non-blocking `submit(frame)` method works.
+        self.outputs = []
+        # a `StageSchedule` applied when the thread starts
+        self.schedule = None
+        self.schedule_name = ""
+        # time of each stage of the current frame in ms, see `end_stage`
+        self.stage_times = {}
+        self.stage_clock = 0
+        # a `Profiler` the stages are reported to, see `set_profiler`
+        self.profiler = None
+        self.profile_name = ""
+
+    def set_schedule(self, schedule, name=""):
+        """
+        Set the cores and priority of the thread, takes effect the next
+        time the thread is started.
+        """
+        self.schedule = schedule
+        self.schedule_name = name
+
+    def apply_schedule(self):
+        if self.schedule is not None:
+            self.schedule.apply("{} thread".format(self.schedule_name))
+
+    def set_profiler(self, profiler, name=None):
+        """
+        Report the stages of this thread to `profiler` under `name` (the
+        class name by default), None to stop. Takes effect at the next stage,
+        the thread may be running.
+        """
+        self.profile_name = name if name is not None else type(self).__name__
+        self.profiler = profiler
+
+    def start_stages(self):
+        self.stage_times = {}
+        self.stage_clock = time.perf_counter()
+
+    def end_stage(self, name):
+        """
+        Record the time since the previous stage ended, in milliseconds.
+        """
+        now = time.perf_counter()
+        self.stage_times[name] = (now - self.stage_clock) * 1000
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.add_section(self.profile_name, name, self.stage_clock, now)
+        self.stage_clock = now
+
+    def add_output(self, output):
+        self.outputs.append(output)
+
+    def submit_to_outputs(self, frame):
+        for output in self.outputs:
+            output.submit(frame)
 
     def stop(self):
         with QMutexLocker(self.stop_mutex):
@@ -2,12 +2,18 @@ import os
 import numpy as np
 import cv2
 from PIL import Image
-from PyQt5.QtCore import QMutex, QWaitCondition, QMutexLocker
+from PyQt5.QtCore import QMutexLocker
 from .base_thread import BaseThread
-from .imagebuffer import Buffer
+from .imagebuffer import Buffer, SyncBarrier
+from .structures import SyncedFrames
 from . import param_settings as settings
-from .param_settings import xl, xr, yt, yb
 from . import utils
+from .rig import RigStitcher
+from .weight_cache import compute_overlap_weights
+from .viewports import ViewportRenderer
+from .bowl import BowlRenderer, BowlViewpoint
+from . import rig as rig_utils
+from .quality import FULL_QUALITY
 
 
 class ProjectedImageBuffer(object):
@@ -16,107 +22,177 @@ class ProjectedImageBuffer(object):
     Class for synchronizing processing threads from different cameras.
     """
 
-    def __init__(self, drop_if_full=True, buffer_size=8):
+    def __init__(self, drop_if_full=True, buffer_size=8, pixel_format="BGR", sync_timeout=1000):
+        """
+        sync_timeout: how long a processing thread waits for the other
+            cameras, in milliseconds. After that the frames are stitched with
+            the last frame of the cameras that did not arrive, and those
+            cameras are listed in the `stale` attribute of the frame set.
+        """
         self.drop_if_full = drop_if_full
+        self.pixel_format = pixel_format
         self.buffer = Buffer(buffer_size)
-        self.sync_devices = set()
-        self.wc = QWaitCondition()
-        self.mutex = QMutex()
-        self.arrived = 0
+        self.barrier = SyncBarrier(sync_timeout, self.add_frames)
         self.current_frames = dict()
+        self.current_raw_frames = dict()
+        self.current_timestamps = dict()
 
-    def bind_thread(self, thread):
-        with QMutexLocker(self.mutex):
-            self.sync_devices.add(thread.device_id)
+    @property
+    def sync_devices(self):
+        return self.barrier.devices
 
-        name = thread.camera_model.camera_name
-        shape = settings.project_shapes[name]
-        self.current_frames[thread.device_id] = np.zeros(shape[::-1] + (3,), np.uint8)
+    def bind_thread(self, thread):
+        self.barrier.add_device(thread.device_id)
+
+        h, w = thread.camera_model.get_frame_shape()
+        if self.pixel_format == "BGR":
+            self.current_frames[thread.device_id] = np.zeros((h, w, 3), np.uint8)
+        else:
+            self.current_frames[thread.device_id] = (np.zeros((h, w), np.uint8),
+                                                     np.full((h // 2, w // 2, 2), 128, np.uint8))
         thread.proc_buffer_manager = self
 
-    def get(self):
-        return self.buffer.get()
+    def get(self, timeout=None):
+        return self.buffer.get(timeout)
 
-    def set_frame_for_device(self, device_id, frame):
-        if device_id not in self.sync_devices:
+    def set_frame_for_device(self, device_id, frame, raw_frame=None, timestamp=None):
+        """
+        raw_frame: the camera frame `frame` was projected from, for
+            viewports rendered from the raw frames.
+        timestamp: the capture timestamp of the camera frame.
+        """
+        if device_id not in self.barrier:
             raise ValueError("Device not held by the buffer: {}".format(device_id))
         self.current_frames[device_id] = frame
+        if raw_frame is not None:
+            self.current_raw_frames[device_id] = raw_frame
+        if timestamp is not None:
+            self.current_timestamps[device_id] = timestamp
+
+    def add_frames(self, stalled):
+        # the frames of stalled cameras are the last ones they delivered
+        self.buffer.add(SyncedFrames(self.current_frames, stalled, self.current_raw_frames,
+                                     self.current_timestamps),
+                        self.drop_if_full)
 
     def sync(self, device_id):
-        # only perform sync if enabled for specified device/stream
-        self.mutex.lock()
-        if device_id in self.sync_devices:
-            # increment arrived count
-            self.arrived += 1
-            # we are the last to arrive: wake all waiting threads
-            if self.arrived == len(self.sync_devices):
-                self.buffer.add(self.current_frames, self.drop_if_full)
-                self.wc.wakeAll()
-            # still waiting for other streams to arrive: wait
-            else:
-                self.wc.wait(self.mutex)
-            # decrement arrived count
-            self.arrived -= 1
-        self.mutex.unlock()
+        return self.barrier.sync(device_id)
+
+    def stalled_devices(self):
+        return self.barrier.stalled_devices()
 
     def wake_all(self):
-        with QMutexLocker(self.mutex):
-            self.wc.wakeAll()
+        self.barrier.wake_all()
 
     def __contains__(self, device_id):
         return device_id in self.sync_devices
 
     def __str__(self):
         return (self.__class__.__name__ + ":\n" + \
-                "devices: {}\n".format(self.sync_devices))
+                "devices: {}\n".format(self.sync_devices) + \
+                "stalled devices: {}\n".format(self.stalled_devices()))
+
+
+def tune(x):
+    if x >= 1:
+        return x * np.exp((1 - x) * 0.5)
+    else:
+        return x * np.exp((1 - x) * 0.8)
+
 
+def FI(front_image, layout=settings.default_layout):
+    return front_image[:, :layout.xl]
 
-def FI(front_image):
-    return front_image[:, :xl]
 
+def FII(front_image, layout=settings.default_layout):
+    return front_image[:, layout.xr:]
 
-def FII(front_image):
-    return front_image[:, xr:]
 
+def FM(front_image, layout=settings.default_layout):
+    return front_image[:, layout.xl:layout.xr]
 
-def FM(front_image):
-    return front_image[:, xl:xr]
 
+def BIII(back_image, layout=settings.default_layout):
+    return back_image[:, :layout.xl]
 
-def BIII(back_image):
-    return back_image[:, :xl]
 
+def BIV(back_image, layout=settings.default_layout):
+    return back_image[:, layout.xr:]
 
-def BIV(back_image):
-    return back_image[:, xr:]
 
+def BM(back_image, layout=settings.default_layout):
+    return back_image[:, layout.xl:layout.xr]
 
-def BM(back_image):
-    return back_image[:, xl:xr]
 
+def LI(left_image, layout=settings.default_layout):
+    return left_image[:layout.yt, :]
 
-def LI(left_image):
-    return left_image[:yt, :]
 
+def LIII(left_image, layout=settings.default_layout):
+    return left_image[layout.yb:, :]
 
-def LIII(left_image):
-    return left_image[yb:, :]
 
+def LM(left_image, layout=settings.default_layout):
+    return left_image[layout.yt:layout.yb, :]
+
+
+def RII(right_image, layout=settings.default_layout):
+    return right_image[:layout.yt, :]
+
+
+def RIV(right_image, layout=settings.default_layout):
+    return right_image[layout.yb:, :]
+
+
+def RM(right_image, layout=settings.default_layout):
+    return right_image[layout.yt:layout.yb, :]
+
+
+def stack_weights(G, compact=False):
+    """
+    The weights of one overlap for the three channels of BGR frames: three
+    float64 copies, or with `compact` a read only float32 view of a single
+    copy, a quarter of the memory per channel and a third of the channels.
+    """
+    if compact:
+        G = np.asarray(G, np.float32)
+        return np.broadcast_to(G[:, :, None], G.shape + (3,))
+    G = np.asarray(G, np.float64)
+    return np.stack((G, G, G), axis=2)
 
-def LM(left_image):
-    return left_image[yt:yb, :]
 
+def read_weights_and_masks(weights_image, masks_image=None, compact=False):
+    """
+    Read the weights and masks of the four overlapping regions from the
+    RGBA images written by `run_get_weight_matrices.py`, or the weights and
+    masks of all overlaps of a rig from a .npz file (`masks_image` is unused).
 
-def RII(right_image):
-    return right_image[:yt, :]
+    compact: see `stack_weights`.
+    """
+    if weights_image.endswith(".npz"):
+        weights, masks = rig_utils.load_weights_and_masks(weights_image)
+        return [stack_weights(G, compact) for G in weights], masks
 
+    GMat = np.asarray(Image.open(weights_image).convert("RGBA"), dtype=np.float64) / 255.0
+    weights = [stack_weights(GMat[:, :, k], compact) for k in range(4)]
 
-def RIV(right_image):
-    return right_image[yb:, :]
+    Mmat = np.asarray(Image.open(masks_image).convert("RGBA"))
+    Mmat = utils.convert_binary_to_bool(Mmat)
+    masks = [Mmat[:, :, k].copy() for k in range(4)]
+    return weights, masks
 
 
-def RM(right_image):
-    return right_image[yt:yb, :]
+def make_yuv_weights(weights):
+    """
+    Luma and half resolution chroma versions of the weights.
+    """
+    luma_weights = [G[:, :, 0] for G in weights]
+    chroma_weights = []
+    for G in luma_weights:
+        h, w = G.shape
+        g = cv2.resize(G, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+        chroma_weights.append(np.stack((g, g), axis=2))
+    return luma_weights, chroma_weights
 
 
 class BirdView(BaseThread):
@@ -125,16 +201,140 @@ class BirdView(BaseThread):
                  proc_buffer_manager=None,
                  drop_if_full=True,
                  buffer_size=8,
+                 pixel_format="BGR",
+                 yuv_output=False,
+                 publisher=None,
+                 buffer_output=True,
+                 rig=None,
+                 layout=None,
+                 governor=None,
+                 stale_policy="hold",
+                 reuse_unchanged=False,
+                 refresh_interval=30,
+                 seam_monitor=None,
+                 compact_weights=False,
                  parent=None):
+        """
+        pixel_format: "BGR", or "NV12"/"I420" if the projected frames are
+            (luma, chroma) pairs of planes.
+        yuv_output: for yuv input, put NV12 frames into the buffer instead of
+            converting the stitched image to BGR.
+        publisher: an optional `BirdViewPublisher`, every stitched frame is
+            written to its shared memory ring.
+        buffer_output: put the stitched frames into `buffer` for `get`, can be
+            disabled if the frames are only consumed through the publisher.
+        rig: a `Rig` describing the cameras and overlaps, the frames are
+            stitched by a `RigStitcher` instead of the four camera layout of
+            `layout`. The frames must arrive in the order of `rig.cameras`.
+        layout: the `param_settings.Layout` of the four camera birdview,
+            `param_settings.default_layout` if not given. Its car image is
+            also drawn on rigs with a car rectangle.
+        governor: an optional `QualityGovernor`, lowers the quality of the
+            stitching when the thread cannot keep up with its target frame
+            rate. The current level is in `stat_data.quality_level`.
+        stale_policy: what to draw for a camera that has stalled, "hold" keeps
+            its last frame, "mask" blacks out its region. The luminance and
+            white balance gains are frozen while any camera is stale.
+        reuse_unchanged: when a camera sends the same frame object again (a
+            `CameraProcessingThread` with a `MotionGate`, or a stale camera),
+            the regions of the canvas that only depend on unchanged cameras
+            are kept from the previous frame, with the gains frozen. Four
+            camera BGR layout at full render scale only.
+        refresh_interval: with `reuse_unchanged`, the whole canvas and the
+            gains are computed again at least every this many frames.
+        seam_monitor: an optional `SeamMonitor`, checks the alignment of the
+            cameras in the overlaps every few frames, the scores are in
+            `stat_data.seam_scores` and `stat_data.seam_drift` is set when a
+            corner has drifted. Four camera layout only.
+        compact_weights: keep the weights loaded by `load_weights_and_masks`
+            and `get_weights_and_masks` as float32 views shared by the three
+            channels, see `stack_weights`.
+        """
+        if stale_policy not in ("hold", "mask"):
+            raise ValueError("Unknown stale policy: {}".format(stale_policy))
+        if rig is not None and seam_monitor is not None:
+            raise ValueError("The seam monitor is only supported for the four camera layout")
         super(BirdView, self).__init__(parent)
         self.proc_buffer_manager = proc_buffer_manager
         self.drop_if_full = drop_if_full
         self.buffer = Buffer(buffer_size)
-        self.image = np.zeros((settings.total_h, settings.total_w, 3), np.uint8)
+        self.layout = layout if layout is not None else settings.default_layout
+        self.rig = rig
+        self.stitcher = None
+        if rig is not None:
+            if pixel_format != "BGR":
+                raise ValueError("Rigs are only supported for BGR frames")
+            self.stitcher = RigStitcher(rig)
+            width, height = rig.canvas_size
+        else:
+            width, height = self.layout.total_w, self.layout.total_h
+        self.image = np.zeros((height, width, 3), np.uint8)
         self.weights = None
         self.masks = None
-        self.car_image = settings.car_image
+        self._car_image = None
         self.frames = None
+        self.pixel_format = pixel_format
+        self.yuv_output = yuv_output
+        self.publisher = publisher
+        self.buffer_output = buffer_output
+        self.luma = np.zeros((height, width), np.uint8)
+        self.chroma = np.full((height // 2, width // 2, 2), 128, np.uint8)
+        self.luma_weights = None
+        self.chroma_weights = None
+        self.governor = governor
+        self.stale_policy = stale_policy
+        # device ids of the cameras whose frame is stale in the current frame set
+        self.stale_devices = set()
+        # capture timestamp of the oldest camera frame of the current frame set
+        self.capture_timestamp = None
+        self.frame_index = 0
+        self.reuse_unchanged = reuse_unchanged
+        self.refresh_interval = refresh_interval
+        self.seam_monitor = seam_monitor
+        self.compact_weights = compact_weights
+        # the frames of the previous frame set, to tell which cameras changed
+        self.previous_frames = None
+        self.changed_cameras = None
+        # extra views rendered from the raw frames, see `set_viewports`
+        self.viewports = []
+        self.viewport_renderer = None
+        self.viewport_images = {}
+        self.active_viewports = None
+        self.bowl_surface = None
+        self.raw_frames = None
+        self.device_ids = []
+        # frames since the whole canvas was rendered, None if it must be
+        # rendered again, and the quality and stale cameras it was rendered with
+        self.frames_since_refresh = None
+        self.refresh_quality = None
+        self.refresh_stale = set()
+        self.luminance_gains = None
+        self.white_balance_gains = None
+        self.scaled_tables = {}
+
+    @property
+    def car_image(self):
+        """
+        The car image of the layout, or the same image resized to the car
+        rectangle of the rig, read when first needed.
+        """
+        if self._car_image is None:
+            if self.rig is not None and self.rig.car_rect is not None:
+                x0, y0, x1, y1 = self.rig.car_rect
+                self._car_image = self.layout.load_car_image((x1 - x0, y1 - y0))
+            else:
+                self._car_image = self.layout.car_image
+        return self._car_image
+
+    def output_shape(self):
+        """
+        Shape of the frames put into the buffer and given to the publisher
+        and the outputs: packed NV12 with `yuv_output`, BGR otherwise.
+        """
+        h, w = self.image.shape[:2]
+        if self.stitcher is None and self.pixel_format != "BGR" and self.yuv_output:
+            return (h * 3 // 2, w)
+        return self.image.shape
 
     def get(self):
         return self.buffer.get()
@@ -142,16 +342,38 @@ class BirdView(BaseThread):
     def update_frames(self, images):
         self.frames = images
 
-    def load_weights_and_masks(self, weights_image, masks_image):
-        GMat = np.asarray(Image.open(weights_image).convert("RGBA"), dtype=np.float64) / 255.0
-        self.weights = [np.stack((GMat[:, :, k],
-                                  GMat[:, :, k],
-                                  GMat[:, :, k]), axis=2)
-                        for k in range(4)]
-
-        Mmat = np.asarray(Image.open(masks_image).convert("RGBA"), dtype=np.float64)
-        Mmat = utils.convert_binary_to_bool(Mmat)
-        self.masks = [Mmat[:, :, k] for k in range(4)]
+    def load_weights_and_masks(self, weights_image, masks_image=None):
+        weights, masks = read_weights_and_masks(weights_image, masks_image, self.compact_weights)
+        self.weights = weights
+        self.masks = masks
+        self.luma_weights = None
+        self.scaled_tables = {}
+        self.frames_since_refresh = None
+        if self.stitcher is not None:
+            self.stitcher.set_weights_and_masks(weights, masks)
+
+    def set_weights_and_masks(self, weights, masks, yuv_weights=None):
+        """
+        Swap in new weights and masks between two frames, safe to call while
+        the thread is running. Everything should be prepared beforehand
+        (see `read_weights_and_masks` and `make_yuv_weights`) so the swap
+        itself costs nothing.
+        """
+        stitcher = None
+        if self.rig is not None:
+            stitcher = RigStitcher(self.rig).set_weights_and_masks(weights, masks)
+
+        with QMutexLocker(self.processing_mutex):
+            self.weights = weights
+            self.masks = masks
+            self.scaled_tables = {}
+            self.frames_since_refresh = None
+            if stitcher is not None:
+                self.stitcher = stitcher
+            if yuv_weights is not None:
+                self.luma_weights, self.chroma_weights = yuv_weights
+            else:
+                self.luma_weights = None
 
     def merge(self, imA, imB, k):
         G = self.weights[k]
@@ -159,159 +381,488 @@ class BirdView(BaseThread):
 
     @property
     def FL(self):
-        return self.image[:yt, :xl]
+        return self.image[:self.layout.yt, :self.layout.xl]
 
     @property
     def F(self):
-        return self.image[:yt, xl:xr]
+        return self.image[:self.layout.yt, self.layout.xl:self.layout.xr]
 
     @property
     def FR(self):
-        return self.image[:yt, xr:]
+        return self.image[:self.layout.yt, self.layout.xr:]
 
     @property
     def BL(self):
-        return self.image[yb:, :xl]
+        return self.image[self.layout.yb:, :self.layout.xl]
 
     @property
     def B(self):
-        return self.image[yb:, xl:xr]
+        return self.image[self.layout.yb:, self.layout.xl:self.layout.xr]
 
     @property
     def BR(self):
-        return self.image[yb:, xr:]
+        return self.image[self.layout.yb:, self.layout.xr:]
 
     @property
     def L(self):
-        return self.image[yt:yb, :xl]
+        return self.image[self.layout.yt:self.layout.yb, :self.layout.xl]
 
     @property
     def R(self):
-        return self.image[yt:yb, xr:]
+        return self.image[self.layout.yt:self.layout.yb, self.layout.xr:]
 
     @property
     def C(self):
-        return self.image[yt:yb, xl:xr]
+        return self.image[self.layout.yt:self.layout.yb, self.layout.xl:self.layout.xr]
 
     def stitch_all_parts(self):
         front, back, left, right = self.frames
-        np.copyto(self.F, FM(front))
-        np.copyto(self.B, BM(back))
-        np.copyto(self.L, LM(left))
-        np.copyto(self.R, RM(right))
-        np.copyto(self.FL, self.merge(FI(front), LI(left), 0))
-        np.copyto(self.FR, self.merge(FII(front), RII(right), 1))
-        np.copyto(self.BL, self.merge(BIII(back), LIII(left), 2))
-        np.copyto(self.BR, self.merge(BIV(back), RIV(right), 3))
+        np.copyto(self.F, FM(front, self.layout))
+        np.copyto(self.B, BM(back, self.layout))
+        np.copyto(self.L, LM(left, self.layout))
+        np.copyto(self.R, RM(right, self.layout))
+        np.copyto(self.FL, self.merge(FI(front, self.layout), LI(left, self.layout), 0))
+        np.copyto(self.FR, self.merge(FII(front, self.layout), RII(right, self.layout), 1))
+        np.copyto(self.BL, self.merge(BIII(back, self.layout), LIII(left, self.layout), 2))
+        np.copyto(self.BR, self.merge(BIV(back, self.layout), RIV(right, self.layout), 3))
 
     def copy_car_image(self):
         np.copyto(self.C, self.car_image)
 
-    def make_luminance_balance(self):
-
-        def tune(x):
-            if x >= 1:
-                return x * np.exp((1 - x) * 0.5)
-            else:
-                return x * np.exp((1 - x) * 0.8)
-
-        front, back, left, right = self.frames
+    def compute_luminance_gains(self, frames, step=1):
+        """
+        Luminance gains of the four cameras from the overlapping regions of
+        `frames`, BGR images or luma planes. Returns an array of shape (4, 3)
+        with one (B, G, R) row per camera, or (4,) for luma planes. The
+        statistics are taken on every `step`-th row and column.
+        """
+        front, back, left, right = frames
         m1, m2, m3, m4 = self.masks
-        Fb, Fg, Fr = cv2.split(front)
-        Bb, Bg, Br = cv2.split(back)
-        Lb, Lg, Lr = cv2.split(left)
-        Rb, Rg, Rr = cv2.split(right)
-
-        a1 = utils.mean_luminance_ratio(RII(Rb), FII(Fb), m2)
-        a2 = utils.mean_luminance_ratio(RII(Rg), FII(Fg), m2)
-        a3 = utils.mean_luminance_ratio(RII(Rr), FII(Fr), m2)
-
-        b1 = utils.mean_luminance_ratio(BIV(Bb), RIV(Rb), m4)
-        b2 = utils.mean_luminance_ratio(BIV(Bg), RIV(Rg), m4)
-        b3 = utils.mean_luminance_ratio(BIV(Br), RIV(Rr), m4)
-
-        c1 = utils.mean_luminance_ratio(LIII(Lb), BIII(Bb), m3)
-        c2 = utils.mean_luminance_ratio(LIII(Lg), BIII(Bg), m3)
-        c3 = utils.mean_luminance_ratio(LIII(Lr), BIII(Br), m3)
-
-        d1 = utils.mean_luminance_ratio(FI(Fb), LI(Lb), m1)
-        d2 = utils.mean_luminance_ratio(FI(Fg), LI(Lg), m1)
-        d3 = utils.mean_luminance_ratio(FI(Fr), LI(Lr), m1)
-
-        t1 = (a1 * b1 * c1 * d1)**0.25
-        t2 = (a2 * b2 * c2 * d2)**0.25
-        t3 = (a3 * b3 * c3 * d3)**0.25
-
-        x1 = t1 / (d1 / a1)**0.5
-        x2 = t2 / (d2 / a2)**0.5
-        x3 = t3 / (d3 / a3)**0.5
-
-        x1 = tune(x1)
-        x2 = tune(x2)
-        x3 = tune(x3)
-
-        Fb = utils.adjust_luminance(Fb, x1)
-        Fg = utils.adjust_luminance(Fg, x2)
-        Fr = utils.adjust_luminance(Fr, x3)
-
-        y1 = t1 / (b1 / c1)**0.5
-        y2 = t2 / (b2 / c2)**0.5
-        y3 = t3 / (b3 / c3)**0.5
-
-        y1 = tune(y1)
-        y2 = tune(y2)
-        y3 = tune(y3)
-
-        Bb = utils.adjust_luminance(Bb, y1)
-        Bg = utils.adjust_luminance(Bg, y2)
-        Br = utils.adjust_luminance(Br, y3)
-
-        z1 = t1 / (c1 / d1)**0.5
-        z2 = t2 / (c2 / d2)**0.5
-        z3 = t3 / (c3 / d3)**0.5
-
-        z1 = tune(z1)
-        z2 = tune(z2)
-        z3 = tune(z3)
-
-        Lb = utils.adjust_luminance(Lb, z1)
-        Lg = utils.adjust_luminance(Lg, z2)
-        Lr = utils.adjust_luminance(Lr, z3)
-
-        w1 = t1 / (a1 / b1)**0.5
-        w2 = t2 / (a2 / b2)**0.5
-        w3 = t3 / (a3 / b3)**0.5
-
-        w1 = tune(w1)
-        w2 = tune(w2)
-        w3 = tune(w3)
-
-        Rb = utils.adjust_luminance(Rb, w1)
-        Rg = utils.adjust_luminance(Rg, w2)
-        Rr = utils.adjust_luminance(Rr, w3)
-
-        self.frames = [cv2.merge((Fb, Fg, Fr)),
-                       cv2.merge((Bb, Bg, Br)),
-                       cv2.merge((Lb, Lg, Lr)),
-                       cv2.merge((Rb, Rg, Rr))]
+
+        def ratio(imA, imB, mask):
+            mask = mask[::step, ::step]
+            if imA.ndim == 3:
+                mask = mask[:, :, None]
+            sumA = (imA[::step, ::step] * mask).sum(axis=(0, 1))
+            sumB = (imB[::step, ::step] * mask).sum(axis=(0, 1))
+            # a black (masked) camera leaves its neighbours unchanged
+            return np.where((sumA > 0) & (sumB > 0), sumA / np.maximum(sumB, 1), 1.0)
+
+        a = ratio(RII(right, self.layout), FII(front, self.layout), m2)
+        b = ratio(BIV(back, self.layout), RIV(right, self.layout), m4)
+        c = ratio(LIII(left, self.layout), BIII(back, self.layout), m3)
+        d = ratio(FI(front, self.layout), LI(left, self.layout), m1)
+        t = (a * b * c * d)**0.25
+        gains = np.array([t / (d / a)**0.5,
+                          t / (b / c)**0.5,
+                          t / (c / d)**0.5,
+                          t / (a / b)**0.5])
+        return rig_utils.tune_gains(gains)
+
+    def make_luminance_balance(self, gains=None):
+        """
+        Scale the frames by the luminance gains, computed from the frames
+        unless given.
+        """
+        if gains is None:
+            gains = self.compute_luminance_gains(self.frames)
+        self.frames = [utils.adjust_luminance(frame, x) for frame, x in zip(self.frames, gains)]
         return self
 
-    def get_weights_and_masks(self, images):
+    def get_weights_and_masks(self, images, camera_models=None, cache=None, workers=None):
+        """
+        Compute the weights and masks of the four corners from the projected
+        and flipped images of the cameras, on worker processes.
+
+        With a `weight_cache.WeightCache`, corners found in it are not
+        computed again, the keys include the `projection_key` of the camera
+        models if they are given.
+        """
         front, back, left, right = images
-        G0, M0 = utils.get_weight_mask_matrix(FI(front), LI(left))
-        G1, M1 = utils.get_weight_mask_matrix(FII(front), RII(right))
-        G2, M2 = utils.get_weight_mask_matrix(BIII(back), LIII(left))
-        G3, M3 = utils.get_weight_mask_matrix(BIV(back), RIV(right))
-        self.weights = [np.stack((G, G, G), axis=2) for G in (G0, G1, G2, G3)]
-        self.masks = [(M / 255.0).astype(int) for M in (M0, M1, M2, M3)]
+        pairs = [(FI(front, self.layout), LI(left, self.layout)),
+                 (FII(front, self.layout), RII(right, self.layout)),
+                 (BIII(back, self.layout), LIII(left, self.layout)),
+                 (BIV(back, self.layout), RIV(right, self.layout))]
+        params = None
+        if camera_models is not None:
+            keys = [camera.projection_key() for camera in camera_models]
+            params = [(keys[0], keys[2]), (keys[0], keys[3]),
+                      (keys[1], keys[2]), (keys[1], keys[3])]
+        results, _ = compute_overlap_weights(pairs, params, cache, workers)
+        (G0, M0), (G1, M1), (G2, M2), (G3, M3) = results
+        self.weights = [stack_weights(G, self.compact_weights) for G in (G0, G1, G2, G3)]
+        self.masks = [utils.convert_binary_to_bool(M) for M in (M0, M1, M2, M3)]
+        self.luma_weights = None
+        self.scaled_tables = {}
+        self.frames_since_refresh = None
         return np.stack((G0, G1, G2, G3), axis=2), np.stack((M0, M1, M2, M3), axis=2)
 
     def make_white_balance(self):
         self.image = utils.make_white_balance(self.image)
 
+    def get_camera_regions(self, weights=None, masks=None):
+        """
+        For each camera, a boolean array of its flipped frame shape marking
+        the pixels the stitcher reads: the middle part, and the pixels of the
+        corners that have a nonzero weight or are used by the luminance balance.
+        The current weights and masks are used if none are given.
+        """
+        if weights is None:
+            weights, masks = self.weights, self.masks
+
+        # (the camera weighted by G, the camera weighted by 1 - G) of each corner
+        used = []
+        for G, M in zip(weights, masks):
+            G = G[:, :, 0]
+            used.append(((G > 0) | (M > 0), (G < 1) | (M > 0)))
+
+        regions = {}
+        for name, (w, h) in self.layout.project_shapes.items():
+            shape = (h, w) if name in ("front", "back") else (w, h)
+            regions[name] = np.zeros(shape, bool)
+
+        front, back, left, right = [regions[name] for name in self.layout.camera_names]
+        FM(front, self.layout)[:] = True
+        BM(back, self.layout)[:] = True
+        LM(left, self.layout)[:] = True
+        RM(right, self.layout)[:] = True
+        FI(front, self.layout)[:], LI(left, self.layout)[:] = used[0]
+        FII(front, self.layout)[:], RII(right, self.layout)[:] = used[1]
+        BIII(back, self.layout)[:], LIII(left, self.layout)[:] = used[2]
+        BIV(back, self.layout)[:], RIV(right, self.layout)[:] = used[3]
+        return regions
+
+    def crop_camera_models(self, camera_models, band_height=16):
+        """
+        Make the camera models compute only the pixels the stitcher reads,
+        the weights and masks must be loaded. Returns the pixels computed per
+        frame by each camera before and after cropping.
+        """
+        regions = self.get_camera_regions()
+        report = {}
+        for camera in camera_models:
+            camera.set_output_region(regions[camera.camera_name], band_height)
+            report[camera.camera_name] = camera.pixels_per_frame()
+        return report
+
+    def update_yuv_tables(self):
+        """
+        Luma and half resolution chroma versions of the weights and the car image.
+        """
+        self.luma_weights, self.chroma_weights = make_yuv_weights(self.weights)
+        self.car_luma, self.car_chroma = utils.bgr_to_yuv(self.car_image)
+
+    def make_luminance_balance_yuv(self, gains=None):
+        """
+        Luminance balance computed and applied on the luma planes only.
+        """
+        if gains is None:
+            gains = self.compute_luminance_gains([y for y, _ in self.frames])
+        self.frames = [(utils.adjust_luminance(y, x), uv)
+                       for (y, uv), x in zip(self.frames, gains)]
+        return self
+
+    def stitch_planes(self, canvas, frames, weights, s=1):
+        """
+        Stitch four frames into `canvas`, the frames, weights and canvas are
+        all at 1 / s of the resolution of the layout.
+        """
+        xl, xr, yt, yb = self.layout.xl, self.layout.xr, self.layout.yt, self.layout.yb
+        front, back, left, right = frames
+        l, r, t, b = [x // s for x in (xl, xr, yt, yb)]
+        np.copyto(canvas[:t, l:r], front[:, l:r])
+        np.copyto(canvas[b:, l:r], back[:, l:r])
+        np.copyto(canvas[t:b, :l], left[t:b])
+        np.copyto(canvas[t:b, r:], right[t:b])
+        for region, imA, imB, G in ((canvas[:t, :l], front[:, :l], left[:t], weights[0]),
+                                    (canvas[:t, r:], front[:, r:], right[:t], weights[1]),
+                                    (canvas[b:, :l], back[:, :l], left[b:], weights[2]),
+                                    (canvas[b:, r:], back[:, r:], right[b:], weights[3])):
+            np.copyto(region, (imA * G + imB * (1 - G)).astype(np.uint8))
+
+    def stitch_all_parts_yuv(self):
+        luma_frames, chroma_frames = zip(*self.frames)
+        self.stitch_planes(self.luma, luma_frames, self.luma_weights, 1)
+        self.stitch_planes(self.chroma, chroma_frames, self.chroma_weights, 2)
+
+    def make_white_balance_yuv(self):
+        """
+        Gray world white balance in yuv space: shift the mean of the chroma
+        planes to the neutral value 128.
+        """
+        mean = self.chroma.reshape(-1, 2).mean(axis=0)
+        self.chroma = np.clip(self.chroma + (128 - mean), 0, 255).astype(np.uint8)
+
+    def copy_car_image_yuv(self):
+        xl, xr, yt, yb = self.layout.xl, self.layout.xr, self.layout.yt, self.layout.yb
+        np.copyto(self.luma[yt:yb, xl:xr], self.car_luma)
+        np.copyto(self.chroma[yt // 2:yb // 2, xl // 2:xr // 2], self.car_chroma)
+
+    def should_update_gains(self, quality):
+        if self.luminance_gains is None:
+            return True
+        # the statistics of a frozen or masked camera are meaningless
+        return len(self.stale_devices) == 0 and self.frame_index % quality.stats_interval == 0
+
+    def update_synced_frames(self, frames):
+        """
+        Take a frame set from the `ProjectedImageBuffer`, the frames of stale
+        cameras are masked if the stale policy says so.
+        """
+        self.stale_devices = getattr(frames, "stale", set())
+        self.capture_timestamp = (frames.capture_timestamp()
+                                  if isinstance(frames, SyncedFrames) else None)
+        images = list(frames.values())
+        if self.previous_frames is not None and len(self.previous_frames) == len(images):
+            self.changed_cameras = [image is not previous
+                                    for image, previous in zip(images, self.previous_frames)]
+        else:
+            self.changed_cameras = [True] * len(images)
+        self.previous_frames = images[:]
+        raw = getattr(frames, "raw", {})
+        self.raw_frames = [raw.get(device_id) for device_id in frames.keys()]
+        self.device_ids = list(frames.keys())
+        if self.stale_policy == "mask" and len(self.stale_devices) > 0:
+            for k, device_id in enumerate(frames.keys()):
+                if device_id in self.stale_devices:
+                    if isinstance(images[k], tuple):
+                        y, uv = images[k]
+                        images[k] = (np.zeros_like(y), np.full_like(uv, 128))
+                    else:
+                        images[k] = np.zeros_like(images[k])
+        self.update_frames(images)
+
+    def check_seams(self):
+        """
+        Give the frames of the next corner to the seam monitor and publish
+        its scores. Skipped while a camera is stale.
+        """
+        monitor = self.seam_monitor
+        if len(self.stale_devices) > 0 or self.masks is None:
+            return
+        if monitor.masks is not self.masks:
+            monitor.set_masks(self.masks)
+        if self.pixel_format == "BGR":
+            front, back, left, right = self.frames
+        else:
+            front, back, left, right = [y for y, _ in self.frames]
+        cropA, imA, cropB, imB = ((FI, front, LI, left),
+                                  (FII, front, RII, right),
+                                  (BIII, back, LIII, left),
+                                  (BIV, back, RIV, right))[monitor.next_corner]
+        monitor.update(cropA(imA, self.layout), cropB(imB, self.layout))
+        self.stat_data.seam_scores = list(monitor.scores)
+        self.stat_data.seam_drift = any(monitor.drift)
+
+    def set_viewports(self, viewports, camera_models, surface=None):
+        """
+        Render a list of `viewports.Viewport` and `bowl.BowlViewpoint` from
+        the raw camera frames after every stitched frame, with the gains of
+        the stitcher. The camera models are in the order of the layout and
+        the weights must be loaded. `surface` is the `bowl.BowlSurface` of the
+        bowl viewpoints. The tables are built in the calling thread, the
+        swap is safe while the thread is running. Four camera BGR layout only.
+        """
+        if len(viewports) > 0 and (self.rig is not None or self.pixel_format != "BGR"):
+            raise ValueError("Viewports are only supported for the four camera BGR layout")
+        renderer = None
+        if any(isinstance(viewport, BowlViewpoint) for viewport in viewports):
+            renderer = BowlRenderer(viewports, camera_models, self.weights, self.layout, surface)
+        elif len(viewports) > 0:
+            renderer = ViewportRenderer(viewports, camera_models, self.weights, self.layout)
+        with QMutexLocker(self.processing_mutex):
+            self.viewports = list(viewports)
+            self.bowl_surface = surface
+            self.viewport_renderer = renderer
+            self.viewport_images = {}
+
+    def select_viewports(self, names=None):
+        """
+        Only render the viewports with these names from the next frame on,
+        all of them if None. Their tables are already built, so switching
+        between viewpoints costs nothing.
+        """
+        with QMutexLocker(self.processing_mutex):
+            self.active_viewports = list(names) if names is not None else None
+            self.viewport_images = {}
+
+    def get_viewports(self):
+        """
+        The latest images of the viewports, a dict keyed by viewport name.
+        """
+        with QMutexLocker(self.processing_mutex):
+            return dict(self.viewport_images)
+
+    def render_viewports(self, quality=FULL_QUALITY):
+        if self.raw_frames is None or any(frame is None for frame in self.raw_frames):
+            return
+        gains = np.array(self.luminance_gains, np.float64)
+        if self.stale_policy == "mask":
+            for k, device_id in enumerate(self.device_ids):
+                if device_id in self.stale_devices:
+                    gains[k] = 0
+        white_balance = self.white_balance_gains if quality.white_balance else None
+        self.viewport_images = self.viewport_renderer.render(self.raw_frames, gains, white_balance,
+                                                             self.active_viewports)
+
+    def get_scaled_tables(self, s):
+        """
+        Canvas, weights and car image for stitching at 1 / s resolution.
+        """
+        if s not in self.scaled_tables:
+            h, w = self.image.shape[:2]
+            car = self.car_image
+            car = cv2.resize(car, (car.shape[1] // s, car.shape[0] // s),
+                             interpolation=cv2.INTER_AREA)
+            self.scaled_tables[s] = (np.zeros((h // s, w // s, 3), np.uint8),
+                                     [G[::s, ::s] for G in self.weights],
+                                     car)
+        return self.scaled_tables[s]
+
+    def can_reuse_regions(self, quality):
+        """
+        Whether the regions of unchanged cameras can be kept from the
+        previous canvas for this frame set.
+        """
+        if not self.reuse_unchanged or quality.render_scale != 1:
+            return False
+        if self.frames_since_refresh is None or self.changed_cameras is None:
+            return False
+        if quality is not self.refresh_quality or self.stale_devices != self.refresh_stale:
+            return False
+        if self.refresh_interval > 0 and self.frames_since_refresh + 1 >= self.refresh_interval:
+            return False
+        return not all(self.changed_cameras)
+
+    def render_bgr_partial(self, quality):
+        """
+        Stitch only the regions of the canvas that use a changed camera, with
+        the gains of the last full render.
+        """
+        self.end_stage("luminance_stats")
+        frames = {}
+
+        def frame(k):
+            if k not in frames:
+                frames[k] = utils.adjust_luminance(self.frames[k], self.luminance_gains[k])
+            return frames[k]
+
+        layout = self.layout
+        parts = ((self.F, (0,), lambda: FM(frame(0), layout)),
+                 (self.B, (1,), lambda: BM(frame(1), layout)),
+                 (self.L, (2,), lambda: LM(frame(2), layout)),
+                 (self.R, (3,), lambda: RM(frame(3), layout)),
+                 (self.FL, (0, 2), lambda: self.merge(FI(frame(0), layout), LI(frame(2), layout), 0)),
+                 (self.FR, (0, 3), lambda: self.merge(FII(frame(0), layout), RII(frame(3), layout), 1)),
+                 (self.BL, (1, 2), lambda: self.merge(BIII(frame(1), layout), LIII(frame(2), layout), 2)),
+                 (self.BR, (1, 3), lambda: self.merge(BIV(frame(1), layout), RIV(frame(3), layout), 3)))
+        updated = []
+        for region, cameras, make in parts:
+            if any(self.changed_cameras[k] for k in cameras):
+                np.copyto(region, make())
+                updated.append(region)
+        self.end_stage("stitch")
+
+        if quality.white_balance and self.white_balance_gains is not None:
+            for region in updated:
+                np.copyto(region, utils.apply_white_balance(region, self.white_balance_gains))
+        self.end_stage("white_balance")
+        self.end_stage("car_image")
+        self.frames_since_refresh += 1
+        return self.image
+
+    def render_bgr(self, quality=FULL_QUALITY):
+        """
+        Stitch BGR frames of the four camera layout at the given quality level.
+        """
+        if self.can_reuse_regions(quality):
+            return self.render_bgr_partial(quality)
+
+        update = self.should_update_gains(quality)
+        if update:
+            self.luminance_gains = self.compute_luminance_gains(self.frames, quality.stats_step)
+        self.end_stage("luminance_stats")
+
+        s = quality.render_scale
+        if s == 1:
+            self.make_luminance_balance(self.luminance_gains).stitch_all_parts()
+            canvas = self.image
+        else:
+            canvas, weights, car = self.get_scaled_tables(s)
+            frames = [utils.adjust_luminance(frame[::s, ::s], x)
+                      for frame, x in zip(self.frames, self.luminance_gains)]
+            self.stitch_planes(canvas, frames, weights, s)
+        self.end_stage("stitch")
+
+        if quality.white_balance:
+            if update or self.white_balance_gains is None:
+                self.white_balance_gains = utils.get_white_balance_gains(canvas, quality.stats_step)
+            canvas = utils.apply_white_balance(canvas, self.white_balance_gains)
+        self.end_stage("white_balance")
+
+        if s == 1:
+            self.image = canvas
+            self.copy_car_image()
+            self.frames_since_refresh = 0
+            self.refresh_quality = quality
+            self.refresh_stale = set(self.stale_devices)
+        else:
+            self.frames_since_refresh = None
+            xl, xr, yt, yb = [x // s for x in (self.layout.xl, self.layout.xr,
+                                               self.layout.yt, self.layout.yb)]
+            np.copyto(canvas[yt:yb, xl:xr], car)
+            cv2.resize(canvas, self.image.shape[1::-1], self.image, interpolation=cv2.INTER_LINEAR)
+        self.end_stage("car_image")
+        return self.image
+
+    def render_rig(self, quality=FULL_QUALITY):
+        """
+        Stitch the frames of a `Rig`, luminance gains come from one
+        least-squares solve over the overlap graph.
+        """
+        update = self.should_update_gains(quality)
+        self.image, self.luminance_gains, self.white_balance_gains = self.stitcher.render(
+            list(self.frames), self.image,
+            None if update else self.luminance_gains,
+            None if update else self.white_balance_gains,
+            quality, self.car_image, self.end_stage)
+        return self.image
+
+    def render_yuv(self, quality=FULL_QUALITY):
+        """
+        Stitch yuv frames, the result is converted to BGR only once, on the
+        final canvas, unless `yuv_output` is set.
+        """
+        if self.luma_weights is None:
+            self.update_yuv_tables()
+
+        if self.should_update_gains(quality):
+            self.luminance_gains = self.compute_luminance_gains([y for y, _ in self.frames],
+                                                                quality.stats_step)
+        self.end_stage("luminance_stats")
+
+        self.make_luminance_balance_yuv(self.luminance_gains).stitch_all_parts_yuv()
+        self.end_stage("stitch")
+
+        if quality.white_balance:
+            self.make_white_balance_yuv()
+        self.end_stage("white_balance")
+
+        self.copy_car_image_yuv()
+        if self.yuv_output:
+            output = utils.pack_yuv(self.luma, self.chroma)
+        else:
+            self.image = utils.yuv_to_bgr(self.luma, self.chroma)
+            output = self.image
+        self.end_stage("car_image")
+        return output
+
     def run(self):
         if self.proc_buffer_manager is None:
             raise ValueError("This thread requires a buffer of projected images to run")
+        if self.publisher is not None and tuple(self.publisher.shape) != self.output_shape():
+            raise ValueError("The publisher ring holds {} frames, the birdview outputs {}".format(
+                self.publisher.shape, self.output_shape()))
 
         while True:
             self.stop_mutex.lock()
@@ -325,11 +876,37 @@ class BirdView(BaseThread):
 
             self.processing_mutex.lock()
 
-            self.update_frames(self.proc_buffer_manager.get().values())
-            self.make_luminance_balance().stitch_all_parts()
-            self.make_white_balance()
-            self.copy_car_image()
-            self.buffer.add(self.image.copy(), self.drop_if_full)
+            self.update_synced_frames(self.proc_buffer_manager.get())
+            self.start_stages()
+            quality = self.governor.level if self.governor is not None else FULL_QUALITY
+            if self.stitcher is not None:
+                output = self.render_rig(quality)
+            elif self.pixel_format == "BGR":
+                output = self.render_bgr(quality)
+            else:
+                output = self.render_yuv(quality)
+
+            if self.publisher is not None:
+                self.publisher.publish(output, self.capture_timestamp or 0)
+            if self.buffer_output or len(self.outputs) > 0:
+                # the BGR canvas is reused for the next frame while
+                # render_yuv always returns a new array
+                if self.pixel_format == "BGR":
+                    output = output.copy()
+                if self.buffer_output:
+                    self.buffer.add(output, self.drop_if_full)
+                self.submit_to_outputs(output)
+            self.end_stage("output")
+            if self.viewport_renderer is not None:
+                self.render_viewports(quality)
+                self.end_stage("viewports")
+            if self.seam_monitor is not None and self.seam_monitor.due(self.frame_index):
+                self.check_seams()
+                self.end_stage("seams")
+            self.frame_index += 1
+            if self.governor is not None:
+                self.governor.update(sum(self.stage_times.values()), self.stage_times)
+                self.stat_data.quality_level = self.governor.level_index
             self.processing_mutex.unlock()
 
             # update statistics
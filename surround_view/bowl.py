@@ -0,0 +1,224 @@
+"""
+Perspective views of a bowl shaped surface around the car.
+
+The birdview projects every camera on the ground plane, so anything that
+stands up near the car is stretched away from it. Here the ground is flat
+close to the car and rises as a bowl further away, and it is looked at by
+a virtual pinhole camera placed anywhere around the car.
+
+The pose of each camera relative to the ground is recovered from its
+project matrix and the camera matrix of its undistortion (`camera_pose`),
+no other calibration is needed. The points of the bowl are projected into
+the raw frames with the fisheye model of the camera. All of it is done once
+per viewpoint when the tables are built, rendering a viewpoint is then the
+remap and blend of `ViewportRenderer`.
+
+Coordinates are those of the birdview canvas (x to the right, y towards the
+back of the car, in canvas pixels) and the height above the ground in the
+same unit.
+"""
+import numpy as np
+import cv2
+
+from . import param_settings as settings
+from .viewports import ViewportRenderer, canvas_offsets
+
+
+def camera_pose(camera, offset=(0, 0)):
+    """
+    Pose of a camera relative to the ground, from its project matrix.
+
+    offset: position of the flipped frame of the camera on the canvas, see
+        `viewports.canvas_offsets`.
+
+    Returns (G, up, center): the point (x, y, h) is at `G.dot((x, y, 1)) +
+    h * up` in the coordinates of the camera, and `center` is the (x, y, h)
+    of the camera. For h = 0 this is exactly the projection of the birdview.
+    """
+    ox, oy = offset
+    # canvas points to the projected image, an affine map
+    src = np.float32([[0, 0], [100, 0], [0, 100]])
+    px, py = camera.unflip_points(src[:, 0] - ox, src[:, 1] - oy)
+    A = np.vstack([cv2.getAffineTransform(src, np.float32(np.stack([px, py], axis=1))),
+                   [0, 0, 1]])
+    G = np.linalg.inv(camera.get_new_camera_matrix()).dot(
+        np.linalg.inv(camera.project_matrix)).dot(A)
+    G /= (np.linalg.norm(G[:, 0]) + np.linalg.norm(G[:, 1])) / 2
+
+    # the ground in front of the camera has a positive depth
+    h, w = camera.get_frame_shape()
+    if G[2].dot((ox + w / 2, oy + h / 2, 1)) < 0:
+        G = -G
+    up = np.cross(G[:, 0], G[:, 1])
+    up /= np.linalg.norm(up)
+    R = np.stack([G[:, 0], G[:, 1], up], axis=1)
+    center = -np.linalg.solve(R, G[:, 2])
+    if center[2] < 0:
+        up = -up
+        center[2] = -center[2]
+    return G, up, center
+
+
+class BowlSurface(object):
+
+    def __init__(self, layout=None, flat_radius=250, curvature=300, max_distance=5000):
+        """
+        flat_radius: the ground is flat up to this distance from the car
+            rectangle.
+        curvature: beyond, the wall rises by d**2 / (2 * curvature) at a
+            distance d from the flat part.
+        max_distance: rays that hit nothing closer than this are left black.
+        """
+        self.layout = layout if layout is not None else settings.default_layout
+        self.flat_radius = flat_radius
+        self.curvature = curvature
+        self.max_distance = max_distance
+
+    def height(self, x, y):
+        xl, yt, xr, yb = self.layout.car_rect
+        dx = np.maximum(np.maximum(xl - x, x - xr), 0)
+        dy = np.maximum(np.maximum(yt - y, y - yb), 0)
+        d = np.maximum(np.sqrt(dx**2 + dy**2) - self.flat_radius, 0)
+        return d**2 / (2 * self.curvature)
+
+    def intersect(self, origin, directions, steps=32, iterations=16):
+        """
+        First points where the rays from `origin` along `directions` (an
+        array of shape (..., 3)) meet the bowl. Returns the (x, y, h) arrays
+        of the points and the mask of the rays that meet it.
+        """
+        ox, oy, oh = origin
+        dx, dy, dh = [directions[..., i] for i in range(3)]
+        x, y = np.zeros(dx.shape), np.zeros(dx.shape)
+        hit = np.zeros(dx.shape, bool)
+
+        # from above the flat part, a ray that meets the ground in the flat
+        # part meets nothing before (the flat part is convex)
+        todo = np.ones(dx.shape, bool)
+        if oh > 0 and self.height(ox, oy) == 0:
+            s = np.where(dh < 0, -oh / np.minimum(dh, -1e-12), np.inf)
+            gx, gy = ox + s * dx, oy + s * dy
+            flat = (dh < 0) & (self.height(gx, gy) == 0)
+            x[flat], y[flat], hit[flat] = gx[flat], gy[flat], True
+            todo = ~flat
+
+        # march the other rays until they go below the surface, then bisect
+        dx, dy, dh = dx[todo], dy[todo], dh[todo]
+
+        def above(s):
+            return oh + s * dh > self.height(ox + s * dx, oy + s * dy)
+
+        lo = np.zeros(dx.shape)
+        hi = np.full(dx.shape, np.inf)
+        for k in range(1, steps + 1):
+            s = self.max_distance * (k / steps)**2
+            found = np.isinf(hi) & ~above(s)
+            hi[found] = s
+            lo[np.isinf(hi)] = s
+        found = np.isfinite(hi)
+        hi[~found] = lo[~found]
+        for _ in range(iterations):
+            mid = (lo + hi) / 2
+            a = above(mid)
+            lo = np.where(a, mid, lo)
+            hi = np.where(a, hi, mid)
+
+        x[todo], y[todo], hit[todo] = ox + hi * dx, oy + hi * dy, found
+        return (x, y, self.height(x, y)), hit
+
+
+class BowlViewpoint(object):
+
+    def __init__(self, name, size, position, target, fov=90, up=(0, 0, 1)):
+        """
+        name: key of the view in the rendered dict.
+        size: (width, height) of the output image.
+        position, target: (x, y, h) of the virtual camera and of the point
+            it looks at.
+        fov: horizontal field of view in degrees.
+        up: the direction that is up in the image, change it when looking
+            straight down.
+        """
+        self.name = name
+        self.size = tuple(int(x) for x in size)
+        self.position = tuple(float(x) for x in position)
+        self.target = tuple(float(x) for x in target)
+        self.fov = fov
+        self.up = tuple(float(x) for x in up)
+        self.camera = None
+        self.rect = None
+
+    def __repr__(self):
+        return "BowlViewpoint({!r}, {}, position={}, target={}, fov={})".format(
+            self.name, self.size, self.position, self.target, self.fov)
+
+    def rays(self):
+        """
+        The directions of the rays through the centers of the output pixels,
+        an array of shape (height, width, 3).
+        """
+        # the canvas coordinates are left handed, flip y to build the camera
+        flip = np.float64([1, -1, 1])
+        forward = (np.float64(self.target) - self.position) * flip
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, np.float64(self.up) * flip)
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+
+        w, h = self.size
+        f = w / 2 / np.tan(np.radians(self.fov) / 2)
+        u, v = np.meshgrid((np.arange(w) + 0.5 - w / 2) / f, (np.arange(h) + 0.5 - h / 2) / f)
+        directions = forward + u[..., None] * right + v[..., None] * down
+        return directions * flip
+
+
+class BowlRenderer(ViewportRenderer):
+
+    """
+    `ViewportRenderer` that also renders `BowlViewpoint`s.
+    """
+
+    def __init__(self, viewports, camera_models, weights, layout=None, surface=None,
+                 max_angle=100, band_height=16):
+        """
+        surface: the `BowlSurface`, the default one if not given.
+        max_angle: points further than this many degrees from the optical
+            axis of a camera are not taken from it.
+        """
+        layout = layout if layout is not None else settings.default_layout
+        self.surface = surface if surface is not None else BowlSurface(layout)
+        self.max_angle = np.radians(max_angle)
+        self.poses = [camera_pose(model, offset)
+                      for model, offset in zip(camera_models, canvas_offsets(layout))]
+        super(BowlRenderer, self).__init__(viewports, camera_models, weights, layout,
+                                           band_height)
+
+    def build_tables(self, viewport):
+        if isinstance(viewport, BowlViewpoint):
+            return self.build_bowl_tables(viewport)
+        return super(BowlRenderer, self).build_tables(viewport)
+
+    def build_bowl_tables(self, viewport):
+        (x, y, h), hit = self.surface.intersect(viewport.position, viewport.rays())
+        # the cameras are blended as in the birdview below each point
+        weights, car_region = self.region_weights(x, y)
+        maps = []
+        for k, (model, (G, up, _)) in enumerate(zip(self.camera_models, self.poses)):
+            X, Y, Z = [G[i, 0] * x + G[i, 1] * y + G[i, 2] + up[i] * h for i in range(3)]
+            mapx, mapy, theta = model.camera_to_raw(X, Y, Z)
+            width, height = model.resolution
+            seen = hit & (theta < self.max_angle) & (mapx >= 0) & (mapx <= width - 1) & \
+                (mapy >= 0) & (mapy <= height - 1)
+            weights[k] = weights[k] * seen
+            maps.append((mapx, mapy))
+
+        # where one camera of a corner does not see the point the other one
+        # takes all of it
+        total = sum(weights)
+        for weight in weights:
+            np.divide(weight, total, out=weight, where=total > 0)
+
+        layers = [self.make_layer(k, mapx, mapy, weight)
+                  for k, ((mapx, mapy), weight) in enumerate(zip(maps, weights))
+                  if np.any(weight > 0)]
+        return layers, self.make_car_layer(x, y, car_region & hit)
@@ -0,0 +1,371 @@
+"""
+Chessboard detection for camera calibration.
+
+`findChessboardCorners` with adaptive threshold and normalization is far too
+slow to run on full resolution frames in the display loop. `detect_corners`
+looks for the board on a downscaled copy of the frame first, which also
+rejects frames without a board quickly, and only refines the corners it
+found with `cornerSubPix` on the full resolution image. `CornerCollector`
+runs it on a pool of worker processes and keeps only the views whose pose
+differs enough from the ones already collected.
+
+For offline calibration, `detect_source` finds the boards in a recorded
+video or a folder of images and caches them on disk, `select_views` picks a
+well spread subset of them and `calibrate_camera` runs the calibration.
+"""
+import os
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import numpy as np
+import cv2
+
+
+DETECT_FLAGS = (cv2.CALIB_CB_ADAPTIVE_THRESH +
+                cv2.CALIB_CB_NORMALIZE_IMAGE +
+                cv2.CALIB_CB_FILTER_QUADS)
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def make_grid_points(grid_size):
+    """
+    Object points of a chessboard with `grid_size` = (columns, rows) inner
+    corners, in units of squares, shape (1, columns * rows, 3).
+    """
+    grid_points = np.zeros((1, np.prod(grid_size), 3), np.float32)
+    grid_points[0, :, :2] = np.indices(grid_size).T.reshape(-1, 2)
+    return grid_points
+
+
+def detect_corners(image, grid_size, max_size=640):
+    """
+    Find the inner corners of a chessboard in a BGR or gray image.
+
+    The board is searched on a copy of the image downscaled so that its
+    longer side is at most `max_size` (0 to disable), with a fast check that
+    gives up early on frames without a board. The corners found are scaled
+    back and refined on the full resolution image.
+
+    Returns the corners as an array of shape (N, 1, 2) or None.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    scale = 1.0
+    if max_size > 0 and max(w, h) > max_size:
+        scale = max_size / float(max(w, h))
+        small = cv2.resize(gray, (int(round(w * scale)), int(round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+
+    found, corners = cv2.findChessboardCorners(small, grid_size,
+                                               DETECT_FLAGS + cv2.CALIB_CB_FAST_CHECK)
+    if not found:
+        return None
+
+    corners = corners / scale
+    # the corners of the downscaled image are off by up to about one of its
+    # pixels, the search window must cover that at full resolution
+    win = max(5, int(np.ceil(2 / scale)))
+    cv2.cornerSubPix(gray, corners, (win, win), (-1, -1), SUBPIX_CRITERIA)
+    return corners
+
+
+def pose_distance(corners1, corners2, image_size):
+    """
+    Mean distance between the corresponding corners of two views, relative
+    to the diagonal of the image.
+    """
+    diagonal = np.hypot(*image_size)
+    return np.linalg.norm(corners1 - corners2, axis=-1).mean() / diagonal
+
+
+def _init_worker():
+    # every worker is one process, do not let OpenCV start a pool in each
+    cv2.setNumThreads(1)
+
+
+def _ready():
+    return True
+
+
+class CornerCollector(object):
+
+    """
+    Collects chessboard views from a stream of frames.
+
+    Frames are handed to `submit` and detected on worker processes, frames
+    that arrive while all workers are busy are dropped, so the caller is
+    never blocked and views are collected at the rate the workers can keep
+    up with. `poll` returns the finished detections, a view is kept only
+    if it is at least `min_distance` away from every view kept so far.
+
+    The worker processes are started in the constructor: on linux they are
+    forked, so create the collector before starting any capture thread.
+    """
+
+    def __init__(self, grid_size, workers=None, max_size=640, min_distance=0.02,
+                 max_pending=None):
+        """
+        grid_size: (columns, rows) inner corners of the chessboard.
+        workers: number of worker processes, defaults to the number of cores.
+        max_size: longer side of the downscaled image the board is searched
+            on, see `detect_corners`.
+        min_distance: minimum `pose_distance` between two kept views, 0 to
+            keep every view.
+        max_pending: number of frames that may wait for a worker, defaults
+            to twice the number of workers.
+        """
+        self.grid_size = tuple(grid_size)
+        self.grid_points = make_grid_points(self.grid_size)
+        self.max_size = max_size
+        self.min_distance = min_distance
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        self.max_pending = max_pending if max_pending is not None else 2 * self.workers
+        self.pending = deque()
+        self.image_size = None
+        self.views = []
+        self.submitted_count = 0
+        self.dropped_count = 0
+        self.detected_count = 0
+        self.duplicate_count = 0
+        # fork the workers now
+        self.executor.submit(_ready).result()
+
+    def submit(self, image):
+        """
+        Queue a frame for detection. Returns False if it was dropped because
+        the workers are busy.
+        """
+        if len(self.pending) >= self.max_pending:
+            self.dropped_count += 1
+            return False
+
+        if image.ndim == 3:
+            # only a third of the data has to be sent to the worker
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        self.image_size = (image.shape[1], image.shape[0])
+        self.pending.append(self.executor.submit(detect_corners, image, self.grid_size,
+                                                 self.max_size))
+        self.submitted_count += 1
+        return True
+
+    def poll(self, wait=False):
+        """
+        Collect the finished detections in submission order, all of them if
+        `wait` is true. Returns a list of (corners, kept) for the frames in
+        which a board was found.
+        """
+        results = []
+        while len(self.pending) > 0 and (wait or self.pending[0].done()):
+            corners = self.pending.popleft().result()
+            if corners is None:
+                continue
+            self.detected_count += 1
+            kept = self.add_view(corners)
+            results.append((corners, kept))
+        return results
+
+    def add_view(self, corners):
+        """
+        Keep the view unless it is too close to one already kept.
+        """
+        if self.min_distance > 0:
+            for view in self.views:
+                if pose_distance(corners, view, self.image_size) < self.min_distance:
+                    self.duplicate_count += 1
+                    return False
+        self.views.append(corners)
+        return True
+
+    @property
+    def image_points(self):
+        return list(self.views)
+
+    @property
+    def object_points(self):
+        return [self.grid_points] * len(self.views)
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+
+def read_frames(path, framestep=1):
+    """
+    Yield (index, image) for every `framestep`-th frame of a video file or
+    of the images of a directory, in file name order. Skipped video frames
+    are not decoded.
+    """
+    if os.path.isdir(path):
+        files = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        for index in range(0, len(files), framestep):
+            image = cv2.imread(os.path.join(path, files[index]))
+            if image is not None:
+                yield index, image
+        return
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError("Cannot open video: {}".format(path))
+    index = 0
+    try:
+        while cap.grab():
+            if index % framestep == 0:
+                ok, image = cap.retrieve()
+                if ok:
+                    yield index, image
+            index += 1
+    finally:
+        cap.release()
+
+
+def cache_file(cache_dir, path, grid_size, framestep, max_size):
+    """
+    The file the detections of `path` are cached in. The name depends on the
+    detection settings and on the size and modification time of the input,
+    so a recording that is replaced is detected again.
+    """
+    stat = os.stat(path)
+    if os.path.isdir(path):
+        # the directory mtime only changes when images are added or removed,
+        # the newest image and the total size catch images replaced in place
+        images = [entry.stat() for entry in os.scandir(path)
+                  if entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+        size = "{}/{}/{}".format(len(images), sum(s.st_size for s in images),
+                                 max([s.st_mtime_ns for s in images], default=0))
+    else:
+        size = stat.st_size
+    key = "{}|{}|{}|{}|{}|{}".format(os.path.abspath(path), size, stat.st_mtime,
+                                     tuple(grid_size), framestep, max_size)
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    return os.path.join(cache_dir, "{}-{}.npz".format(
+        name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def detect_source(path, grid_size, framestep=1, max_size=640, cache_dir=None):
+    """
+    Detect the chessboard in every `framestep`-th frame of a video or image
+    directory, see `detect_corners`. With `cache_dir` the result is read
+    from, or written to, a file in that directory.
+
+    Returns (image_size, frame_indices, corners, frames_read, cached) where
+    `corners` has one (N, 1, 2) array per frame in which a board was found.
+    """
+    filename = None
+    if cache_dir is not None:
+        filename = cache_file(cache_dir, path, grid_size, framestep, max_size)
+        if os.path.isfile(filename):
+            try:
+                with np.load(filename) as data:
+                    return (tuple(int(x) for x in data["image_size"]),
+                            list(data["frame_indices"]), list(data["corners"]),
+                            int(data["frames_read"]), True)
+            except Exception:
+                # e.g. left half written by a killed run, detected again
+                os.remove(filename)
+
+    image_size = None
+    frame_indices = []
+    corners = []
+    frames_read = 0
+    for index, image in read_frames(path, framestep):
+        frames_read += 1
+        image_size = (image.shape[1], image.shape[0])
+        found = detect_corners(image, grid_size, max_size)
+        if found is not None:
+            frame_indices.append(index)
+            corners.append(found)
+
+    if image_size is None:
+        raise IOError("No frames read from {}".format(path))
+
+    if filename is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        n = np.prod(grid_size)
+        # written aside and renamed, so an interrupted run leaves no partial file
+        with open(filename + ".tmp", "wb") as f:
+            np.savez(f,
+                     image_size=np.int32(image_size),
+                     frame_indices=np.int32(frame_indices),
+                     corners=np.float32(corners).reshape(-1, n, 1, 2),
+                     frames_read=frames_read)
+        os.replace(filename + ".tmp", filename)
+    return image_size, frame_indices, corners, frames_read, False
+
+
+def select_views(views, image_size, count):
+    """
+    Indices of at most `count` views that are spread over the poses: the
+    first view, then repeatedly the view farthest (in `pose_distance`) from
+    all views selected so far.
+    """
+    if len(views) <= count:
+        return list(range(len(views)))
+
+    points = np.float32(views).reshape(len(views), -1, 2)
+    diagonal = np.hypot(*image_size)
+    selected = [0]
+    # distance of every view to the nearest selected one
+    nearest = np.linalg.norm(points - points[0], axis=-1).mean(axis=1) / diagonal
+    while len(selected) < count:
+        k = int(np.argmax(nearest))
+        selected.append(k)
+        distance = np.linalg.norm(points - points[k], axis=-1).mean(axis=1) / diagonal
+        nearest = np.minimum(nearest, distance)
+    return sorted(selected)
+
+
+def calibrate_camera(image_points, grid_points, image_size, fisheye=True, max_retries=10):
+    """
+    Calibrate a camera from the corners of several views of the same board.
+
+    For fisheye cameras, views that OpenCV reports as ill conditioned are
+    removed and the calibration is run again, up to `max_retries` times.
+
+    Returns (rms, camera_matrix, dist_coeffs, views_used).
+    """
+    image_points = list(image_points)
+    if not fisheye:
+        rms, K, D, _, _ = cv2.calibrateCamera([grid_points] * len(image_points),
+                                              image_points, image_size, None, None)
+        return rms, K, D, len(image_points)
+
+    flags = (cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC +
+             cv2.fisheye.CALIB_CHECK_COND +
+             cv2.fisheye.CALIB_FIX_SKEW)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-6)
+    for _ in range(max_retries + 1):
+        object_points = [grid_points] * len(image_points)
+        try:
+            rms, K, D, _, _ = cv2.fisheye.calibrate(object_points, image_points, image_size,
+                                                    np.zeros((3, 3)), np.zeros((4, 1)),
+                                                    flags=flags, criteria=criteria)
+            return rms, K, D, len(image_points)
+        except cv2.error as e:
+            # "CALIB_CHECK_COND - Ill-conditioned matrix for input array 12"
+            match = re.search(r"input array (\d+)", str(e))
+            if match is None or len(image_points) <= 1:
+                raise
+            del image_points[int(match.group(1))]
+    raise RuntimeError("Calibration is ill conditioned after removing {} views".format(
+        max_retries))
+
+
+def save_camera_params(filename, image_size, camera_matrix, dist_coeffs):
+    """
+    Write the intrinsics in the format `FisheyeCameraModel` reads.
+    """
+    fs = cv2.FileStorage(filename, cv2.FILE_STORAGE_WRITE)
+    fs.write("resolution", np.int32(image_size))
+    fs.write("camera_matrix", camera_matrix)
+    fs.write("dist_coeffs", dist_coeffs)
+    fs.release()
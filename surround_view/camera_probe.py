@@ -0,0 +1,293 @@
+"""
+Discovery of the USB cameras of the machine.
+
+Only the /dev/videoN nodes that exist are probed, each in a process of its
+own and all at the same time, and a probe that has not finished after
+`timeout` seconds is killed: a bad device can block `cv2.VideoCapture` for
+a long time, and it cannot be interrupted from a thread.
+
+A probe tries every (fourcc, resolution) pair of the candidates and keeps
+those the driver accepts as they are, then measures the frame rate of the
+largest mode. The results are cached under the /dev/v4l/by-path name of the
+device, which only depends on the port the camera is plugged into, and are
+reused as long as the same camera (name of the video4linux device) is on
+that port. `CameraInfo.make_source` opens the camera in the probed mode, so
+bringing up the pipeline does not probe again.
+"""
+import os
+import re
+import glob
+import json
+import time
+import multiprocessing
+from queue import Empty
+import cv2
+
+from .capture_source import V4L2Source
+
+
+CANDIDATE_RESOLUTIONS = [(640, 480), (960, 640), (1280, 720), (1920, 1080)]
+CANDIDATE_FOURCCS = ("MJPG", "YUYV")
+
+
+def fourcc_name(value):
+    value = int(value)
+    return "".join(chr((value >> (8 * i)) & 0xFF) for i in range(4))
+
+
+def device_name(device):
+    """
+    Name of the video4linux device, e.g. the model of a USB camera, "" if
+    it is not known.
+    """
+    path = "/sys/class/video4linux/{}/name".format(os.path.basename(device))
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return ""
+
+
+def list_video_devices():
+    """
+    The (index, device, by-path name) of the /dev/videoN nodes, the by-path
+    name is None for devices that have none.
+    """
+    by_path = {}
+    for link in glob.glob("/dev/v4l/by-path/*"):
+        by_path[os.path.realpath(link)] = os.path.basename(link)
+    devices = []
+    for device in glob.glob("/dev/video*"):
+        match = re.match(r"video(\d+)$", os.path.basename(device))
+        if match is not None:
+            devices.append((int(match.group(1)), device, by_path.get(device)))
+    return sorted(devices)
+
+
+class CameraInfo(object):
+
+    def __init__(self, index, device=None, by_path=None):
+        """
+        index: the N of /dev/videoN, as passed to `cv2.VideoCapture`.
+        device: the device node, by_path: its /dev/v4l/by-path name.
+        """
+        self.index = index
+        self.device = device
+        self.by_path = by_path
+        self.name = device_name(device) if device is not None else ""
+        self.ok = False
+        # (fourcc, width, height) accepted by the driver
+        self.modes = []
+        # the mode frames were read in and their measured rate
+        self.fourcc = None
+        self.resolution = None
+        self.fps = 0.0
+        self.error = None
+        self.probe_time = 0.0
+        self.cached = False
+
+    def __repr__(self):
+        return "CameraInfo({}, {!r}, ok={}, mode={} {}, fps={:.1f})".format(
+            self.index, self.by_path or self.device, self.ok, self.fourcc, self.resolution,
+            self.fps)
+
+    def to_dict(self):
+        return {"index": self.index, "device": self.device, "by_path": self.by_path,
+                "name": self.name, "ok": self.ok, "modes": [list(m) for m in self.modes],
+                "fourcc": self.fourcc, "fps": self.fps, "error": self.error,
+                "resolution": list(self.resolution) if self.resolution is not None else None,
+                "probe_time": self.probe_time}
+
+    @classmethod
+    def from_dict(cls, d):
+        info = cls(d["index"], None, d["by_path"])
+        info.device = d["device"]
+        info.name = d["name"]
+        info.ok = d["ok"]
+        info.modes = [tuple(m) for m in d["modes"]]
+        info.fourcc = d["fourcc"]
+        info.resolution = tuple(d["resolution"]) if d["resolution"] is not None else None
+        info.fps = d["fps"]
+        info.error = d["error"]
+        info.probe_time = d["probe_time"]
+        return info
+
+    def make_source(self, framerate=0):
+        """
+        A `V4L2Source` opening the camera in the probed mode, for the
+        `source` of a `CaptureThread`.
+        """
+        return V4L2Source(self.index, resolution=self.resolution, framerate=framerate,
+                          fourcc=self.fourcc or "MJPG")
+
+
+def probe_camera(info, resolutions=CANDIDATE_RESOLUTIONS, fourccs=CANDIDATE_FOURCCS,
+                 frames=15):
+    """
+    Fill `info` with the modes of the camera and the frame rate measured
+    over `frames` (at least 2) frames of its largest mode. Blocks as long
+    as the camera does, see `probe_cameras`.
+    """
+    start = time.perf_counter()
+    # the index, as `V4L2Source` will open it
+    cap = cv2.VideoCapture(info.index)
+    try:
+        if not cap.isOpened():
+            info.error = "cannot open"
+            return info
+
+        for fourcc in fourccs:
+            for width, height in resolutions:
+                cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+                cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+                mode = (fourcc_name(cap.get(cv2.CAP_PROP_FOURCC)),
+                        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                        int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                if mode == (fourcc, width, height):
+                    info.modes.append(mode)
+
+        if len(info.modes) > 0:
+            # the largest mode, in the first fourcc listed among equals
+            fourcc, width, height = max(info.modes, key=lambda m: (m[1] * m[2],
+                                                                   -fourccs.index(m[0])))
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+        # the first frames come late while the stream starts
+        stamps = []
+        for _ in range(frames + 2):
+            ret, frame = cap.read()
+            if not ret:
+                info.error = "cannot read frames"
+                return info
+            stamps.append(time.perf_counter())
+        info.ok = True
+        info.fourcc = fourcc_name(cap.get(cv2.CAP_PROP_FOURCC)).strip("\0") or None
+        info.resolution = (frame.shape[1], frame.shape[0])
+        info.fps = (len(stamps) - 3) / (stamps[-1] - stamps[2])
+        return info
+    finally:
+        cap.release()
+        info.probe_time = time.perf_counter() - start
+
+
+def _probe_worker(info, queue, kwargs):
+    queue.put(probe_camera(info, **kwargs).to_dict())
+
+
+class CameraCache(object):
+
+    """
+    A json file of the `CameraInfo` of the cameras that were probed
+    successfully, keyed by their /dev/v4l/by-path name. Devices without one
+    are not cached, their index can change at every boot.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                self.entries = {}
+
+    def load(self, info):
+        """
+        The cached `CameraInfo` of the camera `info` describes, with its
+        current index and device, or None if it is not cached or another
+        camera is on the port.
+        """
+        entry = self.entries.get(info.by_path) if info.by_path is not None else None
+        if entry is None or entry["name"] != info.name:
+            return None
+        cached = CameraInfo.from_dict(entry)
+        cached.index, cached.device = info.index, info.device
+        cached.cached = True
+        return cached
+
+    def save(self, infos):
+        for info in infos:
+            # a camera that failed may be busy or still starting, it is
+            # probed again next time
+            if info.by_path is not None and info.ok and not info.cached:
+                self.entries[info.by_path] = info.to_dict()
+        with open(self.filename, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+def probe_cameras(indices=None, timeout=5.0, cache=None, workers=None, **probe_options):
+    """
+    Probe the cameras concurrently, each in its own process.
+
+    indices: the N of the /dev/videoN to probe, all the existing ones by
+        default (0 to 23 without video4linux).
+    timeout: seconds after which the probe of a camera is killed and the
+        camera reported with the error "timed out".
+    cache: a `CameraCache`, cameras found in it are not probed and the new
+        results are saved into it.
+    workers: the most cameras probed at the same time, all by default.
+        Cameras on the same USB bus may not all stream at once.
+    probe_options: passed to `probe_camera`.
+
+    Returns the list of `CameraInfo`, in the order of the indices.
+    """
+    devices = {index: (device, by_path) for index, device, by_path in list_video_devices()}
+    video4linux = os.path.isdir("/sys/class/video4linux")
+    if indices is None:
+        indices = sorted(devices) if video4linux else list(range(24))
+    infos = [CameraInfo(index, *devices.get(index, (None, None))) for index in indices]
+
+    results = {}
+    todo = []
+    for info in infos:
+        cached = cache.load(info) if cache is not None else None
+        if cached is not None:
+            results[info.index] = cached
+        elif video4linux and info.index not in devices:
+            info.error = "no such device"
+            results[info.index] = info
+        else:
+            todo.append(info)
+
+    queue = multiprocessing.Queue()
+    workers = workers if workers is not None else max(len(todo), 1)
+    running = {}
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < workers:
+            info = todo.pop(0)
+            process = multiprocessing.Process(target=_probe_worker,
+                                              args=(info, queue, probe_options), daemon=True)
+            process.start()
+            running[info.index] = (info, process, time.perf_counter())
+
+        # the next result, or the first deadline
+        deadline = min(started + timeout for _, _, started in running.values())
+        try:
+            info = CameraInfo.from_dict(queue.get(timeout=max(deadline - time.perf_counter(),
+                                                              0.01)))
+            # a result may come in just after its probe was given up
+            if info.index in running:
+                running.pop(info.index)[1].join()
+                results[info.index] = info
+        except Empty:
+            pass
+
+        now = time.perf_counter()
+        for index, (info, process, started) in list(running.items()):
+            if now - started >= timeout:
+                # a process stuck in the driver may not even die, it is a
+                # daemon and is not waited for
+                process.terminate()
+                info.error = "timed out"
+                info.probe_time = now - started
+                results[index] = info
+                del running[index]
+
+    infos = [results[index] for index in indices]
+    if cache is not None:
+        cache.save(infos)
+    return infos
@@ -0,0 +1,320 @@
+import os
+import glob
+import time
+import numpy as np
+import cv2
+
+from .utils import gstreamer_pipeline, bgr_to_yuv, pack_yuv
+
+
+class CaptureSource(object):
+
+    """
+    Base class for all frame sources a `CaptureThread` can read from.
+
+    A source is opened once, then `read` is called in a loop. `read` accepts
+    an optional output array: if it has the right shape and dtype the frame
+    is written into it instead of allocating a new one.
+    """
+
+    def __init__(self, resolution=None, framerate=0):
+        """
+        resolution: frame resolution (width, height), `None` for the device default.
+        framerate: frames per second to pace the source at, 0 means as fast as possible.
+        """
+        self.resolution = resolution
+        self.framerate = framerate
+        self._last_time = None
+
+    def open(self):
+        raise NotImplementedError
+
+    def read(self, out=None):
+        """
+        Return a tuple (success, frame).
+        """
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def is_opened(self):
+        raise NotImplementedError
+
+    def wait_next_frame(self):
+        """
+        Sleep until the next frame is due if the source is paced.
+        """
+        if self.framerate <= 0:
+            return
+
+        period = 1.0 / self.framerate
+        now = time.perf_counter()
+        if self._last_time is not None:
+            delay = self._last_time + period - now
+            if delay > 0:
+                time.sleep(delay)
+                now = time.perf_counter()
+        self._last_time = now
+
+    @staticmethod
+    def copy_to(frame, out):
+        if out is not None and out.shape == frame.shape and out.dtype == frame.dtype:
+            np.copyto(out, frame)
+            return out
+        return frame
+
+
+class VideoCaptureSource(CaptureSource):
+
+    """
+    Source backed by a `cv2.VideoCapture` object.
+    """
+
+    def __init__(self, target, api_preference=cv2.CAP_ANY, resolution=None, framerate=0,
+                 fourcc="MJPG"):
+        """
+        fourcc: pixel format requested from the camera.
+        """
+        super(VideoCaptureSource, self).__init__(resolution, framerate)
+        self.target = target
+        self.api_preference = api_preference
+        self.fourcc = fourcc
+        self.cap = cv2.VideoCapture()
+
+    def open(self):
+        self.cap.open(self.target, self.api_preference)
+        if not self.cap.isOpened():
+            return False
+
+        if self.resolution is not None:
+            width, height = self.resolution
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            # some camera may become closed if the resolution is not supported
+            if not self.cap.isOpened():
+                return False
+        else:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+            width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self.resolution = (width, height)
+
+        return True
+
+    def read(self, out=None):
+        self.wait_next_frame()
+        if not self.cap.grab():
+            return False, None
+        return self.cap.retrieve(out)
+
+    def release(self):
+        self.cap.release()
+
+    def is_opened(self):
+        return self.cap.isOpened()
+
+
+class GStreamerSource(VideoCaptureSource):
+
+    """
+    Camera opened through a GStreamer pipeline, by default a csi camera.
+    """
+
+    def __init__(self, cam_id=0, flip_method=2, resolution=None, framerate=0,
+                 api_preference=cv2.CAP_GSTREAMER, **pipeline_options):
+        """
+        pipeline_options: extra keyword arguments for `utils.gstreamer_pipeline`,
+            e.g. source="videotestsrc" or drop=False.
+        """
+        pipeline = gstreamer_pipeline(cam_id=cam_id, flip_method=flip_method,
+                                      **pipeline_options)
+        super(GStreamerSource, self).__init__(pipeline, api_preference,
+                                              resolution, framerate)
+
+
+class V4L2Source(VideoCaptureSource):
+
+    """
+    USB camera opened by its device index, e.g. 0 for /dev/video0.
+    """
+
+    def __init__(self, device_index=0, resolution=None, framerate=0, fourcc="MJPG"):
+        super(V4L2Source, self).__init__(device_index, cv2.CAP_ANY, resolution, framerate, fourcc)
+
+
+class VideoFileSource(VideoCaptureSource):
+
+    """
+    Recorded video file, optionally looped and paced at its native frame rate.
+    """
+
+    def __init__(self, filename, loop=True, realtime=True, framerate=None):
+        super(VideoFileSource, self).__init__(filename, cv2.CAP_ANY, None, 0)
+        self.loop = loop
+        self.realtime = realtime
+        self.requested_framerate = framerate
+
+    def open(self):
+        if not os.path.isfile(self.target):
+            return False
+
+        self.cap.open(self.target, self.api_preference)
+        if not self.cap.isOpened():
+            return False
+
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.resolution = (width, height)
+        if self.requested_framerate is not None:
+            self.framerate = self.requested_framerate
+        elif self.realtime:
+            self.framerate = self.cap.get(cv2.CAP_PROP_FPS)
+        return True
+
+    def read(self, out=None):
+        self.wait_next_frame()
+        if not self.cap.grab():
+            if not self.loop:
+                return False, None
+            # rewind to the first frame and try again
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if not self.cap.grab():
+                return False, None
+        return self.cap.retrieve(out)
+
+
+class ImageSequenceSource(CaptureSource):
+
+    """
+    A folder of images (or a glob pattern) played back as a video stream.
+    """
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+    def __init__(self, pattern, loop=True, framerate=30, preload=False):
+        """
+        pattern: a directory or a glob pattern like "frames/front_*.png".
+        loop: restart from the first image after the last one.
+        preload: decode all images into memory when opened.
+        """
+        super(ImageSequenceSource, self).__init__(None, framerate)
+        self.pattern = pattern
+        self.loop = loop
+        self.preload = preload
+        self.files = []
+        self.cache = None
+        self.index = 0
+        self.opened = False
+
+    def open(self):
+        if os.path.isdir(self.pattern):
+            files = [os.path.join(self.pattern, f) for f in os.listdir(self.pattern)]
+            files = [f for f in files if f.lower().endswith(self.IMAGE_EXTENSIONS)]
+        else:
+            files = glob.glob(self.pattern)
+
+        self.files = sorted(files)
+        if len(self.files) == 0:
+            return False
+
+        first = cv2.imread(self.files[0])
+        if first is None:
+            return False
+
+        self.resolution = (first.shape[1], first.shape[0])
+        if self.preload:
+            self.cache = [cv2.imread(f) for f in self.files]
+        self.index = 0
+        self.opened = True
+        return True
+
+    def read(self, out=None):
+        self.wait_next_frame()
+        if self.index >= len(self.files):
+            if not self.loop:
+                return False, None
+            self.index = 0
+
+        if self.cache is not None:
+            frame = self.cache[self.index]
+        else:
+            frame = cv2.imread(self.files[self.index])
+        self.index += 1
+        if frame is None:
+            return False, None
+        if self.cache is not None and out is None:
+            # never hand out the cached image itself
+            frame = frame.copy()
+        return True, self.copy_to(frame, out)
+
+    def release(self):
+        self.cache = None
+        self.opened = False
+
+    def is_opened(self):
+        return self.opened
+
+
+class SyntheticSource(CaptureSource):
+
+    """
+    Generates frames in memory, for running the pipeline without any cameras.
+
+    The frame is a static background image (or a checkerboard pattern) with a
+    moving bar, so consecutive frames differ like a real video stream.
+    """
+
+    def __init__(self, resolution=(960, 640), framerate=30, background=None, seed=0,
+                 pixel_format="BGR"):
+        """
+        background: optional BGR image, resized to `resolution`.
+        seed: changes the pattern so that virtual cameras are distinguishable.
+        pixel_format: "BGR", or "NV12"/"I420" to generate single channel yuv frames.
+        """
+        super(SyntheticSource, self).__init__(resolution, framerate)
+        self.background = background
+        self.seed = seed
+        self.pixel_format = pixel_format
+        self.frame_index = 0
+        self.base = None
+
+    def open(self):
+        width, height = self.resolution
+        if self.background is not None:
+            self.base = cv2.resize(self.background, (width, height))
+        else:
+            cell = 40 + 8 * (self.seed % 4)
+            ys, xs = np.indices((height, width))
+            board = ((xs // cell + ys // cell) % 2).astype(np.uint8)
+            self.base = cv2.merge((board * 200 + 30,
+                                   board * 120 + 60,
+                                   np.uint8(ys * 255 // max(height - 1, 1))))
+
+        if self.pixel_format == "NV12":
+            self.base = pack_yuv(*bgr_to_yuv(self.base))
+        elif self.pixel_format == "I420":
+            self.base = cv2.cvtColor(self.base, cv2.COLOR_BGR2YUV_I420)
+        self.frame_index = 0
+        return True
+
+    def read(self, out=None):
+        self.wait_next_frame()
+        frame = self.copy_to(self.base, out)
+        if frame is self.base:
+            frame = self.base.copy()
+
+        width, height = self.resolution
+        bar = max(width // 32, 1)
+        x = (self.frame_index * 8 + self.seed * 97) % width
+        # for yuv frames only the luma plane is painted
+        frame[:height, x:x + bar] = 255
+        self.frame_index += 1
+        return True, frame
+
+    def release(self):
+        self.base = None
+
+    def is_opened(self):
+        return self.base is not None
@@ -1,9 +1,11 @@
+import sys
+import time
 import cv2
-from PyQt5.QtCore import qDebug
+from PyQt5.QtCore import qDebug, QMutexLocker
 
 from .base_thread import BaseThread
-from .structures import ImageFrame
-from .utils import gstreamer_pipeline
+from .structures import ImageFrame, CameraHealth
+from .capture_source import GStreamerSource, V4L2Source
 
 
 class CaptureThread(BaseThread):
@@ -15,6 +17,13 @@ class CaptureThread(BaseThread):
                  api_preference=cv2.CAP_GSTREAMER,
                  resolution=None,
                  use_gst=True,
+                 source=None,
+                 reuse_frames=False,
+                 pixel_format="BGR",
+                 max_read_failures=30,
+                 reconnect_interval=500,
+                 max_reconnect_interval=8000,
+                 stall_timeout=1000,
                  parent=None):
         """
         device_id: device number of the camera.
@@ -23,6 +32,17 @@ class CaptureThread(BaseThread):
         drop_if_full: drop the frame if buffer is full.
         api_preference: cv2.CAP_GSTREAMER for csi cameras, usually cv2.CAP_ANY would suffice.
         resolution: camera resolution (width, height).
+        source: an instance of `CaptureSource`, if given `flip_method`, `api_preference`
+            and `use_gst` are ignored and frames are read from this source.
+        reuse_frames: read frames into a pool of preallocated arrays instead of
+            allocating a new array for every frame.
+        pixel_format: "BGR", or "NV12"/"I420" to receive the yuv frames of the camera
+            without converting them to BGR.
+        max_read_failures: reopen the camera after this many failed reads in a row.
+        reconnect_interval, max_reconnect_interval: delay between two attempts
+            to reopen the camera in milliseconds, doubled after every failure.
+        stall_timeout: the camera is reported as stalled when no frame has
+            been read for this many milliseconds.
         """
         super(CaptureThread, self).__init__(parent)
         self.device_id = device_id
@@ -31,7 +51,22 @@ class CaptureThread(BaseThread):
         self.drop_if_full = drop_if_full
         self.api_preference = api_preference
         self.resolution = resolution
-        self.cap = cv2.VideoCapture()
+        self.source = source
+        self.reuse_frames = reuse_frames
+        self.pixel_format = pixel_format
+        self.frame_pool = []
+        self.pool_index = 0
+        # the pool array handed to the source for the frame being read
+        self.pool_slot = None
+        self.max_read_failures = max_read_failures
+        self.reconnect_interval = reconnect_interval
+        self.max_reconnect_interval = max_reconnect_interval
+        self.stall_timeout = stall_timeout
+        self.consecutive_failures = 0
+        self.reconnect_count = 0
+        self.reconnecting = False
+        self.retry_interval = reconnect_interval
+        self.last_frame_time = None
         # an instance of the MultiBufferManager object,
         # for synchronizing this thread with other cameras.
         self.buffer_manager = None
@@ -52,17 +87,34 @@ class CaptureThread(BaseThread):
             self.processing_time = self.clock.elapsed()
             # start timer (used to calculate capture rate)
             self.clock.start()
-
-            # synchronize with other streams (if enabled for this stream)
-            self.buffer_manager.sync(self.device_id)
-
-            if not self.cap.grab():
+            self.start_stages()
+
+            # synchronize with other streams (if enabled for this stream),
+            # a camera that fails to deliver frames does not hold back the others
+            if self.consecutive_failures == 0:
+                self.buffer_manager.sync(self.device_id)
+                self.end_stage("sync")
+
+            ret, frame = self.source.read(self.next_pool_frame())
+            self.end_stage("read")
+            if not ret:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.max_read_failures:
+                    self.reconnect()
                 continue
-
-            # retrieve frame and add it to buffer
-            _, frame = self.cap.retrieve()
-            img_frame = ImageFrame(self.clock.msecsSinceStartOfDay(), frame)
+            self.consecutive_failures = 0
+            self.retry_interval = self.reconnect_interval
+            self.last_frame_time = time.monotonic()
+
+            # add the frame to buffer
+            if self.reuse_frames:
+                self.recycle_pool_frame(frame)
+            img_frame = ImageFrame(self.clock.msecsSinceStartOfDay(), frame, self.pixel_format)
             self.buffer_manager.get_device(self.device_id).add(img_frame, self.drop_if_full)
+            if len(self.outputs) > 0:
+                # pooled frames are overwritten later, the outputs get a copy
+                self.submit_to_outputs(frame.copy() if self.reuse_frames else frame)
+            self.end_stage("deliver")
 
             # update statistics
             self.update_fps(self.processing_time)
@@ -72,44 +124,125 @@ class CaptureThread(BaseThread):
 
         qDebug("Stopping capture thread...")
 
-    def connect_camera(self):
-        if self.use_gst:
-            options = gstreamer_pipeline(cam_id=self.device_id, flip_method=self.flip_method)
-            self.cap.open(options, self.api_preference)
+    def is_stopping(self):
+        with QMutexLocker(self.stop_mutex):
+            return self.stopped
+
+    def reconnect(self):
+        """
+        Reopen the camera, retrying until it opens or the thread is stopped.
+        The delay before each attempt doubles until a frame is read again.
+        Meanwhile the thread does not take part in the synchronization, so
+        the other cameras are not held back.
+        """
+        self.reconnecting = True
+        while not self.is_stopping():
+            qDebug("Reconnecting camera {}...".format(self.device_id))
+            self.source.release()
+            self.msleep(self.retry_interval)
+            self.retry_interval = min(self.retry_interval * 2, self.max_reconnect_interval)
+            if self.source.open():
+                self.reconnect_count += 1
+                break
+
+        # the resolution may have changed
+        self.frame_pool = []
+        self.pool_index = 0
+        self.pool_slot = None
+        self.consecutive_failures = 0
+        self.reconnecting = False
+
+    def camera_health(self):
+        """
+        Return a `CameraHealth` snapshot, safe to call from any thread.
+        """
+        if self.last_frame_time is None:
+            frame_age = None
         else:
-            self.cap.open(self.device_id)
+            frame_age = int((time.monotonic() - self.last_frame_time) * 1000)
+
+        if self.reconnecting:
+            state = "reconnecting"
+        elif not self.is_camera_connected():
+            state = "disconnected"
+        elif frame_age is None or frame_age > self.stall_timeout:
+            state = "stalled"
+        else:
+            state = "ok"
+        return CameraHealth(self.device_id, state, frame_age,
+                            self.consecutive_failures, self.reconnect_count)
+
+    def next_pool_frame(self):
+        """
+        Return the preallocated array the next frame should be written into,
+        None if there is none free.
+
+        A frame may be dropped by the buffer, or held downstream for longer
+        than the buffer depth (e.g. the raw frames kept for the viewports),
+        so an array is only reused once nothing but the pool refers to it.
+        """
+        self.pool_slot = None
+        if not self.reuse_frames or len(self.frame_pool) == 0:
+            return None
+        for offset in range(len(self.frame_pool)):
+            index = (self.pool_index + offset) % len(self.frame_pool)
+            # one reference from the pool and one from the argument
+            if sys.getrefcount(self.frame_pool[index]) <= 2:
+                self.pool_index = index
+                self.pool_slot = self.frame_pool[index]
+                return self.pool_slot
+        return None
+
+    def recycle_pool_frame(self, frame):
+        if len(self.frame_pool) == 0:
+            # a few more arrays than the buffer holds, the pool grows when
+            # the frames are held longer downstream
+            pool_size = self.buffer_manager.get_device(self.device_id).maxsize() + 2
+            self.frame_pool = [frame.copy() for _ in range(pool_size)]
+        elif self.pool_slot is None:
+            # every array was still in use, the source allocated a new one
+            self.frame_pool.append(frame)
+            self.pool_index = len(self.frame_pool) - 1
+        elif frame is not self.pool_slot:
+            # the source could not write into the given array, e.g. the
+            # resolution has changed, so start a new pool.
+            self.frame_pool = []
+            self.pool_index = 0
+            self.pool_slot = None
+            return
+        self.pool_slot = None
+        self.pool_index = (self.pool_index + 1) % len(self.frame_pool)
+
+    def connect_camera(self):
+        if self.source is None:
+            if self.use_gst:
+                self.source = GStreamerSource(cam_id=self.device_id,
+                                              flip_method=self.flip_method,
+                                              resolution=self.resolution,
+                                              api_preference=self.api_preference,
+                                              output_format=self.pixel_format)
+            elif self.pixel_format != "BGR":
+                raise ValueError("{} frames require gstreamer or a custom source".format(
+                    self.pixel_format))
+            else:
+                self.source = V4L2Source(self.device_id, resolution=self.resolution)
+
         # return false if failed to open camera
-        if not self.cap.isOpened():
+        if not self.source.open():
             qDebug("Cannot open camera {}".format(self.device_id))
             return False
-        else:
-            # try to set camera resolution
-            if self.resolution is not None:
-                width, height = self.resolution
-                self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-                # some camera may become closed if the resolution is not supported
-                if not self.cap.isOpened():
-                    qDebug("Resolution not supported by camera device: {}".format(self.resolution))
-                    return False
-            # use the default resolution
-            else:
-                self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
-                width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                self.resolution = (width, height)
 
+        self.resolution = self.source.resolution
         return True
 
     def disconnect_camera(self):
         # disconnect camera if it's already opened.
-        if self.cap.isOpened():
-            self.cap.release()
+        if self.source is not None and self.source.is_opened():
+            self.source.release()
             return True
         # else do nothing and return
         else:
             return False
 
     def is_camera_connected(self):
-        return self.cap.isOpened()
+        return self.source is not None and self.source.is_opened()
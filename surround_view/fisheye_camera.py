@@ -1,8 +1,11 @@
 import os
+import sys
+import hashlib
 import numpy as np
 import cv2
 
 from . import param_settings as settings
+from . import utils
 
 
 class FisheyeCameraModel(object):
@@ -11,20 +14,45 @@ class FisheyeCameraModel(object):
     Fisheye camera model, for undistorting, projecting and flipping camera frames.
     """
 
-    def __init__(self, camera_param_file, camera_name):
+    def __init__(self, camera_param_file, camera_name, orientation=None, project_shape=None,
+                 layout=None):
+        """
+        orientation: how the camera is mounted, one of "front", "back", "left"
+            and "right", determines how the projected image is flipped.
+            Defaults to `camera_name`, must be given for other camera names.
+        project_shape: (width, height) of the projected image, defaults to
+            the one in `layout` for the orientation.
+        layout: a `param_settings.Layout`, `param_settings.default_layout` if
+            not given.
+        """
+        if layout is None:
+            layout = settings.default_layout
+
         if not os.path.isfile(camera_param_file):
             raise ValueError("Cannot find camera param file")
 
-        if camera_name not in settings.camera_names:
-            raise ValueError("Unknown camera name: {}".format(camera_name))
+        if orientation is None:
+            orientation = camera_name
+
+        if orientation not in layout.camera_names:
+            raise ValueError("Unknown camera orientation: {}".format(orientation))
 
         self.camera_file = camera_param_file
         self.camera_name = camera_name
+        self.orientation = orientation
+        self.layout = layout
         self.scale_xy = (1.0, 1.0)
         self.shift_xy = (0, 0)
         self.undistort_maps = None
+        self.chroma_undistort_maps = None
+        self.output_region = None
+        self.fused_rects = None
+        # the arrays `remap_fused` writes into, see `fused_output`
+        self.fused_outputs = []
         self.project_matrix = None
-        self.project_shape = settings.project_shapes[self.camera_name]
+        if project_shape is None:
+            project_shape = layout.project_shapes[orientation]
+        self.project_shape = tuple(project_shape)
         self.load_camera_params()
 
     def load_camera_params(self):
@@ -48,22 +76,51 @@ class FisheyeCameraModel(object):
         fs.release()
         self.update_undistort_maps()
 
-    def update_undistort_maps(self):
+    def get_new_camera_matrix(self):
         new_matrix = self.camera_matrix.copy()
         new_matrix[0, 0] *= self.scale_xy[0]
         new_matrix[1, 1] *= self.scale_xy[1]
         new_matrix[0, 2] += self.shift_xy[0]
         new_matrix[1, 2] += self.shift_xy[1]
+        return new_matrix
+
+    def update_undistort_maps(self):
         width, height = self.resolution
 
         self.undistort_maps = cv2.fisheye.initUndistortRectifyMap(
             self.camera_matrix,
             self.dist_coeffs,
             np.eye(3),
-            new_matrix,
+            self.get_new_camera_matrix(),
             (width, height),
             cv2.CV_16SC2
         )
+        # the chroma maps are only built if yuv frames are processed
+        self.chroma_undistort_maps = None
+        # the fused maps must be rebuilt with `set_output_region`
+        self.fused_rects = None
+        return self
+
+    def update_chroma_undistort_maps(self):
+        """
+        Undistort maps for the half resolution chroma plane of yuv frames.
+
+        They are the luma maps sampled at the centers of the 2x2 pixel blocks,
+        with the source coordinates converted to the chroma grid.
+        """
+        width, height = self.resolution
+        mapx, mapy = cv2.fisheye.initUndistortRectifyMap(
+            self.camera_matrix,
+            self.dist_coeffs,
+            np.eye(3),
+            self.get_new_camera_matrix(),
+            (width, height),
+            cv2.CV_32FC1
+        )
+        half = (width // 2, height // 2)
+        mapx = (cv2.resize(mapx, half, interpolation=cv2.INTER_AREA) - 0.5) / 2
+        mapy = (cv2.resize(mapy, half, interpolation=cv2.INTER_AREA) - 0.5) / 2
+        self.chroma_undistort_maps = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
         return self
 
     def set_scale_and_shift(self, scale_xy=(1.0, 1.0), shift_xy=(0, 0)):
@@ -81,19 +138,213 @@ class FisheyeCameraModel(object):
         result = cv2.warpPerspective(image, self.project_matrix, self.project_shape)
         return result
 
+    def undistort_yuv(self, y, uv):
+        """
+        Undistort the luma plane at full resolution and the chroma plane at
+        half resolution.
+        """
+        if self.chroma_undistort_maps is None:
+            self.update_chroma_undistort_maps()
+
+        y = cv2.remap(y, *self.undistort_maps, interpolation=cv2.INTER_LINEAR,
+                      borderMode=cv2.BORDER_CONSTANT)
+        uv = cv2.remap(uv, *self.chroma_undistort_maps, interpolation=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=(128, 128))
+        return y, uv
+
+    def project_yuv(self, y, uv):
+        # luma pixel x maps to chroma pixel (x - 0.5) / 2
+        A = np.array([[0.5, 0, -0.25], [0, 0.5, -0.25], [0, 0, 1]])
+        chroma_matrix = A.dot(self.project_matrix).dot(np.linalg.inv(A))
+        width, height = self.project_shape
+        y = cv2.warpPerspective(y, self.project_matrix, self.project_shape)
+        uv = cv2.warpPerspective(uv, chroma_matrix, (width // 2, height // 2),
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=(128, 128))
+        return y, uv
+
+    def flip_yuv(self, y, uv):
+        return self.flip(y), self.flip(uv)
+
     def flip(self, image):
-        if self.camera_name == "front":
+        if self.orientation == "front":
             return image.copy()
 
-        elif self.camera_name == "back":
-            return image.copy()[::-1, ::-1, :]
+        elif self.orientation == "back":
+            return image.copy()[::-1, ::-1]
 
-        elif self.camera_name == "left":
+        elif self.orientation == "left":
             return cv2.transpose(image)[::-1]
 
         else:
             return np.flip(cv2.transpose(image), 1)
 
+    def get_frame_shape(self):
+        """
+        (height, width) of the flipped frame.
+        """
+        width, height = self.project_shape
+        if self.orientation in ("front", "back"):
+            return (height, width)
+        return (width, height)
+
+    def set_output_region(self, region=None, band_height=16):
+        """
+        Build fused maps that undistort, project and flip a raw frame with a
+        single remap, restricted to the pixels of the flipped frame that are
+        actually used.
+
+        region: boolean array of the flipped frame shape, `None` for the
+            whole frame. It is covered with horizontal bands of `band_height`
+            rows, each band only spans the columns the region needs.
+        """
+        self.output_region = region
+        h, w = self.get_frame_shape()
+        if region is None:
+            region = np.ones((h, w), bool)
+
+        mapx, mapy = self.get_fused_maps()
+        fused_rects = []
+        for y0, y1, x0, x1 in utils.mask_to_rects(region, band_height):
+            map1, map2 = cv2.convertMaps(mapx[y0:y1, x0:x1], mapy[y0:y1, x0:x1], cv2.CV_16SC2)
+            fused_rects.append((y0, y1, x0, x1, map1, map2))
+        self.fused_rects = fused_rects
+        # the pixels outside of the new region must be black again
+        self.fused_outputs = []
+        return self
+
+    def get_fused_maps(self):
+        """
+        For every pixel of the flipped frame, the location of the pixel in
+        the raw camera frame that undistort + project + flip would sample.
+        Pixels outside of the undistorted image are mapped to (-1, -1).
+        """
+        h, w = self.get_frame_shape()
+        ys, xs = np.indices((h, w), np.float64)
+        return self.flipped_to_raw(xs, ys)
+
+    def flipped_to_raw(self, xs, ys):
+        """
+        Locations in the raw camera frame of the points (xs, ys) of the
+        flipped frame, as float32 maps for `cv2.remap`. Points outside of the
+        undistorted image are mapped to (-1, -1).
+        """
+        px, py = self.unflip_points(xs, ys)
+
+        # undo the projection
+        H = np.linalg.inv(self.project_matrix)
+        X = H[0, 0] * px + H[0, 1] * py + H[0, 2]
+        Y = H[1, 0] * px + H[1, 1] * py + H[1, 2]
+        Z = H[2, 0] * px + H[2, 1] * py + H[2, 2]
+        valid = Z != 0
+        Z = np.where(valid, Z, 1)
+        u = X / Z
+        v = Y / Z
+
+        width, height = self.resolution
+        valid &= (u >= 0) & (u <= width - 1) & (v >= 0) & (v <= height - 1)
+        mapx, mapy = self.undistorted_to_raw(u, v)
+        mapx[~valid] = -1
+        mapy[~valid] = -1
+        return mapx, mapy
+
+    def unflip_points(self, xs, ys):
+        """
+        Locations in the projected image of the points (xs, ys) of the
+        flipped frame.
+        """
+        h, w = self.get_frame_shape()
+        pw, ph = self.project_shape
+        if self.orientation == "front":
+            return xs, ys
+        elif self.orientation == "back":
+            return pw - 1 - xs, ph - 1 - ys
+        elif self.orientation == "left":
+            return h - 1 - ys, xs
+        else:
+            return ys, w - 1 - xs
+
+    def camera_to_raw(self, X, Y, Z):
+        """
+        Locations in the raw camera frame of points given in the coordinates
+        of the camera, as float32 maps, and their angles from the optical
+        axis. This is the model of `cv2.fisheye`, written out so that it also
+        holds for points more than 90 degrees away from the axis.
+        """
+        r = np.sqrt(X**2 + Y**2)
+        theta = np.arctan2(r, Z)
+        k1, k2, k3, k4 = np.ravel(self.dist_coeffs)
+        t2 = theta**2
+        theta_d = theta * (1 + t2 * (k1 + t2 * (k2 + t2 * (k3 + t2 * k4))))
+        scale = theta_d / np.maximum(r, 1e-12)
+        x, y = X * scale, Y * scale
+        K = self.camera_matrix
+        mapx = K[0, 0] * x + K[0, 1] * y + K[0, 2]
+        mapy = K[1, 1] * y + K[1, 2]
+        return mapx.astype(np.float32), mapy.astype(np.float32), theta
+
+    def undistorted_to_raw(self, u, v):
+        """
+        Locations in the raw camera frame of the points (u, v) of the
+        undistorted image, as float32 maps for `cv2.remap`.
+        """
+        new_matrix = self.get_new_camera_matrix()
+        normalized = np.stack(((u - new_matrix[0, 2]) / new_matrix[0, 0],
+                               (v - new_matrix[1, 2]) / new_matrix[1, 1]), axis=-1)
+        raw = cv2.fisheye.distortPoints(normalized.reshape(-1, 1, 2),
+                                        self.camera_matrix,
+                                        self.dist_coeffs).reshape(normalized.shape)
+        return raw[..., 0].astype(np.float32), raw[..., 1].astype(np.float32)
+
+    def fused_output(self, shape, dtype):
+        """
+        A preallocated array for the result of `remap_fused`. The results
+        are queued downstream, so an array is only reused once nothing but
+        the pool refers to it, a new one is added when they are all in use.
+        """
+        for result in self.fused_outputs:
+            # one reference from the pool, one from the loop and one from the argument
+            if sys.getrefcount(result) <= 3 and result.shape == shape and result.dtype == dtype:
+                return result
+        result = np.zeros(shape, dtype)
+        self.fused_outputs.append(result)
+        return result
+
+    def remap_fused(self, image):
+        """
+        Undistort, project and flip a frame with the maps built by
+        `set_output_region`. Pixels outside of the region are left black.
+        """
+        result = self.fused_output(self.get_frame_shape() + image.shape[2:], image.dtype)
+        for y0, y1, x0, x1, map1, map2 in self.fused_rects:
+            cv2.remap(image, map1, map2, dst=result[y0:y1, x0:x1],
+                      interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        return result
+
+    def pixels_per_frame(self):
+        """
+        Return (pixels computed by undistort + project, pixels computed by the fused maps).
+        """
+        width, height = self.resolution
+        pw, ph = self.project_shape
+        default = int(width * height + pw * ph)
+        if self.fused_rects is None:
+            return default, default
+        fused = sum((y1 - y0) * (x1 - x0) for y0, y1, x0, x1, _, _ in self.fused_rects)
+        return default, int(fused)
+
+    def projection_key(self):
+        """
+        A digest of everything that determines the projected and flipped
+        image of the camera.
+        """
+        h = hashlib.sha1()
+        for value in (self.camera_matrix, self.dist_coeffs, self.resolution,
+                      self.project_matrix, self.scale_xy, self.shift_xy):
+            if value is not None:
+                h.update(np.ascontiguousarray(value, np.float64).data)
+        h.update("{}|{}".format(self.project_shape, self.orientation).encode())
+        return h.hexdigest()
+
     def save_data(self):
         fs = cv2.FileStorage(self.camera_file, cv2.FILE_STORAGE_WRITE)
         fs.write("camera_matrix", self.camera_matrix)
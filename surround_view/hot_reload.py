@@ -0,0 +1,176 @@
+import os
+import copy
+from PyQt5.QtCore import qDebug, QMutex, QMutexLocker
+
+from .base_thread import BaseThread
+from .fisheye_camera import FisheyeCameraModel
+from .birdview import read_weights_and_masks, make_yuv_weights
+
+
+class CalibrationReloader(BaseThread):
+
+    """
+    Thread that reloads the camera parameters, weights and masks while the
+    pipeline keeps running.
+
+    It watches the yaml files of the processing threads and the weights/masks
+    images, or reloads on demand when `request_reload` is called. The new
+    undistort maps, weights and masks are built in this thread and then
+    swapped into the processing threads and the birdview between two frames,
+    so no frame is dropped.
+    """
+
+    def __init__(self,
+                 process_threads,
+                 birdview=None,
+                 weights_image=None,
+                 masks_image=None,
+                 watch_files=True,
+                 interval=1000,
+                 parent=None):
+        """
+        process_threads: a list of `CameraProcessingThread` objects.
+        birdview: the `BirdView` object whose weights and masks are reloaded.
+        weights_image, masks_image: the images read by `BirdView.load_weights_and_masks`.
+        watch_files: reload when any of the files is modified.
+        interval: how often the files are checked, in milliseconds.
+        """
+        super(CalibrationReloader, self).__init__(parent)
+        self.process_threads = process_threads
+        self.birdview = birdview
+        self.weights_image = weights_image
+        self.masks_image = masks_image
+        self.watch_files = watch_files
+        self.interval = interval
+        self.request_mutex = QMutex()
+        self.requested = False
+        self.reload_count = 0
+        self.mtimes = {}
+        for path in self.watched_files():
+            self.mtimes[path] = self.get_mtime(path)
+
+    def watched_files(self):
+        files = [td.camera_model.camera_file for td in self.process_threads]
+        if self.birdview is not None and self.weights_image is not None:
+            files += [self.weights_image, self.masks_image]
+        return [path for path in files if path is not None]
+
+    @staticmethod
+    def get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def request_reload(self):
+        """
+        Reload everything at the next check, regardless of the file times.
+        """
+        with QMutexLocker(self.request_mutex):
+            self.requested = True
+
+    def changed_files(self):
+        with QMutexLocker(self.request_mutex):
+            requested = self.requested
+            self.requested = False
+
+        changed = []
+        for path in self.watched_files():
+            mtime = self.get_mtime(path)
+            if requested or (self.watch_files and mtime != self.mtimes.get(path)):
+                changed.append(path)
+            self.mtimes[path] = mtime
+        return changed
+
+    def reload_camera(self, thread):
+        old_model = thread.camera_model
+        try:
+            model = FisheyeCameraModel(old_model.camera_file,
+                                       old_model.camera_name,
+                                       old_model.orientation,
+                                       old_model.project_shape,
+                                       old_model.layout)
+            if old_model.chroma_undistort_maps is not None:
+                model.update_chroma_undistort_maps()
+            if old_model.fused_rects is not None:
+                model.set_output_region(old_model.output_region)
+        except Exception as e:
+            # the file may be empty or half written (cv2.FileStorage raises
+            # SystemError then), keep the current model until it changes again
+            qDebug("Cannot reload {}: {}".format(old_model.camera_file, e))
+            return False
+
+        thread.set_camera_model(model)
+        return True
+
+    def reload_weights_and_masks(self):
+        try:
+            weights, masks = read_weights_and_masks(self.weights_image, self.masks_image,
+                                                    self.birdview.compact_weights)
+            yuv_weights = None
+            if self.birdview.pixel_format != "BGR":
+                yuv_weights = make_yuv_weights(weights)
+
+            # cropped cameras must cover the pixels used with the new weights,
+            # the running models are left alone and copies cropped to the
+            # new regions are swapped in with the weights
+            models = []
+            if self.birdview.rig is None:
+                regions = self.birdview.get_camera_regions(weights, masks)
+                for td in self.process_threads:
+                    if td.camera_model.fused_rects is not None:
+                        model = copy.copy(td.camera_model)
+                        model.set_output_region(regions[model.camera_name])
+                        models.append((td, model))
+        except Exception as e:
+            # a half written npz raises BadZipFile or EOFError, keep the
+            # current weights until the files change again
+            qDebug("Cannot reload weights and masks: {}".format(e))
+            return False
+
+        for td, model in models:
+            td.set_camera_model(model)
+        self.birdview.set_weights_and_masks(weights, masks, yuv_weights)
+        return True
+
+    def reload(self, changed):
+        reloaded = False
+        for td in self.process_threads:
+            if td.camera_model.camera_file in changed:
+                reloaded = self.reload_camera(td) or reloaded
+
+        if self.birdview is not None and (self.weights_image in changed or
+                                          (self.masks_image is not None and
+                                           self.masks_image in changed)):
+            reloaded = self.reload_weights_and_masks() or reloaded
+
+        # the tables of the viewports are made from the models and weights
+        if reloaded and self.birdview is not None and self.birdview.viewport_renderer is not None:
+            self.birdview.set_viewports(self.birdview.viewports,
+                                        [td.camera_model for td in self.process_threads],
+                                        self.birdview.bowl_surface)
+        return reloaded
+
+    def run(self):
+        while True:
+            self.stop_mutex.lock()
+            if self.stopped:
+                self.stopped = False
+                self.stop_mutex.unlock()
+                break
+            self.stop_mutex.unlock()
+
+            self.msleep(self.interval)
+            changed = self.changed_files()
+            if len(changed) == 0:
+                continue
+
+            self.clock.start()
+            if self.reload(changed):
+                self.reload_count += 1
+                self.processing_time = self.clock.elapsed()
+                self.stat_data.frames_processed_count += 1
+                qDebug("Reloaded {} in {} ms".format(changed, self.processing_time))
+                self.update_statistics_gui.emit(self.stat_data)
+
+        qDebug("Stopping calibration reloader...")
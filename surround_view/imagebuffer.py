@@ -1,5 +1,5 @@
 from PyQt5.QtCore import QSemaphore, QMutex
-from PyQt5.QtCore import QMutexLocker, QWaitCondition
+from PyQt5.QtCore import QMutexLocker, QWaitCondition, qDebug
 from queue import Queue
 
 
@@ -15,6 +15,10 @@ class Buffer(object):
         self.queue = Queue(self.buffer_size)
 
     def add(self, data, drop_if_full=False):
+        """
+        Return False if the item was dropped because the buffer is full.
+        """
+        added = True
         self.clear_buffer_add.acquire()
         if drop_if_full:
             if self.free_slots.tryAcquire():
@@ -22,6 +26,8 @@ class Buffer(object):
                 self.queue.put(data)
                 self.queue_mutex.unlock()
                 self.used_slots.release()
+            else:
+                added = False
         else:
             self.free_slots.acquire()
             self.queue_mutex.lock()
@@ -30,11 +36,20 @@ class Buffer(object):
             self.used_slots.release()
 
         self.clear_buffer_add.release()
+        return added
 
-    def get(self):
+    def get(self, timeout=None):
+        """
+        Wait for an item, if `timeout` (in milliseconds) is given return None
+        when no item arrives in time.
+        """
         # acquire semaphores
         self.clear_buffer_get.acquire()
-        self.used_slots.acquire()
+        if timeout is None:
+            self.used_slots.acquire()
+        elif not self.used_slots.tryAcquire(1, int(timeout)):
+            self.clear_buffer_get.release()
+            return None
         self.queue_mutex.lock()
         data = self.queue.get()
         self.queue_mutex.unlock()
@@ -87,28 +102,125 @@ class Buffer(object):
         return self.queue.qsize() == 0
 
 
+class SyncBarrier(object):
+
+    """
+    Barrier for the threads of several cameras, every thread calls `sync`
+    once per frame and waits until the threads of all the other cameras
+    have called it too.
+
+    With a timeout, a camera that does not arrive in time is marked as
+    stalled and left out of the following rounds, so the other cameras keep
+    their frame rate. It joins again the next time its thread calls `sync`.
+    """
+
+    def __init__(self, timeout=None, on_release=None):
+        """
+        timeout: how long to wait for the other cameras, in milliseconds,
+            `None` to wait forever.
+        on_release: called with the set of stalled devices, while the lock is
+            held, every time a round completes.
+        """
+        self.timeout = timeout
+        self.on_release = on_release
+        self.mutex = QMutex()
+        self.wc = QWaitCondition()
+        self.devices = set()
+        self.stalled = set()
+        self.arrived = set()
+        self.generation = 0
+
+    def add_device(self, device_id):
+        with QMutexLocker(self.mutex):
+            self.devices.add(device_id)
+
+    def remove_device(self, device_id):
+        with QMutexLocker(self.mutex):
+            self.devices.discard(device_id)
+            self.stalled.discard(device_id)
+            self.arrived.discard(device_id)
+            if len(self.arrived) > 0 and self.arrived >= self.devices - self.stalled:
+                self.release()
+
+    def __contains__(self, device_id):
+        return device_id in self.devices
+
+    def stalled_devices(self):
+        with QMutexLocker(self.mutex):
+            return set(self.stalled)
+
+    def release(self):
+        if self.on_release is not None:
+            self.on_release(set(self.stalled))
+        self.arrived = set()
+        self.generation += 1
+        self.wc.wakeAll()
+
+    def sync(self, device_id, wait=True):
+        """
+        Returns False if the round was completed without some of the cameras.
+        """
+        with QMutexLocker(self.mutex):
+            if device_id not in self.devices:
+                return True
+            if device_id in self.stalled:
+                self.stalled.discard(device_id)
+                qDebug("Device {} is back in sync".format(device_id))
+
+            self.arrived.add(device_id)
+            if not wait or self.arrived >= self.devices - self.stalled:
+                self.release()
+                return len(self.stalled) == 0
+
+            generation = self.generation
+            while generation == self.generation:
+                if self.timeout is None:
+                    self.wc.wait(self.mutex)
+                elif not self.wc.wait(self.mutex, int(self.timeout)) and \
+                        generation == self.generation:
+                    missing = self.devices - self.stalled - self.arrived
+                    qDebug("Devices {} stalled, continuing without them".format(missing))
+                    self.stalled |= missing
+                    self.release()
+            return len(self.stalled) == 0
+
+    def wake_all(self):
+        """
+        Release the threads waiting in `sync`, e.g. when stopping.
+        """
+        with QMutexLocker(self.mutex):
+            self.arrived = set()
+            self.generation += 1
+            self.wc.wakeAll()
+
+
 class MultiBufferManager(object):
 
     """
     Class for synchronizing capture threads from different cameras.
     """
 
-    def __init__(self, do_sync=True):
-        self.sync_devices = set()
+    def __init__(self, do_sync=True, sync_timeout=1000):
+        """
+        sync_timeout: how long a capture thread waits for the other cameras,
+            in milliseconds. A camera that stalls for longer is left out of
+            the synchronization until it delivers frames again.
+        """
         self.do_sync = do_sync
-        self.wc = QWaitCondition()
-        self.mutex = QMutex()
-        self.arrived = 0
+        self.barrier = SyncBarrier(sync_timeout)
         self.buffer_maps = dict()
 
+    @property
+    def sync_devices(self):
+        return self.barrier.devices
+
     def bind_thread(self, thread, buffer_size, sync=True):
         self.create_buffer_for_device(thread.device_id, buffer_size, sync)
         thread.buffer_manager = self
 
     def create_buffer_for_device(self, device_id, buffer_size, sync=True):
         if sync:
-            with QMutexLocker(self.mutex):
-                self.sync_devices.add(device_id)
+            self.barrier.add_device(device_id)
 
         self.buffer_maps[device_id] = Buffer(buffer_size)
 
@@ -117,30 +229,17 @@ class MultiBufferManager(object):
 
     def remove_device(self, device_id):
         self.buffer_maps.pop(device_id)
-        with QMutexLocker(self.mutex):
-            if device_id in self.sync_devices:
-                self.sync_devices.remove(device_id)
-                self.wc.wakeAll()
+        self.barrier.remove_device(device_id)
 
     def sync(self, device_id):
         # only perform sync if enabled for specified device/stream
-        self.mutex.lock()
-        if device_id in self.sync_devices:
-            # increment arrived count
-            self.arrived += 1
-            # we are the last to arrive: wake all waiting threads
-            if self.do_sync and self.arrived == len(self.sync_devices):
-                self.wc.wakeAll()
-            # still waiting for other streams to arrive: wait
-            else:
-                self.wc.wait(self.mutex)
-            # decrement arrived count
-            self.arrived -= 1
-        self.mutex.unlock()
+        return self.barrier.sync(device_id, self.do_sync)
+
+    def stalled_devices(self):
+        return self.barrier.stalled_devices()
 
     def wake_all(self):
-        with QMutexLocker(self.mutex):
-            self.wc.wakeAll()
+        self.barrier.wake_all()
 
     def set_sync(self, enable):
         self.do_sync = enable
@@ -149,7 +248,7 @@ class MultiBufferManager(object):
         return self.do_sync
 
     def sync_enabled_for_device(self, device_id):
-        return device_id in self.sync_devices
+        return device_id in self.barrier
 
     def __contains__(self, device_id):
         return device_id in self.buffer_maps
@@ -0,0 +1,258 @@
+"""
+Memory held by the four camera pipeline, and a budget mode that sizes it.
+
+`memory_report` adds up the bytes of the numpy arrays held by each part of
+a running pipeline: camera maps, weights, masks, canvases, viewport tables
+and the frames queued in the capture, projected and birdview buffers. An
+array is counted once, in the first component it is found in, even when it
+is shared or reached through views.
+
+`MemoryBudget.plan` estimates the worst case of the same components before
+anything is allocated, and shrinks the buffers and the weights until the
+estimate fits under the budget.
+"""
+import os
+import ctypes
+from collections import OrderedDict
+from queue import Queue
+import numpy as np
+
+from . import param_settings as settings
+from .structures import ImageFrame
+
+
+DEFAULT_BUFFER_SIZE = 8
+# mallopt parameter of glibc
+M_MMAP_THRESHOLD = -3
+
+
+def resident_memory():
+    """
+    Resident memory of the process in bytes, 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def release_freed_arrays(threshold=128 * 1024):
+    """
+    Make glibc allocate every block larger than `threshold` bytes with mmap,
+    so the memory of a freed array goes back to the system at once.
+
+    By default glibc raises this threshold each time a large block is freed,
+    after that the temporaries of every frame come from its heap, which
+    keeps their memory once they are freed. Returns False where `mallopt` is
+    not available.
+    """
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+        return libc.mallopt(M_MMAP_THRESHOLD, threshold) == 1
+    except (OSError, AttributeError):
+        return False
+
+
+def array_bytes(obj, seen=None):
+    """
+    Bytes of the numpy arrays reachable from `obj` through containers,
+    queues and `ImageFrame`s. The memory of a view is that of the array it
+    views, arrays whose memory is in `seen` are skipped and added to it.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(obj, np.ndarray):
+        while isinstance(obj.base, np.ndarray):
+            obj = obj.base
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return obj.nbytes
+    if isinstance(obj, ImageFrame):
+        return array_bytes(obj.image, seen)
+    if isinstance(obj, Queue):
+        obj = list(obj.queue)
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(array_bytes(x, seen) for x in obj)
+    return 0
+
+
+def memory_report(birdview=None, camera_models=(), capture_buffer_manager=None,
+                  proc_buffer_manager=None, capture_threads=()):
+    """
+    Bytes held by each component of the pipeline, as an ordered dict. The
+    arrays of the buffers are those queued at the time of the call. "total"
+    is the sum of the components and "resident" the resident memory of the
+    process, which also includes the interpreter, the libraries and the
+    temporaries of the frame being processed.
+    """
+    seen = set()
+    report = OrderedDict()
+    report["camera maps"] = array_bytes([(m.undistort_maps, m.chroma_undistort_maps,
+                                          m.fused_rects) for m in camera_models], seen)
+    if birdview is not None:
+        report["weights"] = array_bytes([birdview.weights, birdview.luma_weights,
+                                         birdview.chroma_weights], seen)
+        report["masks"] = array_bytes(birdview.masks, seen)
+        report["canvases"] = array_bytes([birdview.image, birdview.luma, birdview.chroma,
+                                          birdview.scaled_tables, birdview._car_image,
+                                          getattr(birdview, "car_luma", None),
+                                          getattr(birdview, "car_chroma", None)], seen)
+        renderer = birdview.viewport_renderer
+        report["viewport tables"] = array_bytes(
+            [renderer.tables, renderer.weights] if renderer is not None else [], seen)
+        report["birdview buffer"] = array_bytes(birdview.buffer.queue, seen)
+    if proc_buffer_manager is not None:
+        report["projected buffer"] = array_bytes([proc_buffer_manager.buffer.queue,
+                                                  proc_buffer_manager.current_frames], seen)
+    if capture_buffer_manager is not None or len(capture_threads) > 0:
+        buffers = []
+        if capture_buffer_manager is not None:
+            buffers = [b.queue for b in capture_buffer_manager.buffer_maps.values()]
+        report["capture buffers"] = array_bytes(
+            [buffers, [td.frame_pool for td in capture_threads]], seen)
+    report["total"] = sum(report.values())
+    report["resident"] = resident_memory()
+    return report
+
+
+def format_report(report):
+    return "\n".join("{:<20}{:>10.1f} MB".format(name, value / 2**20)
+                     for name, value in report.items())
+
+
+class MemoryPlan(object):
+
+    def __init__(self, limit, base):
+        self.limit = limit
+        self.base = base
+        self.capture_buffer_size = DEFAULT_BUFFER_SIZE
+        self.proc_buffer_size = DEFAULT_BUFFER_SIZE
+        self.birdview_buffer_size = DEFAULT_BUFFER_SIZE
+        self.compact_weights = False
+        self.release_freed_arrays = False
+        # the changes made to fit, with their cost
+        self.steps = []
+        self.estimate = OrderedDict()
+
+    def apply_allocator_settings(self):
+        """
+        Call before the pipeline is loaded, the buffer depths and weights
+        are passed to the pipeline by the caller.
+        """
+        if self.release_freed_arrays:
+            release_freed_arrays()
+
+    @property
+    def total(self):
+        return self.base + sum(self.estimate.values())
+
+    @property
+    def fits(self):
+        return self.limit is None or self.total <= self.limit
+
+    def __str__(self):
+        lines = ["{:<20}{:>10.1f} MB".format("base", self.base / 2**20)]
+        lines += ["{:<20}{:>10.1f} MB".format(name, value / 2**20)
+                  for name, value in self.estimate.items()]
+        lines.append("{:<20}{:>10.1f} MB of {}".format(
+            "total", self.total / 2**20,
+            "{:.0f} MB".format(self.limit / 2**20) if self.limit is not None else "no limit"))
+        lines += ["- " + step for step in self.steps]
+        if not self.fits:
+            lines.append("does not fit in the budget")
+        return "\n".join(lines)
+
+
+class MemoryBudget(object):
+
+    """
+    Buffer depths and weight format of the four camera pipeline that fit
+    in `limit_mb` megabytes of resident memory.
+    """
+
+    # from the least to the most costly, the buffers only matter when a
+    # stage stalls, the compact weights slow the stitching down by about 10%
+    # and releasing the freed arrays by about 25% (page faults on every new
+    # temporary): (attribute, value, what it costs)
+    STEPS = [
+        ("birdview_buffer_size", 4, "birdview buffer 4 deep, fewer frames kept for slow readers"),
+        ("proc_buffer_size", 4, "projected buffer 4 deep, fewer frame sets absorbed when the "
+         "stitcher stalls"),
+        ("capture_buffer_size", 4, "capture buffers 4 deep, fewer frames absorbed when a "
+         "processing thread stalls"),
+        ("birdview_buffer_size", 2, "birdview buffer 2 deep"),
+        ("proc_buffer_size", 2, "projected buffer 2 deep"),
+        ("compact_weights", True,
+         "float32 weights shared by the three channels, slower blending that rounds slightly "
+         "differently"),
+        ("capture_buffer_size", 2, "capture buffers 2 deep, frames are dropped as soon as "
+         "processing falls behind"),
+        ("birdview_buffer_size", 1, "birdview buffer 1 deep, only the latest frame is kept"),
+        ("release_freed_arrays", True,
+         "freed arrays returned to the system, every large temporary is a new mapping"),
+    ]
+
+    def __init__(self, limit_mb=None, base_bytes=None):
+        """
+        limit_mb: the budget, None to only estimate the default settings.
+        base_bytes: memory used by the process besides the pipeline, the
+            resident memory at the time of the `plan` call if not given, so
+            plan before loading the pipeline.
+        """
+        self.limit = int(limit_mb * 2**20) if limit_mb is not None else None
+        self.base_bytes = base_bytes
+
+    def estimate(self, plan, camera_models, layout=None, pixel_format="BGR",
+                 buffer_output=True):
+        """
+        Worst case bytes of each component with the settings of `plan`.
+        """
+        lay = layout if layout is not None else settings.default_layout
+        channels = 3 if pixel_format == "BGR" else 1.5
+        canvas = lay.total_w * lay.total_h * 3
+        corners = (lay.xl + lay.total_w - lay.xr) * (lay.yt + lay.total_h - lay.yb)
+        raw = [int(m.resolution[0]) * int(m.resolution[1]) for m in camera_models]
+        projected = [w * h for w, h in lay.project_shapes.values()]
+
+        estimate = OrderedDict()
+        # undistort maps (16 bit pairs and interpolation codes) and fused
+        # maps, at most one entry per projected pixel
+        estimate["camera maps"] = 6 * (sum(raw) + sum(projected))
+        estimate["weights"] = corners * (4 if plan.compact_weights else 3 * 8)
+        estimate["masks"] = corners
+        estimate["canvases"] = canvas + lay.car_image.nbytes
+        # the float64 luminance balanced frames and white balance of the
+        # frame being stitched, measured at 7.5 times the canvas
+        estimate["temporaries"] = 8 * canvas
+        # freed temporaries kept by the allocator, measured at 12.5 times
+        # the canvas
+        estimate["allocator"] = 0 if plan.release_freed_arrays else 12 * canvas
+        # queued frames, the capture pools hold two more, and one more set
+        # is being worked on by each stage
+        estimate["capture buffers"] = int((plan.capture_buffer_size + 2) * sum(raw) * channels)
+        estimate["projected buffer"] = int((plan.proc_buffer_size + 1) * sum(projected) *
+                                           channels)
+        estimate["birdview buffer"] = plan.birdview_buffer_size * canvas if buffer_output else 0
+        return estimate
+
+    def plan(self, camera_models, layout=None, pixel_format="BGR", buffer_output=True):
+        """
+        The settings to use, a `MemoryPlan`. Its `fits` is False when even
+        the smallest settings exceed the budget.
+        """
+        base = self.base_bytes if self.base_bytes is not None else resident_memory()
+        plan = MemoryPlan(self.limit, base)
+        plan.estimate = self.estimate(plan, camera_models, layout, pixel_format, buffer_output)
+        for attribute, value, cost in self.STEPS:
+            if plan.fits:
+                break
+            before = plan.total
+            setattr(plan, attribute, value)
+            plan.estimate = self.estimate(plan, camera_models, layout, pixel_format,
+                                          buffer_output)
+            plan.steps.append("{} (saves {:.1f} MB)".format(cost, (before - plan.total) / 2**20))
+        return plan
@@ -0,0 +1,77 @@
+"""
+Change detection for idle scenes.
+
+When the vehicle is parked most frames are the same as the previous ones. A
+`MotionGate` keeps a tiny signature of the last frame that was processed
+(the green channel or the luma plane averaged down to a few hundred cells)
+and tells whether a new frame differs from it enough to be processed again.
+"""
+import numpy as np
+import cv2
+
+
+class MotionGate(object):
+
+    def __init__(self, threshold=4.0, exposure_threshold=2.0, refresh_interval=30,
+                 size=(32, 24), step=4):
+        """
+        threshold: a frame has changed if one cell of its signature moved by
+            more than this many gray levels, after removing the change of
+            the mean.
+        exposure_threshold: a frame has changed if the mean of its signature
+            moved by more than this many gray levels.
+        refresh_interval: a frame is reported as changed at least every this
+            many frames, 0 to never force it.
+        size: (width, height) of the signature.
+        step: only every `step`-th row and column of the frame is read.
+        """
+        self.threshold = threshold
+        self.exposure_threshold = exposure_threshold
+        self.refresh_interval = refresh_interval
+        self.size = tuple(size)
+        self.step = step
+        self.reference = None
+        self.frames_since_refresh = 0
+        self.unchanged_count = 0
+
+    def signature(self, image):
+        """
+        Average of the green channel of a BGR frame, or of a single channel
+        (luma) frame, over the cells of the signature.
+        """
+        plane = image[::self.step, ::self.step]
+        if plane.ndim == 3:
+            plane = plane[:, :, 1]
+        return cv2.resize(np.ascontiguousarray(plane), self.size,
+                          interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def changed(self, image):
+        """
+        Whether the frame must be processed. The signature of the frame
+        becomes the reference when it is.
+        """
+        sig = self.signature(image)
+        self.frames_since_refresh += 1
+        if self.reference is None or self.reference.shape != sig.shape or \
+           (self.refresh_interval > 0 and self.frames_since_refresh >= self.refresh_interval):
+            return self.accept(sig)
+
+        diff = sig - self.reference
+        exposure = diff.mean()
+        if abs(exposure) > self.exposure_threshold or \
+           np.abs(diff - exposure).max() > self.threshold:
+            return self.accept(sig)
+
+        self.unchanged_count += 1
+        return False
+
+    def accept(self, sig):
+        self.reference = sig
+        self.frames_since_refresh = 0
+        return True
+
+    def reset(self):
+        """
+        Process the next frame whatever it looks like.
+        """
+        self.reference = None
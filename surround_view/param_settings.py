@@ -4,60 +4,126 @@ import cv2
 
 camera_names = ["front", "back", "left", "right"]
 
-# --------------------------------------------------------------------
-# (shift_width, shift_height): how far away the birdview looks outside
-# of the calibration pattern in horizontal and vertical directions
-shift_w = 300
-shift_h = 300
-
-# size of the gap between the calibration pattern and the car
-# in horizontal and vertical directions
-inn_shift_w = 20
-inn_shift_h = 50
-
-# total width/height of the stitched image
-total_w = 600 + 2 * shift_w
-total_h = 1000 + 2 * shift_h
-
-# four corners of the rectangular region occupied by the car
-# top-left (x_left, y_top), bottom-right (x_right, y_bottom)
-xl = shift_w + 180 + inn_shift_w
-xr = total_w - xl
-yt = shift_h + 200 + inn_shift_h
-yb = total_h - yt
-# --------------------------------------------------------------------
-
-project_shapes = {
-    "front": (total_w, yt),
-    "back":  (total_w, yt),
-    "left":  (total_h, xl),
-    "right": (total_h, xl)
-}
-
-# pixel locations of the four points to be chosen.
-# you must click these pixels in the same order when running
-# the get_projection_map.py script
-project_keypoints = {
-    "front": [(shift_w + 120, shift_h),
-              (shift_w + 480, shift_h),
-              (shift_w + 120, shift_h + 160),
-              (shift_w + 480, shift_h + 160)],
-
-    "back":  [(shift_w + 120, shift_h),
-              (shift_w + 480, shift_h),
-              (shift_w + 120, shift_h + 160),
-              (shift_w + 480, shift_h + 160)],
-
-    "left":  [(shift_h + 280, shift_w),
-              (shift_h + 840, shift_w),
-              (shift_h + 280, shift_w + 160),
-              (shift_h + 840, shift_w + 160)],
-
-    "right": [(shift_h + 160, shift_w),
-              (shift_h + 720, shift_w),
-              (shift_h + 160, shift_w + 160),
-              (shift_h + 720, shift_w + 160)]
-}
-
-car_image = cv2.imread(os.path.join(os.getcwd(), "images", "car.png"))
-car_image = cv2.resize(car_image, (xr - xl, yb - yt))
+
+class Layout(object):
+
+    """
+    Geometry of the four camera birdview: the size of the canvas, the car
+    rectangle, the projected image shapes and the keypoints. Nothing is read
+    from disk until the car image is first used.
+    """
+
+    def __init__(self,
+                 shift_w=300,
+                 shift_h=300,
+                 inn_shift_w=20,
+                 inn_shift_h=50,
+                 car_image_file=None):
+        """
+        shift_w, shift_h: how far away the birdview looks outside of the
+            calibration pattern in horizontal and vertical directions.
+        inn_shift_w, inn_shift_h: size of the gap between the calibration
+            pattern and the car in horizontal and vertical directions.
+        car_image_file: image drawn over the car, defaults to "images/car.png"
+            in the current directory at the time it is first used.
+        """
+        self.camera_names = list(camera_names)
+        self.shift_w = shift_w
+        self.shift_h = shift_h
+        self.inn_shift_w = inn_shift_w
+        self.inn_shift_h = inn_shift_h
+        self.car_image_file = car_image_file
+        self._car_image = None
+
+        # total width/height of the stitched image
+        self.total_w = 600 + 2 * shift_w
+        self.total_h = 1000 + 2 * shift_h
+
+        # four corners of the rectangular region occupied by the car
+        # top-left (x_left, y_top), bottom-right (x_right, y_bottom)
+        self.xl = shift_w + 180 + inn_shift_w
+        self.xr = self.total_w - self.xl
+        self.yt = shift_h + 200 + inn_shift_h
+        self.yb = self.total_h - self.yt
+
+        self.project_shapes = {
+            "front": (self.total_w, self.yt),
+            "back":  (self.total_w, self.yt),
+            "left":  (self.total_h, self.xl),
+            "right": (self.total_h, self.xl)
+        }
+
+        # pixel locations of the four points to be chosen.
+        # you must click these pixels in the same order when running
+        # the get_projection_map.py script
+        self.project_keypoints = {
+            "front": [(shift_w + 120, shift_h),
+                      (shift_w + 480, shift_h),
+                      (shift_w + 120, shift_h + 160),
+                      (shift_w + 480, shift_h + 160)],
+
+            "back":  [(shift_w + 120, shift_h),
+                      (shift_w + 480, shift_h),
+                      (shift_w + 120, shift_h + 160),
+                      (shift_w + 480, shift_h + 160)],
+
+            "left":  [(shift_h + 280, shift_w),
+                      (shift_h + 840, shift_w),
+                      (shift_h + 280, shift_w + 160),
+                      (shift_h + 840, shift_w + 160)],
+
+            "right": [(shift_h + 160, shift_w),
+                      (shift_h + 720, shift_w),
+                      (shift_h + 160, shift_w + 160),
+                      (shift_h + 720, shift_w + 160)]
+        }
+
+    @property
+    def car_rect(self):
+        return (self.xl, self.yt, self.xr, self.yb)
+
+    @property
+    def car_image(self):
+        """
+        The car image resized to the car rectangle, read on first use.
+        """
+        if self._car_image is None:
+            self._car_image = self.load_car_image((self.xr - self.xl, self.yb - self.yt))
+        return self._car_image
+
+    def load_car_image(self, size):
+        """
+        Read the car image resized to `size` = (width, height).
+        """
+        filename = self.car_image_file
+        if filename is None:
+            filename = os.path.join(os.getcwd(), "images", "car.png")
+        image = cv2.imread(filename)
+        if image is None:
+            raise IOError("Cannot read car image: {}".format(filename))
+        return cv2.resize(image, size)
+
+
+# the layout used when none is given, the module level names below are
+# kept for scripts written against the old constants
+default_layout = Layout()
+
+shift_w = default_layout.shift_w
+shift_h = default_layout.shift_h
+inn_shift_w = default_layout.inn_shift_w
+inn_shift_h = default_layout.inn_shift_h
+total_w = default_layout.total_w
+total_h = default_layout.total_h
+xl = default_layout.xl
+xr = default_layout.xr
+yt = default_layout.yt
+yb = default_layout.yb
+project_shapes = default_layout.project_shapes
+project_keypoints = default_layout.project_keypoints
+
+
+def __getattr__(name):
+    # `car_image` is only read when it is first accessed
+    if name == "car_image":
+        return default_layout.car_image
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -1,7 +1,8 @@
 import cv2
-from PyQt5.QtCore import qDebug, QMutex
+from PyQt5.QtCore import qDebug, QMutex, QMutexLocker
 
 from .base_thread import BaseThread
+from . import utils
 
 
 class CameraProcessingThread(BaseThread):
@@ -15,21 +16,44 @@ class CameraProcessingThread(BaseThread):
                  device_id,
                  camera_model,
                  drop_if_full=True,
+                 motion_gate=None,
                  parent=None):
         """
         capture_buffer_manager: an instance of the `MultiBufferManager` object.
         device_id: device number of the camera to be processed.
         camera_model: an instance of the `FisheyeCameraModel` object.
         drop_if_full: drop if the buffer is full.
+        motion_gate: an optional `MotionGate`, frames it reports as unchanged
+            are not processed and the previous projected frame is sent again.
         """
         super(CameraProcessingThread, self).__init__(parent)
         self.capture_buffer_manager = capture_buffer_manager
         self.device_id = device_id
         self.camera_model = camera_model
         self.drop_if_full = drop_if_full
+        self.motion_gate = motion_gate
+        self.last_frame = None
         # an instance of the `ProjectedImageBuffer` object
         self.proc_buffer_manager = None
 
+    def set_camera_model(self, camera_model):
+        """
+        Swap in a new camera model between two frames, safe to call while the
+        thread is running. The model should have its maps built already.
+        """
+        with QMutexLocker(self.processing_mutex):
+            self.camera_model = camera_model
+            # the previous frame was projected with the old model
+            self.last_frame = None
+
+    def get_timeout(self):
+        """
+        How long to wait for a camera frame, in milliseconds: the sync
+        timeout of the capture threads, one second without one.
+        """
+        timeout = self.capture_buffer_manager.barrier.timeout
+        return timeout if timeout is not None else 1000
+
     def run(self):
         if self.proc_buffer_manager is None:
             raise ValueError("This thread has not been binded to any processing thread yet")
@@ -44,16 +68,65 @@ class CameraProcessingThread(BaseThread):
 
             self.processing_time = self.clock.elapsed()
             self.clock.start()
+            self.start_stages()
+
+            # wait for the frame outside of the processing mutex, a stalled
+            # camera must not block `set_camera_model`, and check the stop
+            # flag again now and then
+            raw_frame = self.capture_buffer_manager.get_device(self.device_id).get(
+                self.get_timeout())
+            if raw_frame is None:
+                continue
 
             self.processing_mutex.lock()
-            raw_frame = self.capture_buffer_manager.get_device(self.device_id).get()
-            und_frame = self.camera_model.undistort(raw_frame.image)
-            pro_frame = self.camera_model.project(und_frame)
-            flip_frame = self.camera_model.flip(pro_frame)
+            if raw_frame.pixel_format == "BGR":
+                planes = None
+                luma = raw_frame.image
+            else:
+                planes = utils.split_yuv(raw_frame.image, raw_frame.pixel_format)
+                luma = planes[0]
+            self.end_stage("get")
+
+            if self.motion_gate is not None and self.last_frame is None:
+                self.motion_gate.reset()
+
+            unchanged = False
+            if self.motion_gate is not None:
+                unchanged = not self.motion_gate.changed(luma)
+                self.end_stage("motion_gate")
+
+            if unchanged:
+                # sending the same object lets the birdview reuse its regions
+                flip_frame = self.last_frame
+                self.stat_data.frames_reused_count += 1
+            elif planes is None and self.camera_model.fused_rects is not None:
+                flip_frame = self.camera_model.remap_fused(raw_frame.image)
+                self.end_stage("remap_fused")
+            elif planes is None:
+                und_frame = self.camera_model.undistort(raw_frame.image)
+                self.end_stage("undistort")
+                pro_frame = self.camera_model.project(und_frame)
+                self.end_stage("project")
+                flip_frame = self.camera_model.flip(pro_frame)
+                self.end_stage("flip")
+            else:
+                # yuv frames are processed as a (luma, chroma) pair of planes
+                und_frame = self.camera_model.undistort_yuv(*planes)
+                self.end_stage("undistort")
+                pro_frame = self.camera_model.project_yuv(*und_frame)
+                self.end_stage("project")
+                flip_frame = self.camera_model.flip_yuv(*pro_frame)
+                self.end_stage("flip")
+            self.last_frame = flip_frame
             self.processing_mutex.unlock()
 
             self.proc_buffer_manager.sync(self.device_id)
-            self.proc_buffer_manager.set_frame_for_device(self.device_id, flip_frame)
+            self.end_stage("sync")
+            # viewports of the birdview are rendered from the raw BGR frames
+            self.proc_buffer_manager.set_frame_for_device(
+                self.device_id, flip_frame, raw_frame.image if planes is None else None,
+                raw_frame.timestamp)
+            self.end_stage("deliver")
 
             # update statistics
             self.update_fps(self.processing_time)
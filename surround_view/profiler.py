@@ -0,0 +1,141 @@
+"""
+Low overhead profiling of the pipeline threads.
+
+A thread given a `Profiler` with `thread.set_profiler(profiler)` reports
+every stage it times with `start_stages`/`end_stage` (undistort, project,
+flip, luminance_stats, stitch, white_balance, car_image, output, ...) as a
+section: its name, start and duration. Threads without a profiler only pay
+for the timing they already do, and a profiler can be attached to or
+detached from any thread while it runs.
+
+The profiler can also sample the stacks of the threads that reported a
+section, from a thread of its own, every `interval` seconds.
+
+Sections are written as a Chrome trace (`write_chrome_trace`, open it in
+chrome://tracing or https://ui.perfetto.dev), the samples, or the sections
+when there are no samples, as collapsed stacks (`write_collapsed`), the
+input of flamegraph.pl and speedscope.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque, Counter
+
+
+class Profiler(object):
+
+    def __init__(self, max_sections=100000):
+        """
+        max_sections: the oldest sections are dropped beyond this number.
+        """
+        self.sections = deque(maxlen=max_sections)
+        self.samples = Counter()
+        self.thread_names = {}
+        self.start_time = time.perf_counter()
+        self.sampler = None
+        self.sampling = threading.Event()
+
+    def add_section(self, thread_name, name, start, end):
+        """
+        Record a section of the calling thread, `start` and `end` are
+        `time.perf_counter()` values.
+        """
+        ident = threading.get_ident()
+        if ident not in self.thread_names:
+            self.thread_names[ident] = thread_name
+        # appending to a deque is atomic, no lock is needed between threads
+        self.sections.append((ident, name, start, end))
+
+    def start_sampling(self, interval=0.01):
+        """
+        Sample the stacks of the profiled threads every `interval` seconds
+        until `stop_sampling` is called.
+        """
+        if self.sampler is not None:
+            return
+        self.sampling.set()
+        self.sampler = threading.Thread(target=self.sample_loop, args=(interval,),
+                                        name="profiler", daemon=True)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        if self.sampler is None:
+            return
+        self.sampling.clear()
+        self.sampler.join()
+        self.sampler = None
+
+    def sample_loop(self, interval):
+        while self.sampling.is_set():
+            frames = sys._current_frames()
+            for ident, thread_name in list(self.thread_names.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    # the code objects are only formatted when written
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    self.samples[(thread_name, tuple(codes))] += 1
+            del frames
+            time.sleep(interval)
+
+    @staticmethod
+    def collapse(thread_name, codes):
+        """
+        A sampled stack as one line of a collapsed stack file, the outermost
+        function first.
+        """
+        names = [thread_name]
+        for code in reversed(codes):
+            names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+        return ";".join(names)
+
+    def clear(self):
+        self.sections.clear()
+        self.samples.clear()
+        self.start_time = time.perf_counter()
+
+    def section_totals(self):
+        """
+        Total time in ms and count of every (thread, section) pair.
+        """
+        totals = {}
+        for ident, name, start, end in list(self.sections):
+            key = (self.thread_names[ident], name)
+            total, count = totals.get(key, (0.0, 0))
+            totals[key] = (total + (end - start) * 1000, count + 1)
+        return totals
+
+    def write_chrome_trace(self, filename):
+        """
+        Write the sections in the Chrome trace event format, one track per
+        thread.
+        """
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": ident,
+                   "args": {"name": thread_name}}
+                  for ident, thread_name in self.thread_names.items()]
+        for ident, name, start, end in list(self.sections):
+            events.append({"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": ident,
+                           "ts": (start - self.start_time) * 1e6, "dur": (end - start) * 1e6})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def write_collapsed(self, filename):
+        """
+        Write the sampled stacks as collapsed stacks, one "frames count" line
+        per stack. Without samples, write the sections instead, as
+        "thread;section microseconds" lines.
+        """
+        if len(self.samples) > 0:
+            lines = ["{} {}".format(self.collapse(*stack), count)
+                     for stack, count in self.samples.items()]
+        else:
+            lines = ["{};{} {}".format(thread_name, name, int(round(total * 1000)))
+                     for (thread_name, name), (total, _) in self.section_totals().items()]
+        with open(filename, "w") as f:
+            f.write("\n".join(sorted(lines)) + "\n")
@@ -0,0 +1,129 @@
+"""
+Low resolution preview of the undistortion and projection of a camera.
+
+`PreviewProjector` renders a still image of a camera at 1 / s resolution
+and keeps its intermediate results: changing the scale and shift of the
+undistortion rebuilds the small undistort maps, moving the keypoints only
+recomputes the homography and warps the cached undistorted image. The full
+resolution result is only needed once the user confirms, through the
+camera model itself.
+"""
+import numpy as np
+import cv2
+
+
+class PreviewProjector(object):
+
+    def __init__(self, camera, image, s=2):
+        """
+        camera: a `FisheyeCameraModel`, its scale, shift and project matrix
+            are the initial values of the preview.
+        image: a raw frame of the camera.
+        s: the preview is rendered at 1 / s of the full resolution.
+        """
+        self.camera = camera
+        self.image = image
+        self.s = s
+        # full resolution coordinates to preview coordinates, pixel centers
+        # map to pixel centers
+        offset = (1.0 / s - 1) / 2
+        self.S = np.float64([[1.0 / s, 0, offset], [0, 1.0 / s, offset], [0, 0, 1]])
+        self.scale_xy = tuple(float(x) for x in np.ravel(camera.scale_xy))
+        self.shift_xy = tuple(float(x) for x in np.ravel(camera.shift_xy))
+        self.project_matrix = camera.project_matrix
+        self.keypoints = []
+        if self.project_matrix is not None:
+            # start from the keypoints the current project matrix was made from
+            dst = np.float32(camera.layout.project_keypoints[camera.orientation])
+            src = cv2.perspectiveTransform(dst.reshape(-1, 1, 2),
+                                           np.linalg.inv(self.project_matrix))
+            self.keypoints = [tuple(float(v) for v in pt) for pt in src.reshape(-1, 2)]
+        self.undistorted = None
+        self.projected = None
+
+    def get_new_camera_matrix(self):
+        new_matrix = self.camera.camera_matrix.copy()
+        new_matrix[0, 0] *= self.scale_xy[0]
+        new_matrix[1, 1] *= self.scale_xy[1]
+        new_matrix[0, 2] += self.shift_xy[0]
+        new_matrix[1, 2] += self.shift_xy[1]
+        return new_matrix
+
+    def set_scale_and_shift(self, scale_xy, shift_xy):
+        """
+        Change the undistortion. The keypoints are moved so that they stay on
+        the same points of the scene.
+        """
+        old = self.get_new_camera_matrix()
+        self.scale_xy = tuple(float(x) for x in scale_xy)
+        self.shift_xy = tuple(float(x) for x in shift_xy)
+        new = self.get_new_camera_matrix()
+        # undistorted pixels are K_new times the normalized coordinates,
+        # each axis is mapped by a scale and an offset
+        self.keypoints = [((x - old[0, 2]) / old[0, 0] * new[0, 0] + new[0, 2],
+                           (y - old[1, 2]) / old[1, 1] * new[1, 1] + new[1, 2])
+                          for x, y in self.keypoints]
+        self.undistorted = None
+        self.projected = None
+        if len(self.keypoints) == 4:
+            self.update_project_matrix()
+
+    def set_keypoints(self, keypoints):
+        """
+        Keypoints in full resolution undistorted coordinates, the project
+        matrix is recomputed once there are four.
+        """
+        self.keypoints = [tuple(float(v) for v in pt) for pt in keypoints]
+        if len(self.keypoints) == 4:
+            self.update_project_matrix()
+
+    def update_project_matrix(self):
+        src = np.float32(self.keypoints)
+        dst = np.float32(self.camera.layout.project_keypoints[self.camera.orientation])
+        self.project_matrix = cv2.getPerspectiveTransform(src, dst)
+        self.projected = None
+
+    def get_undistorted(self):
+        """
+        The undistorted image at preview resolution.
+        """
+        if self.undistorted is None:
+            width, height = [int(x) for x in self.camera.resolution]
+            mapx, mapy = cv2.fisheye.initUndistortRectifyMap(
+                self.camera.camera_matrix,
+                self.camera.dist_coeffs,
+                np.eye(3),
+                self.S.dot(self.get_new_camera_matrix()),
+                (width // self.s, height // self.s),
+                cv2.CV_32FC1
+            )
+            # the maps point into the full resolution image, only the
+            # preview pixels are computed
+            self.undistorted = cv2.remap(self.image, mapx, mapy, interpolation=cv2.INTER_LINEAR,
+                                         borderMode=cv2.BORDER_CONSTANT)
+        return self.undistorted
+
+    def get_projected(self):
+        """
+        The projected and flipped image at preview resolution, black if the
+        project matrix is not known yet.
+        """
+        if self.projected is None:
+            width, height = self.camera.project_shape
+            size = (width // self.s, height // self.s)
+            if self.project_matrix is None:
+                image = np.zeros((size[1], size[0], 3), np.uint8)
+            else:
+                H = self.S.dot(self.project_matrix).dot(np.linalg.inv(self.S))
+                image = cv2.warpPerspective(self.get_undistorted(), H, size)
+            self.projected = self.camera.flip(image)
+        return self.projected
+
+    def apply(self):
+        """
+        Copy the scale, shift and project matrix to the camera model and
+        rebuild its full resolution maps.
+        """
+        self.camera.project_matrix = self.project_matrix
+        self.camera.set_scale_and_shift(self.scale_xy, self.shift_xy)
+        return self.camera
@@ -0,0 +1,132 @@
+"""
+Adaptive quality for the stitcher.
+
+A `QualityGovernor` watches how long the stitcher spends on every frame and,
+when it cannot keep up with the target frame rate, steps down through a list
+of `QualityLevel`s that shed work in a fixed order. It steps back up when the
+frames would fit in the budget again at the previous level.
+"""
+import time
+from collections import deque
+
+
+class QualityLevel(object):
+
+    def __init__(self, name, stats_interval=1, white_balance=True, stats_step=1, render_scale=1):
+        """
+        name: shown in the switch history.
+        stats_interval: recompute the luminance and white balance gains every
+            this many frames, the last gains are reused in between.
+        white_balance: apply the white balance at all.
+        stats_step: compute the luminance statistics on every `stats_step`-th
+            row and column of the overlapping regions.
+        render_scale: stitch at 1 / render_scale resolution and upscale the
+            result (four camera BGR layout only).
+        """
+        self.name = name
+        self.stats_interval = stats_interval
+        self.white_balance = white_balance
+        self.stats_step = stats_step
+        self.render_scale = render_scale
+
+    def __repr__(self):
+        return "QualityLevel({!r})".format(self.name)
+
+
+# the default levels, each one keeps the savings of the previous ones
+QUALITY_LEVELS = [
+    QualityLevel("full"),
+    QualityLevel("gains every 4 frames", stats_interval=4),
+    QualityLevel("no white balance", stats_interval=4, white_balance=False),
+    QualityLevel("subsampled statistics", stats_interval=4, white_balance=False, stats_step=4),
+    QualityLevel("half resolution", stats_interval=4, white_balance=False, stats_step=4,
+                 render_scale=2),
+]
+
+FULL_QUALITY = QUALITY_LEVELS[0]
+
+
+class QualityGovernor(object):
+
+    """
+    Chooses the quality level of the stitcher from its processing times.
+
+    The average processing time over the last `window` frames is compared
+    with the budget of the target frame rate. Above the budget, the next
+    lower level is used. Below it, the governor estimates the cost of the
+    next higher level from what it measured when it left that level, and
+    steps up if that estimate fits in the budget with some margin.
+    """
+
+    def __init__(self, target_fps, levels=None, window=30, hold_frames=30, headroom=1.5,
+                 margin=0.9):
+        """
+        target_fps: frame rate to hold.
+        levels: list of `QualityLevel` from the best to the cheapest,
+            `QUALITY_LEVELS` if not given.
+        window: number of frames the processing time is averaged over.
+        hold_frames: minimum number of frames between two switches.
+        headroom: assumed cost ratio of a level to the next lower one when
+            it has not been measured yet.
+        margin: step up only if the estimated time is below this fraction
+            of the budget.
+        """
+        self.levels = levels if levels is not None else QUALITY_LEVELS
+        self.budget = 1000.0 / target_fps
+        self.times = deque(maxlen=window)
+        self.hold_frames = hold_frames
+        self.headroom = headroom
+        self.margin = margin
+        self.level_index = 0
+        self.frames_since_switch = 0
+        # measured cost of level k relative to level k + 1
+        self.cost_ratios = {}
+        self.pending_ratio = None
+        # moving averages of the stage timings reported by the stitcher, in ms
+        self.stage_times = {}
+        # (time, old level, new level, average processing time in ms)
+        self.history = []
+
+    @property
+    def level(self):
+        return self.levels[self.level_index]
+
+    def average_time(self):
+        if len(self.times) == 0:
+            return 0
+        return sum(self.times) / len(self.times)
+
+    def update(self, processing_time, stage_times=None):
+        """
+        Record the processing time of a frame in milliseconds, and optionally
+        the time of each stage. Returns the level for the next frame.
+        """
+        self.times.append(processing_time)
+        if stage_times is not None:
+            for name, t in stage_times.items():
+                self.stage_times[name] = 0.9 * self.stage_times.get(name, t) + 0.1 * t
+
+        self.frames_since_switch += 1
+        if self.frames_since_switch < self.hold_frames or len(self.times) < self.times.maxlen:
+            return self.level
+
+        average = self.average_time()
+        if self.pending_ratio is not None:
+            index, previous = self.pending_ratio
+            self.cost_ratios[index] = previous / max(average, 1e-3)
+            self.pending_ratio = None
+
+        if average > self.budget and self.level_index < len(self.levels) - 1:
+            self.pending_ratio = (self.level_index, average)
+            self.switch(self.level_index + 1, average)
+        elif self.level_index > 0:
+            ratio = self.cost_ratios.get(self.level_index - 1, self.headroom)
+            if average * ratio < self.budget * self.margin:
+                self.switch(self.level_index - 1, average)
+        return self.level
+
+    def switch(self, index, average):
+        self.history.append((time.time(), self.level.name, self.levels[index].name, average))
+        self.level_index = index
+        self.frames_since_switch = 0
+        self.times.clear()
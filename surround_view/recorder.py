@@ -0,0 +1,237 @@
+import os
+import socket
+import threading
+import cv2
+from PyQt5.QtCore import qDebug
+
+from .base_thread import BaseThread
+from .imagebuffer import Buffer
+
+
+class VideoFileSink(object):
+
+    """
+    Write frames to a video file. The file is opened when the first frame
+    arrives, so the frame size does not need to be known in advance.
+    """
+
+    FOURCCS = {"mjpg": "MJPG", "h264": "avc1"}
+
+    def __init__(self, filename, codec="mjpg", fps=30, use_gst=False):
+        """
+        codec: "mjpg" or "h264".
+        use_gst: encode h264 through a gstreamer pipeline, uses the hardware
+            encoder on jetson boards.
+        """
+        if codec not in self.FOURCCS:
+            raise ValueError("Unknown codec: {}".format(codec))
+
+        self.filename = filename
+        self.codec = codec
+        self.fps = fps
+        self.use_gst = use_gst
+        self.writer = None
+
+    def open(self, frame_size):
+        width, height = frame_size
+        if self.use_gst and self.codec == "h264":
+            pipeline = ("appsrc ! video/x-raw, format=(string)BGR ! videoconvert ! "
+                        "video/x-raw, format=(string)I420 ! nvvidconv ! "
+                        "nvv4l2h264enc ! h264parse ! qtmux ! filesink location={}".format(
+                            self.filename))
+            self.writer = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, self.fps,
+                                          (width, height))
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*self.FOURCCS[self.codec])
+            self.writer = cv2.VideoWriter(self.filename, fourcc, self.fps, (width, height))
+
+        if not self.writer.isOpened():
+            raise IOError("Cannot open video writer for {}".format(self.filename))
+
+    def write(self, frame):
+        if self.writer is None:
+            self.open((frame.shape[1], frame.shape[0]))
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class MJPEGStreamSink(object):
+
+    """
+    Serve frames as a MJPEG stream over http, on a local tcp port or a unix
+    socket. View it with e.g. `ffplay http://127.0.0.1:8080`.
+
+    Every frame is encoded once and sent to all connected clients. A client
+    that cannot keep up is disconnected instead of slowing down the encoder.
+    """
+
+    BOUNDARY = b"svframe"
+
+    def __init__(self, address=("127.0.0.1", 8080), quality=80, send_timeout=0.05):
+        """
+        address: (host, port) for tcp or a file path for a unix socket.
+        """
+        self.address = address
+        self.quality = quality
+        self.send_timeout = send_timeout
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(4)
+        self.accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
+        self.accept_thread.start()
+
+    def accept_clients(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                # the server socket has been closed
+                return
+
+            conn.settimeout(self.send_timeout)
+            try:
+                conn.sendall(b"HTTP/1.0 200 OK\r\n"
+                             b"Content-Type: multipart/x-mixed-replace; boundary=" +
+                             self.BOUNDARY + b"\r\n\r\n")
+            except OSError:
+                conn.close()
+                continue
+
+            with self.clients_lock:
+                self.clients.append(conn)
+
+    def write(self, frame):
+        with self.clients_lock:
+            if len(self.clients) == 0:
+                return
+            clients = list(self.clients)
+
+        ok, jpeg = cv2.imencode(".jpg", frame, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+        if not ok:
+            return
+
+        part = (b"--" + self.BOUNDARY + b"\r\n"
+                b"Content-Type: image/jpeg\r\n"
+                b"Content-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n" +
+                jpeg.tobytes() + b"\r\n")
+        for conn in clients:
+            try:
+                conn.sendall(part)
+            except OSError:
+                with self.clients_lock:
+                    self.clients.remove(conn)
+                conn.close()
+
+    def close(self):
+        self.server.close()
+        with self.clients_lock:
+            for conn in self.clients:
+                conn.close()
+            self.clients = []
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class EncoderThread(BaseThread):
+
+    """
+    Thread that encodes frames into one or more sinks (`VideoFileSink`,
+    `MJPEGStreamSink`).
+
+    Frames are submitted to a small bounded buffer. If the encoder falls
+    behind, new frames are dropped and counted in
+    `stat_data.frames_dropped_count`, the producer is never blocked.
+
+    A sink that raises, e.g. a `VideoFileSink` that cannot open its file, is
+    closed and moved to `failed_sinks`, the other sinks keep recording.
+    """
+
+    def __init__(self, sinks, buffer_size=4, pixel_format="BGR", name="", parent=None):
+        """
+        sinks: a list of sinks, each must have `write(frame)` and `close()` methods.
+        pixel_format: "BGR", or "NV12" if the submitted frames are packed NV12.
+        name: used in debug messages.
+        """
+        super(EncoderThread, self).__init__(parent)
+        self.sinks = list(sinks)
+        self.failed_sinks = []
+        self.pixel_format = pixel_format
+        self.name = name
+        self.buffer = Buffer(buffer_size)
+
+    def submit(self, frame):
+        """
+        Queue a frame for encoding, the frame must not be modified afterwards.
+        Returns False if the frame was dropped.
+        """
+        if self.buffer.add(frame, drop_if_full=True):
+            return True
+        self.stat_data.frames_dropped_count += 1
+        return False
+
+    def stop(self):
+        super(EncoderThread, self).stop()
+        # wake up the thread if it is waiting for a frame
+        self.buffer.add(None, drop_if_full=True)
+
+    def run(self):
+        while True:
+            self.stop_mutex.lock()
+            if self.stopped:
+                self.stopped = False
+                self.stop_mutex.unlock()
+                break
+            self.stop_mutex.unlock()
+
+            frame = self.buffer.get()
+            if frame is None:
+                continue
+
+            self.processing_time = self.clock.elapsed()
+            self.clock.start()
+            self.start_stages()
+
+            self.processing_mutex.lock()
+            if self.pixel_format == "NV12":
+                frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_NV12)
+                self.end_stage("convert")
+            for sink in list(self.sinks):
+                try:
+                    sink.write(frame)
+                except Exception as e:
+                    qDebug("Encoder thread {}: disabling {}: {}".format(
+                        self.name, sink.__class__.__name__, e))
+                    self.sinks.remove(sink)
+                    self.failed_sinks.append(sink)
+                    self.close_sink(sink)
+            self.end_stage("encode")
+            self.processing_mutex.unlock()
+
+            # update statistics
+            self.update_fps(self.processing_time)
+            self.stat_data.frames_processed_count += 1
+            # inform GUI of updated statistics
+            self.update_statistics_gui.emit(self.stat_data)
+
+        for sink in self.sinks:
+            self.close_sink(sink)
+        qDebug("Stopping encoder thread {}...".format(self.name))
+
+    def close_sink(self, sink):
+        try:
+            sink.close()
+        except Exception as e:
+            qDebug("Encoder thread {}: cannot close {}: {}".format(
+                self.name, sink.__class__.__name__, e))
@@ -0,0 +1,392 @@
+"""
+Data-driven description of a surround view rig with any number of cameras.
+
+A rig lists its cameras, the rectangle of the birdview canvas each camera
+covers, and the rectangles where two cameras overlap. The stitcher blends the
+overlapping rectangles with their weight matrices, copies the rest, and
+computes the luminance gains of all cameras with one least-squares solve over
+the overlap graph.
+"""
+import os
+import numpy as np
+import cv2
+
+from . import param_settings as settings
+from . import utils
+from .fisheye_camera import FisheyeCameraModel
+from .quality import FULL_QUALITY
+from .weight_cache import compute_overlap_weights
+
+
+class RigCamera(object):
+
+    def __init__(self, name, rect, orientation=None):
+        """
+        name: name of the camera, also the name of its yaml file.
+        rect: (x0, y0, x1, y1) the canvas rectangle covered by the flipped
+            camera frame.
+        orientation: "front", "back", "left" or "right", how the camera is
+            mounted, defaults to `name`.
+        """
+        self.name = name
+        self.rect = tuple(int(x) for x in rect)
+        self.orientation = orientation if orientation is not None else name
+
+    @property
+    def frame_shape(self):
+        """
+        (height, width) of the flipped frame.
+        """
+        x0, y0, x1, y1 = self.rect
+        return (y1 - y0, x1 - x0)
+
+    @property
+    def project_shape(self):
+        """
+        (width, height) of the projected frame, before flipping.
+        """
+        h, w = self.frame_shape
+        if self.orientation in ("front", "back"):
+            return (w, h)
+        return (h, w)
+
+
+class RigOverlap(object):
+
+    def __init__(self, camera_a, camera_b, rect):
+        """
+        camera_a, camera_b: names of the two cameras, the weight matrix of the
+            overlap is the weight of `camera_a`.
+        rect: (x0, y0, x1, y1) canvas rectangle of the overlap.
+        """
+        self.camera_a = camera_a
+        self.camera_b = camera_b
+        self.rect = tuple(int(x) for x in rect)
+
+
+class Rig(object):
+
+    """
+    Cameras, overlaps and the car rectangle of a birdview canvas.
+    """
+
+    def __init__(self, canvas_size, cameras, overlaps, car_rect=None):
+        """
+        canvas_size: (width, height) of the birdview image.
+        cameras: a list of `RigCamera` objects.
+        overlaps: a list of `RigOverlap` objects.
+        car_rect: (x0, y0, x1, y1) canvas rectangle the car image is drawn in.
+        """
+        self.canvas_size = tuple(canvas_size)
+        self.cameras = list(cameras)
+        self.overlaps = list(overlaps)
+        self.car_rect = tuple(car_rect) if car_rect is not None else None
+        self.index = {camera.name: k for k, camera in enumerate(self.cameras)}
+        for ov in self.overlaps:
+            for name in (ov.camera_a, ov.camera_b):
+                if name not in self.index:
+                    raise ValueError("Unknown camera in overlap: {}".format(name))
+            if not contains(self.get_camera(ov.camera_a).rect, ov.rect) or \
+               not contains(self.get_camera(ov.camera_b).rect, ov.rect):
+                raise ValueError("Overlap {} is not covered by both cameras".format(ov.rect))
+
+    @property
+    def camera_names(self):
+        return [camera.name for camera in self.cameras]
+
+    def get_camera(self, name):
+        return self.cameras[self.index[name]]
+
+    @classmethod
+    def default(cls, layout=None):
+        """
+        The four camera rig of a `param_settings.Layout`, the overlaps are in
+        the order of the channels of weights.png and masks.png.
+        """
+        if layout is None:
+            layout = settings.default_layout
+        W, H = layout.total_w, layout.total_h
+        xl, xr, yt, yb = layout.xl, layout.xr, layout.yt, layout.yb
+        cameras = [RigCamera("front", (0, 0, W, yt)),
+                   RigCamera("back", (0, yb, W, H)),
+                   RigCamera("left", (0, 0, xl, H)),
+                   RigCamera("right", (xr, 0, W, H))]
+        overlaps = [RigOverlap("front", "left", (0, 0, xl, yt)),
+                    RigOverlap("front", "right", (xr, 0, W, yt)),
+                    RigOverlap("back", "left", (0, yb, xl, H)),
+                    RigOverlap("back", "right", (xr, yb, W, H))]
+        return cls((W, H), cameras, overlaps, (xl, yt, xr, yb))
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a rig from an opencv yaml file like:
+
+            canvas_size: [1200, 1600]
+            car_rect: [500, 550, 700, 1050]
+            cameras:
+              - { name: front, orientation: front, rect: [0, 0, 1200, 550] }
+              ...
+            overlaps:
+              - { cameras: [front, left], rect: [0, 0, 500, 550] }
+              ...
+        """
+        fs = cv2.FileStorage(filename, cv2.FILE_STORAGE_READ)
+        if not fs.isOpened():
+            raise ValueError("Cannot open rig file: {}".format(filename))
+
+        def read_ints(node):
+            return [int(node.at(k).real()) for k in range(node.size())]
+
+        canvas_size = read_ints(fs.getNode("canvas_size"))
+        car_node = fs.getNode("car_rect")
+        car_rect = None if car_node.empty() else read_ints(car_node)
+
+        cameras = []
+        node = fs.getNode("cameras")
+        for k in range(node.size()):
+            item = node.at(k)
+            orientation = item.getNode("orientation")
+            cameras.append(RigCamera(item.getNode("name").string(),
+                                     read_ints(item.getNode("rect")),
+                                     None if orientation.empty() else orientation.string()))
+
+        overlaps = []
+        node = fs.getNode("overlaps")
+        for k in range(node.size()):
+            item = node.at(k)
+            names = item.getNode("cameras")
+            overlaps.append(RigOverlap(names.at(0).string(),
+                                       names.at(1).string(),
+                                       read_ints(item.getNode("rect"))))
+        fs.release()
+        return cls(canvas_size, cameras, overlaps, car_rect)
+
+    def make_camera_models(self, yaml_dir):
+        """
+        Create a `FisheyeCameraModel` for each camera from "<yaml_dir>/<name>.yaml".
+        """
+        return [FisheyeCameraModel(os.path.join(yaml_dir, camera.name + ".yaml"),
+                                   camera.name,
+                                   camera.orientation,
+                                   camera.project_shape)
+                for camera in self.cameras]
+
+
+def save_weights_and_masks(filename, weights, masks):
+    """
+    Save the weights and masks of all overlaps of a rig to a .npz file.
+    It is not compressed, reading it back is a plain copy.
+    """
+    arrays = {}
+    for k, (G, M) in enumerate(zip(weights, masks)):
+        arrays["weight_{}".format(k)] = np.asarray(G, np.float32)
+        arrays["mask_{}".format(k)] = np.asarray(M, np.uint8)
+    # the file may be hot reloaded, it is written aside and renamed so it
+    # is never read half written
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_weights_and_masks(filename):
+    """
+    Read the weights and masks saved by `save_weights_and_masks`.
+    """
+    data = np.load(filename)
+    n = len([key for key in data.files if key.startswith("weight_")])
+    weights = [data["weight_{}".format(k)] for k in range(n)]
+    masks = [data["mask_{}".format(k)].astype(np.uint8) for k in range(n)]
+    return weights, masks
+
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def crop(image, rect, origin=(0, 0)):
+    """
+    The part of an image covering the canvas rectangle `rect`, the image
+    itself covers the canvas starting at `origin`.
+    """
+    x0, y0, x1, y1 = rect
+    ox, oy = origin
+    return image[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+
+
+def tune_gains(x):
+    """
+    Vectorized version of `birdview.tune`, damps large gain corrections.
+    """
+    return np.where(x >= 1, x * np.exp((1 - x) * 0.5), x * np.exp((1 - x) * 0.8))
+
+
+class RigStitcher(object):
+
+    """
+    Stitch the flipped frames of the cameras of a `Rig` into a birdview image.
+    The frames are passed in the order of `rig.cameras`.
+    """
+
+    def __init__(self, rig, regularization=1e-3, band_height=16):
+        """
+        regularization: weight pulling every log gain to zero, keeps the
+            solve well posed and leaves cameras without overlaps untouched.
+        """
+        self.rig = rig
+        self.band_height = band_height
+        self.weights = None
+        self.masks = None
+        self.copy_rects = None
+        self.solver = self.make_gain_solver(regularization)
+
+    def make_gain_solver(self, regularization):
+        """
+        For overlap k between cameras a and b with mean ratio r_k = A / B we
+        want g_a * A = g_b * B, i.e. log g_a - log g_b = -log r_k. The
+        least-squares solution is a fixed linear map of the log ratios, so
+        its matrix only depends on the rig and is computed once.
+        """
+        n = len(self.rig.cameras)
+        m = len(self.rig.overlaps)
+        A = np.zeros((m + n, n))
+        for k, ov in enumerate(self.rig.overlaps):
+            A[k, self.rig.index[ov.camera_a]] = 1
+            A[k, self.rig.index[ov.camera_b]] = -1
+        A[m:] = np.eye(n) * regularization
+        # only the first m columns are needed since the prior rows have target 0
+        return np.linalg.pinv(A)[:, :m]
+
+    def set_weights_and_masks(self, weights, masks):
+        """
+        weights, masks: one 2d array per overlap, in the order of `rig.overlaps`.
+        Weights may also be 3 channel stacks as used by `BirdView`.
+        """
+        # cv2.blendLinear wants single channel float32 weights for both images
+        self.weights = []
+        for G in weights:
+            if G.ndim == 3:
+                G = G[:, :, 0]
+            G = np.ascontiguousarray(G, np.float32)
+            self.weights.append((G, 1 - G))
+        self.masks = [np.asarray(M, np.uint8) for M in masks]
+
+        self.copy_rects = []
+        for camera in self.rig.cameras:
+            x0, y0, _, _ = camera.rect
+            exclusive = np.ones(camera.frame_shape, bool)
+            for ov in self.rig.overlaps:
+                if camera.name in (ov.camera_a, ov.camera_b):
+                    crop(exclusive, ov.rect, (x0, y0))[:] = False
+            rects = utils.mask_to_rects(exclusive, self.band_height)
+            self.copy_rects.append([(x0 + rx0, y0 + ry0, x0 + rx1, y0 + ry1)
+                                    for ry0, ry1, rx0, rx1 in rects])
+        return self
+
+    def compute_weights_and_masks(self, frames, camera_models=None, cache=None, workers=None):
+        """
+        Compute the weights and masks of all overlaps from a set of frames on
+        worker processes, returns the two lists. Overlaps found in the
+        `weight_cache.WeightCache` `cache` are not computed again.
+        """
+        pairs, params = [], []
+        for ov in self.rig.overlaps:
+            camA = self.rig.get_camera(ov.camera_a)
+            camB = self.rig.get_camera(ov.camera_b)
+            imA = crop(frames[self.rig.index[ov.camera_a]], ov.rect, camA.rect[:2])
+            imB = crop(frames[self.rig.index[ov.camera_b]], ov.rect, camB.rect[:2])
+            pairs.append((imA, imB))
+            if camera_models is not None:
+                params.append((camera_models[self.rig.index[ov.camera_a]].projection_key(),
+                               camera_models[self.rig.index[ov.camera_b]].projection_key()))
+        results, _ = compute_overlap_weights(pairs, params or None, cache, workers)
+        weights = [G for G, _ in results]
+        masks = [utils.convert_binary_to_bool(M) for _, M in results]
+        self.set_weights_and_masks(weights, masks)
+        return weights, masks
+
+    def compute_gains(self, frames, step=1):
+        """
+        Per camera and per channel luminance gains, an array of shape (n, 3).
+        The means are taken on every `step`-th row and column of the overlaps.
+        """
+        log_ratios = np.zeros((len(self.rig.overlaps), 3))
+        for k, ov in enumerate(self.rig.overlaps):
+            camA = self.rig.get_camera(ov.camera_a)
+            camB = self.rig.get_camera(ov.camera_b)
+            imA = crop(frames[self.rig.index[ov.camera_a]], ov.rect, camA.rect[:2])
+            imB = crop(frames[self.rig.index[ov.camera_b]], ov.rect, camB.rect[:2])
+            # both means are taken over the same pixels, so their ratio is
+            # the ratio of the sums
+            mask = self.masks[k]
+            if step > 1:
+                imA, imB, mask = imA[::step, ::step], imB[::step, ::step], mask[::step, ::step]
+            meanA = np.array(cv2.mean(imA, mask)[:3])
+            meanB = np.array(cv2.mean(imB, mask)[:3])
+            if np.all(meanA > 0) and np.all(meanB > 0):
+                log_ratios[k] = np.log(meanA / meanB)
+
+        gains = np.exp(-self.solver.dot(log_ratios))
+        return tune_gains(gains)
+
+    def stitch(self, frames, canvas, gains=None):
+        """
+        Write the stitched frames into `canvas`. If `gains` is given the
+        frames are scaled by them while being copied and blended.
+        """
+        for k, camera in enumerate(self.rig.cameras):
+            for rect in self.copy_rects[k]:
+                part = crop(frames[k], rect, camera.rect[:2])
+                if gains is not None:
+                    part = cv2.multiply(part, tuple(gains[k]) + (0,))
+                np.copyto(crop(canvas, rect), part)
+
+        for k, ov in enumerate(self.rig.overlaps):
+            a = self.rig.index[ov.camera_a]
+            b = self.rig.index[ov.camera_b]
+            imA = crop(frames[a], ov.rect, self.rig.cameras[a].rect[:2])
+            imB = crop(frames[b], ov.rect, self.rig.cameras[b].rect[:2])
+            if gains is not None:
+                imA = cv2.multiply(imA, tuple(gains[a]) + (0,))
+                imB = cv2.multiply(imB, tuple(gains[b]) + (0,))
+            GA, GB = self.weights[k]
+            np.copyto(crop(canvas, ov.rect), cv2.blendLinear(imA, imB, GA, GB))
+        return canvas
+
+    def render(self, frames, canvas, gains=None, white_balance_gains=None,
+               quality=FULL_QUALITY, car_image=None, end_stage=None):
+        """
+        Render one frame set into `canvas`: luminance gains, stitch, white
+        balance and car image, the per frame work of `BirdView.render_rig`
+        and `RigInstance.process_frame`.
+
+        gains, white_balance_gains: the gains of a previous frame to reuse,
+            computed from the frames when None.
+        end_stage: called with the name of every stage when it is done, e.g.
+            `BaseThread.end_stage`.
+
+        Returns (canvas, gains, white_balance_gains).
+        """
+        if gains is None:
+            gains = self.compute_gains(frames, quality.stats_step)
+        if end_stage is not None:
+            end_stage("luminance_stats")
+
+        self.stitch(frames, canvas, gains)
+        if end_stage is not None:
+            end_stage("stitch")
+
+        if quality.white_balance:
+            if white_balance_gains is None:
+                white_balance_gains = utils.get_white_balance_gains(canvas, quality.stats_step)
+            utils.apply_white_balance(canvas, white_balance_gains, canvas)
+        if end_stage is not None:
+            end_stage("white_balance")
+
+        if self.rig.car_rect is not None and car_image is not None:
+            x0, y0, x1, y1 = self.rig.car_rect
+            np.copyto(canvas[y0:y1, x0:x1], car_image)
+        if end_stage is not None:
+            end_stage("car_image")
+        return canvas, gains, white_balance_gains
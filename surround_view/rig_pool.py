@@ -0,0 +1,296 @@
+"""
+Host several surround view rigs in one process.
+
+Every `RigInstance` carries its own configuration: the `Rig` layout, the
+camera models, the frame sources, the weights and masks, and its statistics.
+A `RigPool` schedules the frames of all its rigs onto a bounded pool of
+worker threads, so the number of threads depends on the number of cores
+instead of the number of cameras. OpenCV releases the GIL in remap, blend
+and the other heavy calls, so the workers run in parallel.
+
+Scheduling is round-robin: a rig that has just had a frame processed goes
+to the back of the queue, and each rig has at most one frame in flight, so
+its frames are stitched in order and a busy rig cannot starve the others.
+"""
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PyQt5.QtCore import qDebug
+
+from . import param_settings as settings
+from .base_thread import BaseThread
+from .birdview import read_weights_and_masks
+from .rig import RigStitcher
+from .quality import FULL_QUALITY
+from .structures import ThreadStatisticsData
+
+
+class RigInstance(object):
+
+    """
+    One rig hosted by a `RigPool`.
+
+    Sources are read synchronously by the worker that processes the rig,
+    so they should not pace themselves (`framerate=0`, `realtime=False` for
+    `VideoFileSource`), use the `framerate` of the instance instead.
+    """
+
+    FPS_STAT_QUEUE_LENGTH = 32
+
+    def __init__(self, name, rig, camera_models, sources, weights_file, masks_file=None,
+                 framerate=0, fused_remap=True, layout=None, quality=FULL_QUALITY):
+        """
+        name: used in statistics and debug messages.
+        rig: the `Rig` layout of this instance.
+        camera_models: `FisheyeCameraModel` objects in the order of `rig.cameras`.
+        sources: one opened or unopened `CaptureSource` per camera, same order.
+        weights_file, masks_file: the .npz file written by `run_get_rig_weights.py`,
+            or weights.png and masks.png for the four camera layout.
+        framerate: frames per second to process this rig at, 0 for as fast
+            as possible.
+        fused_remap: undistort, project and flip every frame with a single
+            remap (see `FisheyeCameraModel.set_output_region`).
+        layout: the `param_settings.Layout` whose car image is drawn in the
+            car rectangle of the rig.
+        quality: the `QualityLevel` the frames are rendered at, e.g. how
+            often the luminance and white balance gains are computed.
+        """
+        if len(camera_models) != len(rig.cameras) or len(sources) != len(rig.cameras):
+            raise ValueError("Rig {} needs one camera model and one source per camera".format(name))
+
+        self.name = name
+        self.layout = layout if layout is not None else settings.default_layout
+        self.rig = rig
+        self.camera_models = camera_models
+        self.sources = sources
+        self.framerate = framerate
+        self.quality = quality
+        self.stitcher = RigStitcher(rig)
+        self.stitcher.set_weights_and_masks(*read_weights_and_masks(weights_file, masks_file))
+        if fused_remap:
+            for model in self.camera_models:
+                if model.fused_rects is None:
+                    model.set_output_region()
+
+        width, height = rig.canvas_size
+        self.image = np.zeros((height, width, 3), np.uint8)
+        self.car_image = None
+        if rig.car_rect is not None:
+            x0, y0, x1, y1 = rig.car_rect
+            self.car_image = self.layout.load_car_image((x1 - x0, y1 - y0))
+
+        self.raw_frames = [None] * len(sources)
+        self.luminance_gains = None
+        self.white_balance_gains = None
+        self.frame_index = 0
+        self.finished = False
+        # the error that made the pool drop this rig, None if it did not fail
+        self.error = None
+        # consumers of the stitched frames, anything with a non-blocking
+        # `submit(frame)` method, e.g. `EncoderThread`
+        self.outputs = []
+        self.next_due = 0
+        self.last_time = None
+        self.fps = deque(maxlen=self.FPS_STAT_QUEUE_LENGTH)
+        self.processing_time = 0
+        self.stat_data = ThreadStatisticsData()
+
+    def add_output(self, output):
+        self.outputs.append(output)
+
+    def open(self):
+        for source in self.sources:
+            if not source.is_opened() and not source.open():
+                return False
+        return True
+
+    def release(self):
+        for source in self.sources:
+            source.release()
+
+    def read_frames(self):
+        """
+        Read one frame of every camera into the reused raw frame arrays,
+        returns False when any source has no more frames.
+        """
+        for k, source in enumerate(self.sources):
+            ok, frame = source.read(self.raw_frames[k])
+            if not ok:
+                return False
+            self.raw_frames[k] = frame
+        return True
+
+    def project_frames(self):
+        frames = []
+        for model, frame in zip(self.camera_models, self.raw_frames):
+            if model.fused_rects is not None:
+                frames.append(model.remap_fused(frame))
+            else:
+                frames.append(model.flip(model.project(model.undistort(frame))))
+        return frames
+
+    def process_frame(self):
+        """
+        Read, project and stitch one frame set, called by a worker of the
+        pool. Returns False when the rig has no more frames.
+        """
+        start = time.perf_counter()
+        if not self.read_frames():
+            self.finished = True
+            self.stat_data.state = "finished"
+            return False
+
+        frames = self.project_frames()
+        update = self.luminance_gains is None or \
+            self.frame_index % self.quality.stats_interval == 0
+        self.image, self.luminance_gains, self.white_balance_gains = self.stitcher.render(
+            frames, self.image,
+            None if update else self.luminance_gains,
+            None if update else self.white_balance_gains,
+            self.quality, self.car_image)
+        self.frame_index += 1
+
+        for output in self.outputs:
+            output.submit(self.image.copy())
+
+        now = time.perf_counter()
+        self.processing_time = (now - start) * 1000
+        self.update_fps(now)
+        self.stat_data.frames_processed_count += 1
+        return True
+
+    def update_fps(self, now):
+        if self.last_time is not None and now > self.last_time:
+            self.fps.append(1.0 / (now - self.last_time))
+        self.last_time = now
+        if len(self.fps) > 0:
+            self.stat_data.average_fps = round(sum(self.fps) / len(self.fps), 2)
+
+
+class RigPool(BaseThread):
+
+    """
+    Schedules the frames of several `RigInstance` objects onto a bounded
+    pool of worker threads. The thread itself only dispatches, the frames
+    are processed by the workers.
+
+    `stat_data` counts the frame sets processed over all rigs, the
+    statistics of each rig are in `RigInstance.stat_data`.
+    """
+
+    def __init__(self, max_workers=None, parent=None):
+        """
+        max_workers: number of worker threads, defaults to the number of cores.
+        """
+        super(RigPool, self).__init__(parent)
+        self.max_workers = max_workers or os.cpu_count()
+        self.instances = []
+        self.ready = deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def add_rig(self, instance):
+        """
+        Add a rig, can be called while the pool is running.
+        """
+        if not instance.open():
+            raise IOError("Cannot open the sources of rig {}".format(instance.name))
+        with self.condition:
+            self.instances.append(instance)
+            self.ready.append(instance)
+            self.condition.notify()
+
+    def remove_rig(self, instance):
+        """
+        Stop scheduling a rig, a frame already in flight is still finished.
+        """
+        with self.condition:
+            if instance in self.instances:
+                self.instances.remove(instance)
+            if instance in self.ready:
+                self.ready.remove(instance)
+        instance.release()
+
+    def is_finished(self):
+        """
+        True when all rigs have run out of frames.
+        """
+        with self.condition:
+            return len(self.ready) == 0 and self.in_flight == 0
+
+    def stop(self):
+        super(RigPool, self).stop()
+        with self.condition:
+            self.condition.notify_all()
+
+    def next_instance(self, timeout=0.1):
+        """
+        The first rig in round-robin order whose next frame is due, or None
+        if there is none within `timeout` seconds or no worker is free.
+        """
+        with self.condition:
+            deadline = time.perf_counter() + timeout
+            while True:
+                now = time.perf_counter()
+                if self.in_flight < self.max_workers:
+                    for instance in self.ready:
+                        if instance.next_due <= now:
+                            self.ready.remove(instance)
+                            self.in_flight += 1
+                            return instance
+
+                wait = deadline - now
+                if wait <= 0:
+                    return None
+                if self.in_flight < self.max_workers and len(self.ready) > 0:
+                    wait = min(wait, max(min(x.next_due for x in self.ready) - now, 0))
+                self.condition.wait(wait)
+
+    def process(self, instance):
+        try:
+            more = instance.process_frame()
+        except Exception as e:
+            qDebug("Rig {} failed: {}".format(instance.name, e))
+            instance.error = e
+            instance.finished = True
+            instance.stat_data.state = "failed"
+            instance.release()
+            more = False
+
+        with self.condition:
+            self.in_flight -= 1
+            if more:
+                if instance.framerate > 0:
+                    instance.next_due = max(instance.next_due + 1.0 / instance.framerate,
+                                            time.perf_counter() - 1.0 / instance.framerate)
+                if instance in self.instances:
+                    self.ready.append(instance)
+                self.stat_data.frames_processed_count += 1
+            elif instance.error is None:
+                qDebug("Rig {} has no more frames".format(instance.name))
+            self.condition.notify()
+
+    def run(self):
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix="rig") as executor:
+            while True:
+                self.stop_mutex.lock()
+                if self.stopped:
+                    self.stopped = False
+                    self.stop_mutex.unlock()
+                    break
+                self.stop_mutex.unlock()
+
+                instance = self.next_instance()
+                if instance is None:
+                    continue
+                executor.submit(self.process, instance)
+
+                self.processing_time = self.clock.elapsed()
+                self.clock.start()
+                self.update_fps(self.processing_time)
+                self.update_statistics_gui.emit(self.stat_data)
+
+        qDebug("Stopping rig pool...")
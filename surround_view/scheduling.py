@@ -0,0 +1,121 @@
+"""
+CPU placement of the pipeline threads.
+
+A `SchedulingConfig` maps the stages of the pipeline ("capture", "process",
+"stitch", "encode", ...) to a `StageSchedule`: the cores the threads of the
+stage may run on and their priority. Threads apply their schedule themselves
+when they start, see `BaseThread.set_schedule`.
+
+OpenCV runs `remap`, `warpPerspective` and friends on its own pool of worker
+threads, and the size of that pool is a single process-wide setting, so it
+is part of the config rather than of the stages.
+"""
+import os
+import threading
+import cv2
+from PyQt5.QtCore import qDebug
+
+
+class StageSchedule(object):
+
+    def __init__(self, cores=None, nice=None):
+        """
+        cores: list of cpu indices the thread may run on, `None` for all.
+        nice: niceness of the thread, -20 (highest priority) to 19 (lowest).
+            Negative values usually need root or CAP_SYS_NICE, `None` to
+            leave it unchanged.
+        """
+        self.cores = list(cores) if cores is not None else None
+        self.nice = nice
+
+    def apply(self, name=""):
+        """
+        Apply the schedule to the calling thread. Settings the OS does not
+        support or allow are skipped with a debug message.
+        """
+        if self.cores is not None:
+            if hasattr(os, "sched_setaffinity"):
+                try:
+                    # pid 0 is the calling thread on linux
+                    os.sched_setaffinity(0, self.cores)
+                except OSError as e:
+                    qDebug("Cannot pin {} to cores {}: {}".format(name, self.cores, e))
+            else:
+                qDebug("Thread affinity is not supported on this platform")
+
+        if self.nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+            except (OSError, AttributeError) as e:
+                qDebug("Cannot set the priority of {} to {}: {}".format(name, self.nice, e))
+
+    def __repr__(self):
+        return "StageSchedule(cores={}, nice={})".format(self.cores, self.nice)
+
+
+class SchedulingConfig(object):
+
+    """
+    Schedules of the pipeline stages.
+    """
+
+    def __init__(self, stages=None, opencv_threads=None, name=""):
+        """
+        stages: dict mapping a stage name, or a (stage name, device id) pair
+            for a single camera, to a `StageSchedule`.
+        opencv_threads: size of the OpenCV worker pool, 0 or 1 to run OpenCV
+            functions in the calling thread, `None` to keep the default.
+        name: shown in benchmark reports.
+        """
+        self.stages = dict(stages) if stages is not None else {}
+        self.opencv_threads = opencv_threads
+        self.name = name
+
+    def get(self, stage, device_id=None):
+        """
+        The schedule of a thread, the per camera entry wins over the stage
+        entry. Returns None if neither is configured.
+        """
+        if device_id is not None and (stage, device_id) in self.stages:
+            return self.stages[(stage, device_id)]
+        return self.stages.get(stage)
+
+    def apply_opencv_threads(self):
+        """
+        Must be called before the pipeline threads start, OpenCV does not
+        allow resizing its pool while it is in use.
+        """
+        if self.opencv_threads is not None:
+            cv2.setNumThreads(self.opencv_threads)
+
+    def assign(self, threads, stage):
+        """
+        Give the threads of a stage their schedules, the device id of a
+        thread is used for per camera entries if it has one.
+        """
+        for thread in threads:
+            schedule = self.get(stage, getattr(thread, "device_id", None))
+            if schedule is not None:
+                thread.set_schedule(schedule, stage)
+
+    @classmethod
+    def spread(cls, device_ids, cores=None, opencv_threads=1, name="spread"):
+        """
+        A config for the cameras `device_ids` that pins the capture threads
+        to the first core, the processing threads round-robin to the
+        remaining cores but the last, and the stitching and encoding threads
+        to the last core. With fewer than three cores nothing is pinned.
+        """
+        if cores is None:
+            cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+                else list(range(os.cpu_count()))
+        if len(cores) < 3:
+            return cls({}, opencv_threads, name)
+
+        stages = {"capture": StageSchedule([cores[0]]),
+                  "stitch": StageSchedule([cores[-1]]),
+                  "encode": StageSchedule([cores[-1]])}
+        workers = cores[1:-1]
+        for k, device_id in enumerate(device_ids):
+            stages[("process", device_id)] = StageSchedule([workers[k % len(workers)]])
+        return cls(stages, opencv_threads, name)
@@ -0,0 +1,115 @@
+"""
+Online check of the alignment of the cameras.
+
+Where two cameras overlap they see the same ground, so the edges of the
+ground are at the same places in both projected frames. A bumped camera
+moves its edges away from those of its neighbours. `SeamMonitor` measures
+how far, in canvas pixels, the edges of one frame of a corner are shifted
+from those of the other one: the gradient magnitudes of the two frames,
+downscaled and windowed by the overlap mask, are phase correlated. The
+shifts measured right after the calibration was loaded are the baseline,
+the score of a corner is how far its shift has moved away from it.
+
+Only one corner is measured per check and checks are `interval` frames
+apart, so the cost is spread thinly over the frames.
+"""
+import numpy as np
+import cv2
+
+
+class SeamMonitor(object):
+
+    def __init__(self, interval=15, threshold=5.0, scale=2, smoothing=0.3, min_response=0.1,
+                 baseline_checks=3):
+        """
+        interval: measure one corner every this many frames.
+        threshold: a corner is flagged when its smoothed score, in canvas
+            pixels, is above this.
+        scale: the overlaps are measured at 1 / scale resolution.
+        smoothing: weight of a new score in the exponential average.
+        min_response: measurements with a weaker phase correlation peak
+            (no texture, or too different frames) are ignored.
+        baseline_checks: number of measurements of each corner averaged
+            into its baseline.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.scale = scale
+        self.smoothing = smoothing
+        self.min_response = min_response
+        self.baseline_checks = baseline_checks
+        self.masks = None
+        self.windows = []
+        self.next_corner = 0
+        self.checks = 0
+        self.shifts = []
+        self.baselines = []
+        self.scores = []
+        self.drift = []
+
+    def due(self, frame_index):
+        return self.interval > 0 and frame_index % self.interval == 0
+
+    def set_masks(self, masks):
+        """
+        Prepare the windows of the overlap masks and start a new baseline.
+        """
+        self.masks = masks
+        self.windows = []
+        for mask in masks:
+            h, w = mask.shape[:2]
+            size = (w // self.scale, h // self.scale)
+            window = cv2.resize(np.float32(mask), size, interpolation=cv2.INTER_AREA)
+            # soft edges, the border of the mask must not look like an edge
+            self.windows.append(cv2.GaussianBlur(window, (0, 0), 4))
+        n = len(masks)
+        self.next_corner = 0
+        self.shifts = [None] * n
+        self.baselines = [[] for _ in range(n)]
+        self.scores = [None] * n
+        self.drift = [False] * n
+
+    def edges(self, image, k):
+        if image.ndim == 3:
+            image = image[:, :, 1]
+        window = self.windows[k]
+        small = cv2.resize(image, window.shape[::-1], interpolation=cv2.INTER_AREA)
+        small = np.float32(small)
+        gx = cv2.Sobel(small, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(small, cv2.CV_32F, 0, 1)
+        return cv2.magnitude(gx, gy) * window
+
+    def measure(self, imA, imB, k):
+        """
+        Shift (dx, dy) in canvas pixels of the edges of `imB` relative to
+        those of `imA`, the two frames of corner `k` cropped to its mask, and
+        the strength of the correlation peak.
+        """
+        (dx, dy), response = cv2.phaseCorrelate(self.edges(imA, k), self.edges(imB, k))
+        return (dx * self.scale, dy * self.scale), response
+
+    def update(self, imA, imB):
+        """
+        Measure the corner whose turn it is. Returns its index.
+        """
+        k = self.next_corner
+        self.next_corner = (k + 1) % len(self.windows)
+        self.checks += 1
+        shift, response = self.measure(imA, imB, k)
+        if response < self.min_response:
+            return k
+
+        self.shifts[k] = shift
+        baseline = self.baselines[k]
+        if len(baseline) < self.baseline_checks:
+            baseline.append(shift)
+            return k
+
+        bx, by = np.mean(baseline, axis=0)
+        score = float(np.hypot(shift[0] - bx, shift[1] - by))
+        if self.scores[k] is None:
+            self.scores[k] = score
+        else:
+            self.scores[k] += self.smoothing * (score - self.scores[k])
+        self.drift[k] = self.scores[k] > self.threshold
+        return k
@@ -0,0 +1,222 @@
+"""
+A ring of birdview frames in POSIX shared memory.
+
+The stitching process creates a `BirdViewPublisher` and writes every frame
+into the next slot of the ring. Other processes open a `BirdViewReader` with
+the same name and map the latest frame without copying it.
+
+Memory layout: a global header followed by `slots` slots, each slot is a
+slot header followed by the image data.
+
+    global header (8 x uint64): magic, version, slots, height, width,
+                                channels, dtype code, latest sequence number
+    slot header (4 x uint64):   sequence number, capture timestamp (ms),
+                                publish timestamp (ns), reserved
+
+The capture timestamp is the time the oldest camera frame of the stitched
+frame was captured, in milliseconds since midnight (the `ImageFrame`
+timestamps of the capture threads), 0 if it is not known. The publish
+timestamp is `time.time_ns()` when the frame was written.
+
+A slot's sequence number is set to 0 while the slot is being written, so a
+reader can detect that a frame it is holding has been overwritten.
+"""
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+MAGIC = 0x53564952  # "SVIR"
+VERSION = 1
+HEADER_SIZE = 8
+SLOT_HEADER_SIZE = 4
+DTYPES = [np.uint8, np.uint16, np.float32]
+# the rings created by publishers of this process
+_published_names = set()
+
+
+def slot_layout(height, width, channels, dtype):
+    """
+    Return (image bytes, slot bytes), the slot size is rounded up to 64 bytes.
+    """
+    image_bytes = height * width * channels * np.dtype(dtype).itemsize
+    slot_bytes = SLOT_HEADER_SIZE * 8 + image_bytes
+    slot_bytes = (slot_bytes + 63) // 64 * 64
+    return image_bytes, slot_bytes
+
+
+class SharedFrame(object):
+
+    def __init__(self, seq, capture_timestamp, publish_timestamp, image, slot_header):
+        self.seq = seq
+        self.capture_timestamp = capture_timestamp
+        self.publish_timestamp = publish_timestamp
+        self.image = image
+        self._slot_header = slot_header
+
+    def is_valid(self):
+        """
+        False if the publisher has started overwriting this frame. Check it
+        after using `image` to make sure the data was not torn.
+        """
+        return int(self._slot_header[0]) == self.seq
+
+
+class BirdViewPublisher(object):
+
+    """
+    Writes frames of a fixed shape into a named shared memory ring.
+    """
+
+    def __init__(self, name, shape, dtype=np.uint8, slots=4):
+        """
+        name: name of the shared memory block, e.g. "surround_view".
+        shape: (height, width) or (height, width, channels) of the frames.
+        slots: number of frames kept in the ring. Readers that fall more than
+            `slots - 1` frames behind will see overruns.
+        """
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) == 3 else 1
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.image_bytes, self.slot_bytes = slot_layout(height, width, channels, dtype)
+        size = HEADER_SIZE * 8 + slots * self.slot_bytes
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _published_names.add(self.shm.name)
+        self.header = np.ndarray((HEADER_SIZE,), np.uint64, self.shm.buf)
+        self.header[:] = (MAGIC, VERSION, slots, height, width, channels,
+                          DTYPES.index(self.dtype.type), 0)
+        self.slot_headers = []
+        self.slot_images = []
+        for k in range(slots):
+            offset = HEADER_SIZE * 8 + k * self.slot_bytes
+            slot_header = np.ndarray((SLOT_HEADER_SIZE,), np.uint64, self.shm.buf, offset)
+            slot_header[:] = 0
+            self.slot_headers.append(slot_header)
+            self.slot_images.append(np.ndarray(self.shape, self.dtype, self.shm.buf,
+                                               offset + SLOT_HEADER_SIZE * 8))
+        self.seq = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, image, capture_timestamp=0):
+        """
+        Copy a frame into the next slot and make it the latest frame.
+
+        capture_timestamp: capture time of the frame in milliseconds since
+            midnight, 0 if it is not known. It wraps to 0 at midnight, a
+            reader comparing it with its own clock must allow for that.
+        """
+        self.seq += 1
+        slot = self.seq % self.slots
+        slot_header = self.slot_headers[slot]
+        # mark the slot as being written
+        slot_header[0] = 0
+        np.copyto(self.slot_images[slot], image)
+        slot_header[1] = capture_timestamp
+        slot_header[2] = time.time_ns()
+        slot_header[0] = self.seq
+        self.header[7] = self.seq
+        return self.seq
+
+    def close(self):
+        self.header = None
+        self.slot_headers = []
+        self.slot_images = []
+        self.shm.close()
+        self.shm.unlink()
+        _published_names.discard(self.shm.name)
+
+
+class BirdViewReader(object):
+
+    """
+    Maps the frames published by a `BirdViewPublisher` in another process.
+    """
+
+    def __init__(self, name):
+        # python registers attached blocks too and would unlink the ring when
+        # the reader exits, only the publisher owns it.
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=False, track=False)
+        except TypeError:
+            # python < 3.13, unregister the block by hand. In the process of
+            # the publisher the registration is the publisher's own.
+            self.shm = shared_memory.SharedMemory(name=name, create=False)
+            if os.name == "posix" and self.shm.name not in _published_names:
+                # the tracker knows POSIX blocks by their name with a slash
+                resource_tracker.unregister("/" + self.shm.name, "shared_memory")
+        self.header = np.ndarray((HEADER_SIZE,), np.uint64, self.shm.buf)
+        magic, version, slots, height, width, channels, dtype_code, _ = [int(x) for x in self.header]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a birdview ring: {}".format(name))
+
+        self.slots = slots
+        self.dtype = np.dtype(DTYPES[dtype_code])
+        self.shape = (height, width) if channels == 1 else (height, width, channels)
+        _, self.slot_bytes = slot_layout(height, width, channels, self.dtype)
+        self.last_seq = 0
+        # number of frames published but never seen by this reader
+        self.dropped = 0
+        # number of frames overwritten while this reader was mapping them
+        self.overruns = 0
+
+    def latest_seq(self):
+        return int(self.header[7])
+
+    def get_latest(self):
+        """
+        Return the latest frame as a `SharedFrame` whose image is a view into
+        shared memory, or None if no new frame has been published since the
+        last call.
+        """
+        seq = self.latest_seq()
+        if seq == 0 or seq == self.last_seq:
+            return None
+
+        slot = seq % self.slots
+        offset = HEADER_SIZE * 8 + slot * self.slot_bytes
+        slot_header = np.ndarray((SLOT_HEADER_SIZE,), np.uint64, self.shm.buf, offset)
+        image = np.ndarray(self.shape, self.dtype, self.shm.buf, offset + SLOT_HEADER_SIZE * 8)
+        frame = SharedFrame(seq, int(slot_header[1]), int(slot_header[2]), image, slot_header)
+        if not frame.is_valid():
+            # the publisher lapped the ring since reading the header
+            self.overruns += 1
+            return None
+
+        if self.last_seq > 0 and seq > self.last_seq + 1:
+            self.dropped += seq - self.last_seq - 1
+        self.last_seq = seq
+        return frame
+
+    def wait_latest(self, timeout=1.0, poll_interval=0.001):
+        """
+        Poll for a new frame, return None on timeout.
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            frame = self.get_latest()
+            if frame is not None:
+                return frame
+            time.sleep(poll_interval)
+        return None
+
+    def release(self, frame):
+        """
+        Finish using a frame, returns False if it was overwritten meanwhile.
+        """
+        if frame.is_valid():
+            return True
+        self.overruns += 1
+        return False
+
+    def close(self):
+        """
+        All frames returned by this reader must be released before closing.
+        """
+        self.header = None
+        self.shm.close()
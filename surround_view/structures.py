@@ -1,8 +1,13 @@
+MSECS_PER_DAY = 24 * 3600 * 1000
+
+
 class ImageFrame(object):
 
-    def __init__(self, timestamp, image):
+    def __init__(self, timestamp, image, pixel_format="BGR"):
         self.timestamp = timestamp
         self.image = image
+        # "BGR", or "NV12"/"I420" if the image is a single channel yuv frame
+        self.pixel_format = pixel_format
 
 
 class ThreadStatisticsData(object):
@@ -10,3 +15,69 @@ class ThreadStatisticsData(object):
     def __init__(self):
         self.average_fps = 0
         self.frames_processed_count = 0
+        self.frames_dropped_count = 0
+        # frames not processed because they did not change, see `MotionGate`
+        self.frames_reused_count = 0
+        # index of the `QualityLevel` in use, 0 is the best quality
+        self.quality_level = 0
+        # misalignment of the corners in canvas pixels (None until measured)
+        # and whether one of them drifted, see `SeamMonitor`
+        self.seam_scores = []
+        self.seam_drift = False
+        # "running", "finished" when the source ran out of frames or
+        # "failed", for work that can stop on its own (see `RigPool`)
+        self.state = "running"
+
+
+class SyncedFrames(dict):
+
+    """
+    The projected frames of all cameras for one stitched frame, keyed by
+    device id. `stale` holds the devices whose frame is the last good frame
+    of a stalled camera rather than a new one, `raw` the raw camera frames
+    the projected frames were made from and `timestamps` the capture
+    timestamps of the raw frames (see `ImageFrame`), when the processing
+    threads provide them.
+    """
+
+    def __init__(self, frames, stale=(), raw=None, timestamps=None):
+        super(SyncedFrames, self).__init__(frames)
+        self.stale = set(stale)
+        self.raw = dict(raw) if raw is not None else {}
+        self.timestamps = dict(timestamps) if timestamps is not None else {}
+
+    def capture_timestamp(self):
+        """
+        Capture timestamp of the oldest new frame of the set, stale frames
+        only count when all frames are stale. None if none is known.
+        """
+        fresh = [t for device_id, t in self.timestamps.items() if device_id not in self.stale]
+        if len(fresh) == 0:
+            fresh = list(self.timestamps.values())
+        if len(fresh) == 0:
+            return None
+        # the timestamps are milliseconds since midnight, if the set spans
+        # midnight the oldest one is among the largest
+        if max(fresh) - min(fresh) > MSECS_PER_DAY // 2:
+            return min(t for t in fresh if t > MSECS_PER_DAY // 2)
+        return min(fresh)
+
+
+class CameraHealth(object):
+
+    def __init__(self, device_id, state="ok", frame_age=0, consecutive_failures=0,
+                 reconnect_count=0):
+        """
+        state: "ok", "stalled" (no frame for longer than the stall timeout),
+            "reconnecting" or "disconnected".
+        frame_age: milliseconds since the last frame was read.
+        """
+        self.device_id = device_id
+        self.state = state
+        self.frame_age = frame_age
+        self.consecutive_failures = consecutive_failures
+        self.reconnect_count = reconnect_count
+
+    def __repr__(self):
+        return "CameraHealth({}: {}, last frame {} ms ago, {} reconnects)".format(
+            self.device_id, self.state, self.frame_age, self.reconnect_count)
@@ -2,28 +2,119 @@ import cv2
 import numpy as np
 
 
+# nvvidconv and videoflip number their flip methods differently, this maps
+# the nvvidconv convention used throughout this repo to videoflip's.
+NVVIDCONV_TO_VIDEOFLIP = {0: 0, 1: 3, 2: 2, 3: 1, 4: 4, 5: 7, 6: 5, 7: 6}
+
+
 def gstreamer_pipeline(cam_id=0,
                        capture_width=960,
                        capture_height=640,
                        framerate=60,
-                       flip_method=2):
-    """
-    Use libgstreamer to open csi-cameras.
-    """
-    return ("nvarguscamerasrc sensor-id={} ! ".format(cam_id) + \
-            "video/x-raw(memory:NVMM), "
-            "width=(int)%d, height=(int)%d, "
-            "format=(string)NV12, framerate=(fraction)%d/1 ! "
-            "nvvidconv flip-method=%d ! "
-            "video/x-raw, format=(string)BGRx ! "
-            "videoconvert ! "
-            "video/x-raw, format=(string)BGR ! appsink"
-            % (capture_width,
-               capture_height,
-               framerate,
-               flip_method
-            )
-    )
+                       flip_method=2,
+                       source="nvarguscamerasrc",
+                       location=None,
+                       output_format="BGR",
+                       drop=True,
+                       max_buffers=1,
+                       sync=False):
+    """
+    Build a GStreamer pipeline string for `cv2.VideoCapture`.
+
+    source: one of "nvarguscamerasrc" (csi cameras on jetson), "v4l2src"
+        (usb cameras, `cam_id` is the /dev/video index), "videotestsrc"
+        (no hardware needed, `cam_id` selects the test pattern) or "filesrc"
+        (`location` is the path of a video file).
+    flip_method: flip method in the convention of nvvidconv, 0 for identity,
+        2 for 180 degree rotation.
+    output_format: pixel format delivered to the appsink, "BGR", "GRAY8",
+        "NV12" or "I420".
+    drop, max_buffers, sync: queue policy of the appsink. The defaults keep
+        only the newest frame so that stale frames are not queued inside
+        GStreamer when the consumer is slower than the camera, use
+        drop=False, max_buffers=0, sync=True to get the old behaviour.
+    """
+    caps = "width=(int)%d, height=(int)%d, framerate=(fraction)%d/1" % (
+        capture_width, capture_height, framerate)
+
+    if source == "nvarguscamerasrc":
+        elements = ["nvarguscamerasrc sensor-id=%d" % cam_id,
+                    "video/x-raw(memory:NVMM), %s, format=(string)NV12" % caps,
+                    "nvvidconv flip-method=%d" % flip_method]
+        # nvvidconv can output NV12/I420/GRAY8 directly, only BGR needs a cpu conversion
+        if output_format == "BGR":
+            elements += ["video/x-raw, format=(string)BGRx", "videoconvert"]
+    else:
+        if source == "v4l2src":
+            elements = ["v4l2src device=/dev/video%d" % cam_id,
+                        "video/x-raw, %s" % caps]
+        elif source == "videotestsrc":
+            elements = ["videotestsrc is-live=true pattern=%d" % cam_id,
+                        "video/x-raw, %s" % caps]
+        elif source == "filesrc":
+            if location is None:
+                raise ValueError("filesrc requires the location of a video file")
+            elements = ["filesrc location=%s" % location,
+                        "decodebin",
+                        "videoconvert",
+                        "videoscale",
+                        "video/x-raw, width=(int)%d, height=(int)%d" % (capture_width,
+                                                                         capture_height)]
+        else:
+            raise ValueError("Unknown gstreamer source: {}".format(source))
+
+        if flip_method != 0:
+            elements.append("videoflip method=%d" % NVVIDCONV_TO_VIDEOFLIP[flip_method])
+        elements.append("videoconvert")
+
+    elements.append("video/x-raw, format=(string)%s" % output_format)
+    elements.append("appsink drop=%s max-buffers=%d sync=%s" % (
+        str(drop).lower(), max_buffers, str(sync).lower()))
+    return " ! ".join(elements)
+
+
+def split_yuv(frame, pixel_format="NV12"):
+    """
+    Split a NV12 or I420 frame (a single channel array of shape (h*3/2, w))
+    into its luma plane of shape (h, w) and an interleaved chroma plane of
+    shape (h/2, w/2, 2). For NV12 both planes are views of the frame.
+    """
+    h = frame.shape[0] * 2 // 3
+    w = frame.shape[1]
+    y = frame[:h]
+    if pixel_format == "NV12":
+        uv = frame[h:].reshape(h // 2, w // 2, 2)
+    elif pixel_format == "I420":
+        u, v = frame[h:].reshape(2, h // 2, w // 2)
+        uv = cv2.merge((u, v))
+    else:
+        raise ValueError("Unsupported yuv format: {}".format(pixel_format))
+    return y, uv
+
+
+def pack_yuv(y, uv):
+    """
+    Pack a luma plane and an interleaved chroma plane into a NV12 frame.
+    """
+    h, w = y.shape
+    frame = np.empty((h * 3 // 2, w), np.uint8)
+    frame[:h] = y
+    frame[h:].reshape(h // 2, w // 2, 2)[...] = uv
+    return frame
+
+
+def bgr_to_yuv(image):
+    """
+    Convert a BGR image with even width and height to (luma, chroma) planes.
+    """
+    return split_yuv(cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420), "I420")
+
+
+def yuv_to_bgr(y, uv):
+    """
+    Convert (luma, chroma) planes to a BGR image.
+    """
+    return cv2.cvtColorTwoPlane(y, uv, cv2.COLOR_YUV2BGR_NV12)
 
 
 def convert_binary_to_bool(mask):
@@ -31,7 +122,7 @@ def convert_binary_to_bool(mask):
     Convert a binary image (only one channel and pixels are 0 or 255) to
     a bool one (all pixels are 0 or 1).
     """
-    return (mask.astype(np.float64) / 255.0).astype(int)
+    return (mask == 255).astype(np.uint8)
 
 
 def adjust_luminance(gray, factor):
@@ -124,19 +215,55 @@ def get_weight_mask_matrix(imA, imB, dist_threshold=5):
     return G, overlapMask
 
 
-def make_white_balance(image):
+def mask_to_rects(mask, band_height=16):
     """
-    Adjust white balance of an image base on the means of its channels.
+    Cover the nonzero pixels of a mask with rectangles (y0, y1, x0, x1):
+    the mask is cut into horizontal bands and each band is shrunk to the
+    columns it uses. Adjacent bands with the same columns are joined.
     """
+    rects = []
+    for y0 in range(0, mask.shape[0], band_height):
+        y1 = min(y0 + band_height, mask.shape[0])
+        cols = np.flatnonzero(mask[y0:y1].any(axis=0))
+        if len(cols) == 0:
+            continue
+        x0, x1 = int(cols[0]), int(cols[-1]) + 1
+        if len(rects) > 0 and rects[-1][1] == y0 and rects[-1][2:] == (x0, x1):
+            rects[-1] = (rects[-1][0], y1, x0, x1)
+        else:
+            rects.append((y0, y1, x0, x1))
+    return rects
+
+
+def get_white_balance_gains(image, step=1):
+    """
+    Gains (c1, c2, c3) that make the means of the B, G, R channels equal,
+    the means are taken over every `step`-th row and column.
+    """
+    if step > 1:
+        image = image[::step, ::step]
     B, G, R = cv2.split(image)
     m1 = np.mean(B)
     m2 = np.mean(G)
     m3 = np.mean(R)
     K = (m1 + m2 + m3) / 3
-    c1 = K / m1
-    c2 = K / m2
-    c3 = K / m3
+    return K / m1, K / m2, K / m3
+
+
+def apply_white_balance(image, gains, out=None):
+    """
+    out: the array the result is written into, it may be `image` itself.
+    """
+    B, G, R = cv2.split(image)
+    c1, c2, c3 = gains
     B = adjust_luminance(B, c1)
     G = adjust_luminance(G, c2)
     R = adjust_luminance(R, c3)
-    return cv2.merge((B, G, R))
+    return cv2.merge((B, G, R), out)
+
+
+def make_white_balance(image):
+    """
+    Adjust white balance of an image base on the means of its channels.
+    """
+    return apply_white_balance(image, get_white_balance_gains(image))
@@ -0,0 +1,297 @@
+"""
+Accuracy of the fast rendering modes against the reference pipeline.
+
+The reference undistorts, projects and flips every camera frame with
+`FisheyeCameraModel` and stitches them with `BirdView` at full quality.
+Every `RenderMode` renders the same raw frames its own way, the results
+are compared region by region of the canvas (PSNR, SSIM and the largest
+absolute error) and checked against the tolerances the mode declares.
+"""
+import os
+import time
+import numpy as np
+import cv2
+
+from . import param_settings as settings
+from . import utils
+from .fisheye_camera import FisheyeCameraModel
+from .birdview import BirdView
+from .motion import MotionGate
+from .structures import SyncedFrames
+from .quality import QUALITY_LEVELS, FULL_QUALITY
+from .viewports import Viewport, ViewportRenderer
+
+
+def canvas_regions(layout=None):
+    """
+    The eight regions of the canvas around the car, name -> (x0, y0, x1, y1).
+    """
+    lay = layout if layout is not None else settings.default_layout
+    xs = (0, lay.xl, lay.xr, lay.total_w)
+    ys = (0, lay.yt, lay.yb, lay.total_h)
+    names = (("FL", "F", "FR"), ("L", None, "R"), ("BL", "B", "BR"))
+    regions = {}
+    for i in range(3):
+        for j in range(3):
+            if names[i][j] is not None:
+                regions[names[i][j]] = (xs[j], ys[i], xs[j + 1], ys[i + 1])
+    return regions
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b)**2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0**2 / mse)
+
+
+def ssim(a, b):
+    """
+    Mean structural similarity of the luminance of two BGR images, with the
+    usual 11x11 gaussian window of sigma 1.5.
+    """
+    a = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255)**2, (0.03 * 255)**2
+
+    def blur(x):
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+
+    ma, mb = blur(a), blur(b)
+    va = blur(a * a) - ma * ma
+    vb = blur(b * b) - mb * mb
+    cov = blur(a * b) - ma * mb
+    s = ((2 * ma * mb + c1) * (2 * cov + c2)) / ((ma**2 + mb**2 + c1) * (va + vb + c2))
+    return float(s.mean())
+
+
+def compare(reference, image, layout=None):
+    """
+    PSNR, SSIM and largest absolute error of `image` against `reference`,
+    for every region of the canvas. Returns name -> (psnr, ssim, max_abs).
+    """
+    metrics = {}
+    for name, (x0, y0, x1, y1) in canvas_regions(layout).items():
+        a, b = reference[y0:y1, x0:x1], image[y0:y1, x0:x1]
+        metrics[name] = (psnr(a, b), ssim(a, b),
+                         int(np.abs(a.astype(np.int16) - b).max()))
+    return metrics
+
+
+def load_camera_models(yamls_dir, layout=None):
+    return [FisheyeCameraModel(os.path.join(yamls_dir, name + ".yaml"), name, layout=layout)
+            for name in settings.camera_names]
+
+
+class RenderMode(object):
+
+    """
+    A way of rendering the birdview from raw BGR frames, with the tolerances
+    it must meet against the reference in every region.
+    """
+
+    def __init__(self, name, min_psnr=None, min_ssim=None, max_abs=None):
+        self.name = name
+        self.min_psnr = min_psnr
+        self.min_ssim = min_ssim
+        self.max_abs = max_abs
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        self.camera_models = load_camera_models(yamls_dir, layout)
+        self.birdview = BirdView(layout=layout)
+        self.birdview.load_weights_and_masks(*weights_files)
+
+    def project(self, raw_frames):
+        return [m.flip(m.project(m.undistort(frame)))
+                for m, frame in zip(self.camera_models, raw_frames)]
+
+    def render(self, raw_frames):
+        self.birdview.update_frames(self.project(raw_frames))
+        return self.birdview.render_bgr(FULL_QUALITY)
+
+    def next_frame(self, raw_frames):
+        """
+        Render a frame set and count it as `BirdView.run` does.
+        """
+        image = self.render(raw_frames)
+        self.birdview.frame_index += 1
+        return image
+
+    def failures(self, metrics):
+        """
+        Descriptions of the tolerances not met by the worst of `metrics`,
+        name -> (psnr, ssim, max_abs) as returned by `compare`.
+        """
+        failed = []
+        for region, (p, s, m) in sorted(metrics.items()):
+            if self.min_psnr is not None and p < self.min_psnr:
+                failed.append("{} PSNR {:.1f} < {}".format(region, p, self.min_psnr))
+            if self.min_ssim is not None and s < self.min_ssim:
+                failed.append("{} SSIM {:.4f} < {}".format(region, s, self.min_ssim))
+            if self.max_abs is not None and m > self.max_abs:
+                failed.append("{} max abs {} > {}".format(region, m, self.max_abs))
+        return failed
+
+
+class FusedRemapMode(RenderMode):
+
+    """
+    `BirdView.crop_camera_models`: one remap per camera, of the used pixels only.
+    """
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        super(FusedRemapMode, self).setup(yamls_dir, weights_files, layout)
+        self.birdview.crop_camera_models(self.camera_models)
+
+    def project(self, raw_frames):
+        return [m.remap_fused(frame) for m, frame in zip(self.camera_models, raw_frames)]
+
+
+class QualityMode(RenderMode):
+
+    """
+    The reference frames stitched at a lower `QualityLevel`.
+    """
+
+    def __init__(self, name, level, **tolerances):
+        super(QualityMode, self).__init__(name, **tolerances)
+        self.level = level
+
+    def render(self, raw_frames):
+        self.birdview.update_frames(self.project(raw_frames))
+        return self.birdview.render_bgr(self.level)
+
+
+class YuvMode(RenderMode):
+
+    """
+    Frames converted to yuv, processed and stitched as (luma, chroma) planes.
+    """
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        self.camera_models = load_camera_models(yamls_dir, layout)
+        self.birdview = BirdView(pixel_format="NV12", layout=layout)
+        self.birdview.load_weights_and_masks(*weights_files)
+
+    def render(self, raw_frames):
+        frames = []
+        for m, frame in zip(self.camera_models, raw_frames):
+            frames.append(m.flip_yuv(*m.project_yuv(*m.undistort_yuv(*utils.bgr_to_yuv(frame)))))
+        self.birdview.update_frames(frames)
+        return self.birdview.render_yuv(FULL_QUALITY)
+
+
+class CompactWeightsMode(RenderMode):
+
+    """
+    The float32 weights shared by the three channels of a `MemoryBudget`.
+    """
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        self.camera_models = load_camera_models(yamls_dir, layout)
+        self.birdview = BirdView(layout=layout, compact_weights=True)
+        self.birdview.load_weights_and_masks(*weights_files)
+
+
+class MotionGatingMode(RenderMode):
+
+    """
+    Cameras whose frame a `MotionGate` finds unchanged are not processed and
+    their regions are kept from the previous canvas (`reuse_unchanged`).
+    """
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        super(MotionGatingMode, self).setup(yamls_dir, weights_files, layout)
+        self.birdview.reuse_unchanged = True
+        self.gates = [MotionGate() for _ in self.camera_models]
+        self.last_frames = [None] * len(self.camera_models)
+
+    def render(self, raw_frames):
+        frames = []
+        for k, (m, frame) in enumerate(zip(self.camera_models, raw_frames)):
+            if self.last_frames[k] is None or self.gates[k].changed(frame):
+                self.last_frames[k] = m.flip(m.project(m.undistort(frame)))
+            frames.append(self.last_frames[k])
+        self.birdview.update_synced_frames(SyncedFrames(dict(enumerate(frames))))
+        return self.birdview.render_bgr(FULL_QUALITY)
+
+
+class ViewportMode(FusedRemapMode):
+
+    """
+    The whole canvas rendered as a `Viewport`, straight from the raw frames,
+    with the gains of the fused remap pipeline. Its time includes the stitch
+    the gains come from.
+    """
+
+    def setup(self, yamls_dir, weights_files, layout=None):
+        super(ViewportMode, self).setup(yamls_dir, weights_files, layout)
+        lay = self.birdview.layout
+        self.renderer = ViewportRenderer([Viewport("canvas", (lay.total_w, lay.total_h))],
+                                         self.camera_models, self.birdview.weights, lay)
+
+    def render(self, raw_frames):
+        super(ViewportMode, self).render(raw_frames)
+        return self.renderer.render(raw_frames, self.birdview.luminance_gains,
+                                    self.birdview.white_balance_gains)["canvas"]
+
+
+def default_modes():
+    """
+    The fast modes of the tree with their declared tolerances. The levels
+    that skip the white balance or change the resolution are expected to
+    look different, their tolerances only guard against gross errors.
+    """
+    levels = {level.name: level for level in QUALITY_LEVELS}
+    return [
+        FusedRemapMode("fused remap", min_psnr=24, min_ssim=0.83),
+        QualityMode("gains every 4 frames", levels["gains every 4 frames"],
+                    min_psnr=30, min_ssim=0.98),
+        QualityMode("subsampled statistics", levels["subsampled statistics"],
+                    min_psnr=22, min_ssim=0.98),
+        QualityMode("half resolution", levels["half resolution"], min_psnr=20, min_ssim=0.78),
+        YuvMode("yuv planes", min_psnr=27, min_ssim=0.94),
+        CompactWeightsMode("compact weights", min_psnr=60, min_ssim=0.999, max_abs=2),
+        MotionGatingMode("motion gating", min_psnr=25, min_ssim=0.97),
+        ViewportMode("viewport", min_psnr=23, min_ssim=0.83),
+    ]
+
+
+def validate(frame_sets, modes, yamls_dir, weights_files, layout=None):
+    """
+    Render every set of raw frames (front, back, left, right) with the
+    reference and each mode.
+
+    Returns a list of dicts, the reference first, with the mode, its mean
+    time per frame set in ms, the worst metrics of every region over all
+    frame sets and the tolerances it failed.
+    """
+    reference = RenderMode("reference")
+    for mode in [reference] + modes:
+        mode.setup(yamls_dir, weights_files, layout)
+
+    results = {mode.name: {"mode": mode, "time": 0.0, "metrics": {}}
+               for mode in [reference] + modes}
+    count = 0
+    for raw_frames in frame_sets:
+        count += 1
+        start = time.perf_counter()
+        expected = reference.next_frame(raw_frames).copy()
+        results[reference.name]["time"] += time.perf_counter() - start
+        for mode in modes:
+            start = time.perf_counter()
+            image = mode.next_frame(raw_frames)
+            results[mode.name]["time"] += time.perf_counter() - start
+            worst = results[mode.name]["metrics"]
+            for region, (p, s, m) in compare(expected, image, layout).items():
+                if region in worst:
+                    wp, ws, wm = worst[region]
+                    p, s, m = min(p, wp), min(s, ws), max(m, wm)
+                worst[region] = (p, s, m)
+
+    report = []
+    for mode in [reference] + modes:
+        r = results[mode.name]
+        report.append({"mode": mode,
+                       "time": 1000 * r["time"] / max(count, 1),
+                       "metrics": r["metrics"],
+                       "failures": mode.failures(r["metrics"]) if mode is not reference else []})
+    return report
@@ -0,0 +1,202 @@
+"""
+Extra output views rendered directly from the raw camera frames.
+
+A `Viewport` is a rectangle of the birdview canvas, or of the undistorted
+image of one camera, shown at a given output size. Instead of cropping and
+resizing the stitched canvas, `ViewportRenderer` precomputes for every view
+where each of its output pixels comes from in the raw frames and with which
+blending weight, so a view only costs its own output pixels, at any zoom,
+and uses the luminance and white balance gains of the stitcher.
+"""
+import numpy as np
+import cv2
+
+from . import param_settings as settings
+from . import utils
+
+
+class Viewport(object):
+
+    def __init__(self, name, size, rect=None, camera=None):
+        """
+        name: key of the view in the rendered dict.
+        size: (width, height) of the output image.
+        rect: (x0, y0, x1, y1) the part of the birdview canvas shown, or of
+            the undistorted image if `camera` is given, the whole image if
+            not given.
+        camera: name of a camera, show its undistorted image instead of the
+            birdview.
+        """
+        self.name = name
+        self.size = tuple(int(x) for x in size)
+        self.rect = tuple(rect) if rect is not None else None
+        self.camera = camera
+
+    def __repr__(self):
+        return "Viewport({!r}, {}, rect={}, camera={})".format(self.name, self.size, self.rect,
+                                                              self.camera)
+
+
+def sample_grid(rect, size):
+    """
+    Coordinates of the centers of the output pixels of a view of size
+    (width, height) showing `rect`, in the coordinates of the shown image.
+    """
+    x0, y0, x1, y1 = rect
+    w, h = size
+    xs = x0 + (np.arange(w) + 0.5) * (x1 - x0) / w - 0.5
+    ys = y0 + (np.arange(h) + 0.5) * (y1 - y0) / h - 0.5
+    return np.meshgrid(xs, ys)
+
+
+def canvas_offsets(layout):
+    """
+    Position on the canvas of the flipped frames of the four cameras.
+    """
+    return [(0, 0), (0, layout.yb), (0, 0), (layout.xr, 0)]
+
+
+class ViewportRenderer(object):
+
+    """
+    Lookup tables of a list of viewports for the four camera layout.
+    """
+
+    def __init__(self, viewports, camera_models, weights, layout=None, band_height=16):
+        """
+        viewports: a list of `Viewport`.
+        camera_models: the `FisheyeCameraModel` of the cameras, in the order
+            of `layout.camera_names`.
+        weights: the weights of the four corners, as used by `BirdView`.
+        band_height: the pixels taken from a camera are covered by bands of
+            this height, see `utils.mask_to_rects`.
+        """
+        self.viewports = list(viewports)
+        self.camera_models = list(camera_models)
+        self.layout = layout if layout is not None else settings.default_layout
+        self.band_height = band_height
+        self.weights = [G[:, :, 0] if G.ndim == 3 else G for G in weights]
+        self.tables = {}
+        for viewport in self.viewports:
+            self.tables[viewport.name] = self.build_tables(viewport)
+
+    def build_tables(self, viewport):
+        if viewport.camera is None:
+            return self.build_birdview_tables(viewport)
+        return self.build_camera_tables(viewport)
+
+    def make_layer(self, k, mapx, mapy, weight):
+        """
+        The rectangles of the output where camera `k` has a nonzero weight,
+        with their maps and weights. The weight is None where it is 1.
+        """
+        rects = []
+        for y0, y1, x0, x1 in utils.mask_to_rects(weight > 0, self.band_height):
+            map1, map2 = cv2.convertMaps(np.ascontiguousarray(mapx[y0:y1, x0:x1]),
+                                         np.ascontiguousarray(mapy[y0:y1, x0:x1]),
+                                         cv2.CV_16SC2)
+            w = weight[y0:y1, x0:x1]
+            w = None if np.all(w == 1) else np.ascontiguousarray(w[:, :, None], np.float32)
+            rects.append((y0, y1, x0, x1, map1, map2, w))
+        return k, rects
+
+    def region_weights(self, cx, cy):
+        """
+        Weights of the four cameras at the canvas points (cx, cy), those of
+        the nearest canvas pixel, and the mask of the points on the car.
+        """
+        lay = self.layout
+        ix = np.clip(np.round(cx).astype(int), 0, lay.total_w - 1)
+        iy = np.clip(np.round(cy).astype(int), 0, lay.total_h - 1)
+        top, bottom = iy < lay.yt, iy >= lay.yb
+        left, right = ix < lay.xl, ix >= lay.xr
+        middle_x, middle_y = ~left & ~right, ~top & ~bottom
+
+        shape = cx.shape
+        front, back, left_w, right_w = [np.zeros(shape, np.float32) for _ in range(4)]
+        front[top & middle_x] = 1
+        back[bottom & middle_x] = 1
+        left_w[middle_y & left] = 1
+        right_w[middle_y & right] = 1
+        for k, region, (A, B), (gy, gx) in (
+                (0, top & left, (front, left_w), (iy, ix)),
+                (1, top & right, (front, right_w), (iy, ix - lay.xr)),
+                (2, bottom & left, (back, left_w), (iy - lay.yb, ix)),
+                (3, bottom & right, (back, right_w), (iy - lay.yb, ix - lay.xr))):
+            G = self.weights[k][gy[region], gx[region]]
+            A[region] = G
+            B[region] = 1 - G
+        return [front, back, left_w, right_w], middle_x & middle_y
+
+    def make_car_layer(self, cx, cy, car_region):
+        """
+        The car image sampled at the canvas points (cx, cy) of `car_region`,
+        it does not change so it is sampled once.
+        """
+        if not np.any(car_region):
+            return None
+        lay = self.layout
+        canvas_car = cv2.remap(lay.car_image, (cx - lay.xl).astype(np.float32),
+                               (cy - lay.yt).astype(np.float32), cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+        y0, y1, x0, x1 = utils.mask_to_rects(car_region, car_region.shape[0])[0]
+        return (y0, y1, x0, x1, canvas_car[y0:y1, x0:x1], car_region[y0:y1, x0:x1, None])
+
+    def build_birdview_tables(self, viewport):
+        lay = self.layout
+        rect = viewport.rect if viewport.rect is not None else (0, 0, lay.total_w, lay.total_h)
+        cx, cy = sample_grid(rect, viewport.size)
+        weights, car_region = self.region_weights(cx, cy)
+        layers = []
+        for k, (weight, (ox, oy)) in enumerate(zip(weights, canvas_offsets(lay))):
+            if not np.any(weight > 0):
+                continue
+            mapx, mapy = self.camera_models[k].flipped_to_raw(cx - ox, cy - oy)
+            layers.append(self.make_layer(k, mapx, mapy, weight))
+        return layers, self.make_car_layer(cx, cy, car_region)
+
+    def build_camera_tables(self, viewport):
+        k = self.layout.camera_names.index(viewport.camera)
+        model = self.camera_models[k]
+        width, height = [int(x) for x in model.resolution]
+        rect = viewport.rect if viewport.rect is not None else (0, 0, width, height)
+        u, v = sample_grid(rect, viewport.size)
+        mapx, mapy = model.undistorted_to_raw(u, v)
+        weight = np.ones(u.shape, np.float32)
+        return [self.make_layer(k, mapx, mapy, weight)], None
+
+    def render(self, raw_frames, gains=None, white_balance=None, names=None):
+        """
+        Render the viewports from the raw frames of the four cameras.
+
+        gains: luminance gains of the cameras, an array of shape (4, 3).
+        white_balance: white balance gains of the birdview, shape (3,).
+        names: render only the viewports with these names, all if None.
+
+        Returns a dict mapping the viewport names to their images.
+        """
+        gains = np.ones((4, 3)) if gains is None else np.asarray(gains, np.float64)
+        if white_balance is not None:
+            gains = gains * np.asarray(white_balance, np.float64)
+        images = {}
+        for viewport in self.viewports:
+            if names is not None and viewport.name not in names:
+                continue
+            layers, car = self.tables[viewport.name]
+            w, h = viewport.size
+            acc = np.zeros((h, w, 3), np.float32)
+            for k, rects in layers:
+                g = gains[k].astype(np.float32)
+                for y0, y1, x0, x1, map1, map2, weight in rects:
+                    part = cv2.remap(raw_frames[k], map1, map2, interpolation=cv2.INTER_LINEAR,
+                                     borderMode=cv2.BORDER_CONSTANT)
+                    if weight is None:
+                        acc[y0:y1, x0:x1] += part * g
+                    else:
+                        acc[y0:y1, x0:x1] += part * (weight * g)
+            image = np.minimum(acc, 255).astype(np.uint8)
+            if car is not None:
+                y0, y1, x0, x1, car_image, mask = car
+                np.copyto(image[y0:y1, x0:x1], car_image, where=mask)
+            images[viewport.name] = image
+        return images
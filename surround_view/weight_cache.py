@@ -0,0 +1,120 @@
+"""
+Incremental computation of the overlap weights and masks.
+
+`utils.get_weight_mask_matrix` tests every pixel of an overlap against the
+outlines of the two cameras in a Python loop, it takes seconds per overlap.
+`compute_overlap_weights` computes the overlaps on worker processes and
+stores each one in a `WeightCache` under a key made of the projection
+parameters of its two cameras and of the projected images, so after one
+camera is recalibrated only the overlaps it takes part in are computed
+again.
+"""
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from . import utils
+
+
+def overlap_key(imA, imB, params=(), dist_threshold=5):
+    """
+    Key of the weights and mask of the overlap of `imA` and `imB`. `params`
+    are strings identifying the projection of the two cameras, see
+    `FisheyeCameraModel.projection_key`.
+    """
+    h = hashlib.sha1()
+    for p in params:
+        h.update(p.encode())
+    for image in (imA, imB):
+        h.update(str(image.shape).encode())
+        h.update(np.ascontiguousarray(image).data)
+    h.update(str(dist_threshold).encode())
+    return h.hexdigest()
+
+
+class WeightCache(object):
+
+    """
+    A directory with the weights (float32) and mask (uint8) of one overlap
+    per file, returned in the same types.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key):
+        """
+        Returns (G, M) or None if the key is not in the cache or its file
+        cannot be read.
+        """
+        filename = self.path(key)
+        if not os.path.isfile(filename):
+            self.misses += 1
+            return None
+        try:
+            with np.load(filename) as data:
+                G, M = data["weight"], data["mask"]
+        except Exception:
+            # e.g. left half written by a killed process, computed again
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.asarray(G, np.float32), np.asarray(M, np.uint8)
+
+    def save(self, key, G, M):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # written aside and renamed, so a reader never sees a partial file
+        filename = self.path(key)
+        with open(filename + ".tmp", "wb") as f:
+            np.savez_compressed(f, weight=np.float32(G), mask=np.uint8(M))
+        os.replace(filename + ".tmp", filename)
+
+
+def compute_overlap_weights(pairs, params=None, cache=None, workers=None, dist_threshold=5):
+    """
+    Weights and masks of a list of overlaps, see `utils.get_weight_mask_matrix`.
+
+    pairs: list of (imA, imB), the two cameras cropped to each overlap.
+    params: list of the `params` of `overlap_key` for each overlap.
+    cache: a `WeightCache`, overlaps found in it are not computed.
+    workers: number of processes the missing overlaps are computed on,
+        defaults to one per missing overlap.
+
+    Returns the list of (G, M), G in float32 and M in 0..255 (uint8) as
+    computed by `get_weight_mask_matrix`, the same whether they come from
+    the cache or not, and the indices of the overlaps computed.
+    """
+    results = [None] * len(pairs)
+    keys = [None] * len(pairs)
+    if cache is not None:
+        for k, (imA, imB) in enumerate(pairs):
+            keys[k] = overlap_key(imA, imB, params[k] if params is not None else (),
+                                  dist_threshold)
+            results[k] = cache.load(keys[k])
+
+    missing = [k for k, result in enumerate(results) if result is None]
+    if len(missing) == 1:
+        k = missing[0]
+        results[k] = utils.get_weight_mask_matrix(*pairs[k], dist_threshold=dist_threshold)
+    elif len(missing) > 1:
+        max_workers = workers if workers is not None else min(len(missing), os.cpu_count())
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {k: executor.submit(utils.get_weight_mask_matrix, *pairs[k],
+                                          dist_threshold=dist_threshold)
+                       for k in missing}
+            for k, future in futures.items():
+                results[k] = future.result()
+
+    for k in missing:
+        G, M = results[k]
+        results[k] = np.asarray(G, np.float32), np.asarray(M, np.uint8)
+        if cache is not None:
+            cache.save(keys[k], *results[k])
+    return results, missing
@@ -1,20 +1,37 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 import cv2
 import time
+from surround_view.camera_probe import probe_cameras, CameraCache
+
+# the modes and frame rates of the probed cameras, keyed by their
+# /dev/v4l/by-path name
+CACHE_FILE = os.path.join(os.getcwd(), ".camera_cache.json")
+
 
 # get the installed camera list for initialization.
-def get_cam_lst(cam_lst=range(0, 24)):
-    arr = []
-    for iCam in cam_lst:
-        cap = cv2.VideoCapture(iCam)
-        if not cap.read()[0]:
-            continue
+def get_cam_lst(cam_lst=None, timeout=5.0, refresh=False):
+    """
+    The `CameraInfo` of the cameras that deliver frames. All the cameras
+    are probed at the same time, a camera that does not answer within
+    `timeout` seconds is skipped, and the cameras found in the cache are not
+    probed again unless `refresh` is set.
+    """
+    cache = CameraCache(CACHE_FILE)
+    if refresh:
+        cache.entries = {}
+    infos = probe_cameras(cam_lst, timeout, cache)
+    for info in infos:
+        if info.ok:
+            print("video{}: {} {}x{} at {:.1f} fps, modes {}{}".format(
+                info.index, info.fourcc, info.resolution[0], info.resolution[1], info.fps,
+                " ".join("{}:{}x{}".format(*mode) for mode in info.modes),
+                " (cached)" if info.cached else " ({:.1f}s)".format(info.probe_time)))
         else:
-            arr.append(iCam)
-
-        cap.release()
-    return arr
+            print("video{}: {}".format(info.index, info.error))
+    return [info for info in infos if info.ok]
 
 def show_cam_img(caps, cam_list):
     print("INFO: Press 'q' to quit! Press 's' to save a picture, 'n' to change to next camera device!")
@@ -42,21 +59,22 @@ def show_cam_img(caps, cam_list):
         # save the picture
         if c == ord('s'):
             if ret:
-                name = 'video{0}_{1}.png'.format(cam_list[idx],
+                name = 'video{0}_{1}.png'.format(cam_list[idx].index,
                             time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime()))
                 cv2.imwrite(name, frame)
                 print("saved file: %s!" %name)
 
     cv2.destroyAllWindows()
 
-def init_caps(cam_list, resolution=(1280,720)):
+def init_caps(cam_list):
+    """
+    Open the probed cameras in the mode they were probed in.
+    """
     caps = []
-    for iCam in cam_list:
-        cap = cv2.VideoCapture(iCam)
-        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
-        cap.set(3, resolution[0])
-        cap.set(4, resolution[1])
-        caps.append(cap)
+    for info in cam_list:
+        source = info.make_source()
+        source.open()
+        caps.append(source)
 
     return caps
 
@@ -64,13 +82,13 @@ def deinit_caps(cap_list):
     for cap in cap_list:
         cap.release()
 
-def show_cameras(video_list=None):
+def show_cameras(video_list=None, timeout=5.0, refresh=False):
     if video_list == None:
         print("Start to search all available camera devices, please wait... ")
-        cam_list = get_cam_lst()
+        cam_list = get_cam_lst(timeout=timeout, refresh=refresh)
         err_msg = "cannot find any video device!"
     else:
-        cam_list = get_cam_lst(video_list)
+        cam_list = get_cam_lst(video_list, timeout, refresh)
         err_msg = "cannot find available video device in list: {0}!".format(video_list) +\
                     "\nPlease check the video devices in /dev/v4l/by-path/ folder!"
 
@@ -78,14 +96,19 @@ def show_cameras(video_list=None):
         print("ERROR: " + err_msg)
         return
 
-    print("Available video device list is {}".format(cam_list))
+    print("Available video device list is {}".format([info.index for info in cam_list]))
     caps = init_caps(cam_list)
     show_cam_img(caps, cam_list)
     deinit_caps(caps)
 
 if __name__ == "__main__":
-    # User can specify the video list here.
-    #show_cameras([2, 6, 10, 14])
-
-    # Or search all available video devices automatically.
-    show_cameras()
+    parser = argparse.ArgumentParser()
+    # User can specify the video list here, e.g. -devices 2 6 10 14
+    parser.add_argument("-devices", "--devices", type=int, nargs="+", default=None,
+                        help="indices of the /dev/video devices, all available ones by default")
+    parser.add_argument("-timeout", "--timeout", type=float, default=5.0,
+                        help="seconds after which the probe of a device is abandoned")
+    parser.add_argument("-refresh", "--refresh", action="store_true",
+                        help="probe the cameras again instead of using the cache")
+    args = parser.parse_args()
+    show_cameras(args.devices, args.timeout, args.refresh)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Measure how long the frames wait in the pipeline before they reach the
+application, with the low-latency appsink policy (drop=true max-buffers=1
+sync=false) and with the old unbounded appsink queue.
+
+The consumer sleeps for a while after every frame to simulate a stitcher that
+is slower than the camera. The queueing delay of a frame is the time elapsed
+since the first frame was grabbed minus the time between their timestamps,
+`(now - now0) - (pts - pts0)`, so the unknown offset between the clock of the
+pipeline and the clock of the application cancels out. The first frame is the
+reference and has no delay.
+
+Usage:
+    python test_gst_latency.py --source videotestsrc --delay 50
+    python test_gst_latency.py --source nvarguscamerasrc --cam_id 0
+"""
+import argparse
+import time
+import numpy as np
+import cv2
+from surround_view.utils import gstreamer_pipeline
+
+
+def measure_queueing_delay(pipeline, num_frames, delay):
+    cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+    if not cap.isOpened():
+        print("ERROR: cannot open pipeline: {}".format(pipeline))
+        return None
+
+    now0 = pts0 = None
+    delays = []
+    for _ in range(num_frames):
+        if not cap.grab():
+            break
+        now = time.perf_counter() * 1000
+        pts = cap.get(cv2.CAP_PROP_POS_MSEC)
+        if now0 is None:
+            now0, pts0 = now, pts
+        delays.append((now - now0) - (pts - pts0))
+        cap.retrieve()
+        time.sleep(delay / 1000.0)
+
+    cap.release()
+    return np.array(delays)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="videotestsrc",
+                        choices=["videotestsrc", "nvarguscamerasrc", "v4l2src"],
+                        help="gstreamer source element")
+    parser.add_argument("--cam_id", type=int, default=0,
+                        help="sensor id, device index or test pattern")
+    parser.add_argument("--resolution", default="960x640",
+                        help="capture resolution")
+    parser.add_argument("--framerate", type=int, default=30,
+                        help="capture frame rate")
+    parser.add_argument("--delay", type=float, default=50,
+                        help="processing time of the simulated consumer in ms")
+    parser.add_argument("--frames", type=int, default=100,
+                        help="number of frames to measure")
+    args = parser.parse_args()
+
+    width, height = [int(x) for x in args.resolution.split("x")]
+    policies = [("queued (old)", dict(drop=False, max_buffers=0, sync=True)),
+                ("low latency", dict(drop=True, max_buffers=1, sync=False))]
+
+    for name, policy in policies:
+        pipeline = gstreamer_pipeline(cam_id=args.cam_id,
+                                      capture_width=width,
+                                      capture_height=height,
+                                      framerate=args.framerate,
+                                      flip_method=0,
+                                      source=args.source,
+                                      **policy)
+        delays = measure_queueing_delay(pipeline, args.frames, args.delay)
+        if delays is None or len(delays) == 0:
+            continue
+
+        print("{:>12}: mean queueing delay {:.1f} ms, last {:.1f} ms, max {:.1f} ms".format(
+            name, delays.mean(), delays[-1], delays.max()))
+
+
+if __name__ == "__main__":
+    main()